@@ -0,0 +1,264 @@
+import json
+from pathlib import Path
+from typing import Dict, List
+
+import numpy as np
+
+from encode_profiles import list_audio_files
+from proxies import PROXY_SAMPLE_RATE, get_proxy, read_proxy
+
+
+# Boundary timings of a sura are stored per reciter as timings/NNN.json, in milliseconds on the fixed file timeline:
+#   {"boundaries": [{"label": "ayah 1", "ms": 0.0}, {"label": "page 50", "ms": 15230.0}, ...]}
+# Hand made timings exist only for a few reference recordings. align_sura warps the log-mel features of another reciter
+# onto the reference and maps the reference boundaries through the warping path, the written file also names the reference.
+# The timings of a median file are the fixed timings divided by the speed change of the reciter.
+TIMINGS_FOLDER_NAME = "timings"
+ALIGNMENT_FOLDER_NAME = ".alignments"
+
+N_FFT = 512
+WIN_LENGTH = 400  # 25 ms at 16 kHz
+HOP_LENGTH = 320  # 20 ms, 50 feature frames per second
+N_MELS = 40
+FRAME_MS = 1000.0 * HOP_LENGTH / PROXY_SAMPLE_RATE
+
+# step pattern (reference frames, query frames): diagonal plus the two slope limits 1/2 and 2
+DTW_STEPS = np.array([[1, 1], [1, 2], [2, 1]])
+
+
+def mel_filterbank(n_mels: int = N_MELS, n_fft: int = N_FFT, sample_rate: int = PROXY_SAMPLE_RATE) -> np.ndarray:
+    """Returns the (n_mels, n_fft // 2 + 1) matrix of triangular mel filters."""
+    def hz_to_mel(hz):
+        return 2595.0 * np.log10(1.0 + hz / 700.0)
+
+    mel_points = np.linspace(hz_to_mel(20.0), hz_to_mel(sample_rate / 2.0), n_mels + 2)
+    hz_points = 700.0 * (10.0 ** (mel_points / 2595.0) - 1.0)
+    fft_freqs = np.linspace(0.0, sample_rate / 2.0, n_fft // 2 + 1)
+    lower, centre, upper = hz_points[:-2, None], hz_points[1:-1, None], hz_points[2:, None]
+    rising = (fft_freqs[None, :] - lower) / (centre - lower)
+    falling = (upper - fft_freqs[None, :]) / (upper - centre)
+    return np.maximum(0.0, np.minimum(rising, falling)).astype(np.float32)
+
+
+def log_mel_features(samples: np.ndarray, block_frames: int = 3000) -> np.ndarray:
+    """
+    Calculates log-mel frames of 16 kHz samples block by block, so a memory mapped multi-hour proxy is never loaded at once.
+    The frames are normalized per band over the whole file and to unit length, so the dot product of two frames is their cosine similarity.
+
+    Returns:
+        np.ndarray: (frames, N_MELS) float32 features, FRAME_MS apart.
+    """
+    num_frames = max(0, 1 + (len(samples) - WIN_LENGTH) // HOP_LENGTH)
+    features = np.empty((num_frames, N_MELS), dtype=np.float32)
+    filterbank = mel_filterbank()
+    window = np.hanning(WIN_LENGTH).astype(np.float32)
+    for first_frame in range(0, num_frames, block_frames):
+        end_frame = min(num_frames, first_frame + block_frames)
+        block = np.asarray(samples[first_frame * HOP_LENGTH:(end_frame - 1) * HOP_LENGTH + WIN_LENGTH], dtype=np.float32) / 32768.0
+        frames = np.lib.stride_tricks.sliding_window_view(block, WIN_LENGTH)[::HOP_LENGTH] * window
+        power = np.abs(np.fft.rfft(frames, n=N_FFT)) ** 2
+        features[first_frame:end_frame] = np.log(power @ filterbank.T + 1e-10)
+
+    if num_frames:
+        features -= features.mean(axis=0)
+        features /= features.std(axis=0) + 1e-6
+        features /= np.linalg.norm(features, axis=1, keepdims=True) + 1e-6
+    return features
+
+
+def get_features(source_filep: Path) -> np.ndarray:
+    """
+    Returns the log-mel features of an audio file, cached next to its proxy under the same content hash.
+    The cache stores float16; fresh features are rounded the same way, so a cache hit returns exactly the same float32 array.
+    """
+    proxy_path = get_proxy(source_filep)
+    features_path = proxy_path.with_name(f"{proxy_path.stem}.logmel{N_MELS}.npy")
+    if features_path.exists():
+        return np.load(features_path).astype(np.float32)
+    features = log_mel_features(read_proxy(source_filep)).astype(np.float16)
+    np.save(features_path, features)
+    return features.astype(np.float32)
+
+
+def _band_values(row: np.ndarray, row_offset: int, cols: np.ndarray) -> np.ndarray:
+    """Looks up the columns cols in a band row starting at column row_offset, inf outside of the band."""
+    band_idx = cols - row_offset
+    valid = (band_idx >= 0) & (band_idx < len(row))
+    values = np.full(len(cols), np.inf, dtype=np.float32)
+    values[valid] = row[band_idx[valid]]
+    return values
+
+
+def banded_dtw(ref: np.ndarray, query: np.ndarray, band_frames: int, slope: float, free_end: bool = False) -> np.ndarray:
+    """
+    Dynamic time warping of query onto ref inside a band of +-band_frames around the line j = i * slope, starting at (0, 0).
+    Only the band is stored (rows x (2 * band_frames + 1)) and every row is computed in one vectorized step,
+    which works because no step of DTW_STEPS stays inside a row.
+
+    Args:
+        ref (np.ndarray): Reference features, see log_mel_features.
+        query (np.ndarray): Query features.
+        band_frames (int): Half width of the band in query frames.
+        slope (float): Expected query frames per reference frame.
+        free_end (bool): End in the best column of the last row instead of the last query frame.
+
+    Returns:
+        np.ndarray: The warping path as (k, 2) array of (ref frame, query frame), from (0, 0) onwards.
+    """
+    num_rows, num_cols = len(ref), len(query)
+    width = 2 * band_frames + 1
+    offsets = np.round(np.arange(num_rows) * slope).astype(np.int64) - band_frames
+    band_cols = np.arange(width)
+    costs = np.full((num_rows, width), np.inf, dtype=np.float32)
+    steps = np.zeros((num_rows, width), dtype=np.int8)
+    costs[0, -offsets[0]] = 1.0 - float(ref[0] @ query[0])
+
+    no_row = np.full(width, np.inf, dtype=np.float32)
+    for row in range(1, num_rows):
+        cols = offsets[row] + band_cols
+        valid = (cols >= 0) & (cols < num_cols)
+        local_cost = np.full(width, np.inf, dtype=np.float32)
+        local_cost[valid] = 1.0 - query[cols[valid]] @ ref[row]
+        candidates = np.stack([
+            _band_values(costs[row - 1], offsets[row - 1], cols - 1),
+            _band_values(costs[row - 1], offsets[row - 1], cols - 2),
+            _band_values(costs[row - 2], offsets[row - 2], cols - 1) if row >= 2 else no_row,
+        ])
+        steps[row] = np.argmin(candidates, axis=0)
+        costs[row] = local_cost + candidates[steps[row], band_cols]
+
+    end_col = num_cols - 1 - offsets[-1]
+    if free_end or not (0 <= end_col < width) or not np.isfinite(costs[-1, end_col]):
+        # the best end, normalized by the path length so short cuts through the band are not preferred
+        path_lengths = np.maximum(1, num_rows + offsets[-1] + band_cols + 1)
+        end_col = int(np.argmin(np.where(np.isfinite(costs[-1]), costs[-1] / path_lengths, np.inf)))
+    if not np.isfinite(costs[-1, end_col]):
+        raise ValueError("No warping path inside the band, the band is too narrow for the tempo difference.")
+
+    path = []
+    row, band_col = num_rows - 1, end_col
+    while True:
+        col = offsets[row] + band_col
+        path.append((row, col))
+        if row == 0:
+            break
+        step_rows, step_cols = DTW_STEPS[steps[row, band_col]]
+        row, col = row - step_rows, col - step_cols
+        band_col = col - offsets[row]
+    return np.array(path[::-1], dtype=np.int64)
+
+
+def align_features(ref: np.ndarray, query: np.ndarray, chunk_frames: int = 3000, band_frames: int = 500) -> np.ndarray:
+    """
+    Aligns two feature sequences of any length with banded DTW in chunks of chunk_frames reference frames (60 s).
+    Each chunk starts at an anchor on the path of the previous chunk; only the first three quarters of a chunk path are kept,
+    so the free end of a chunk never decides the path. Memory stays at one chunk band, even for multi-hour suras.
+
+    Returns:
+        np.ndarray: The warping path as (k, 2) int32 array of (ref frame, query frame) from the first to the last frames.
+    """
+    num_ref, num_query = len(ref), len(query)
+    commit_frames = max(2, chunk_frames * 3 // 4)
+    path_parts = []
+    anchor_ref, anchor_query = 0, 0
+    while True:
+        end_ref = min(num_ref, anchor_ref + chunk_frames)
+        last_chunk = end_ref == num_ref
+        remaining_slope = (num_query - anchor_query) / max(1, num_ref - anchor_ref)
+        if last_chunk:
+            end_query = num_query
+            slope = (num_query - 1 - anchor_query) / max(1, end_ref - 1 - anchor_ref)
+        else:
+            end_query = min(num_query, anchor_query + int(round((end_ref - anchor_ref) * remaining_slope)) + band_frames)
+            slope = remaining_slope
+        chunk_path = banded_dtw(ref[anchor_ref:end_ref], query[anchor_query:end_query], band_frames, slope, free_end=not last_chunk)
+        chunk_path += (anchor_ref, anchor_query)
+        if last_chunk:
+            path_parts.append(chunk_path)
+            break
+        kept = chunk_path[chunk_path[:, 0] < anchor_ref + commit_frames]
+        path_parts.append(kept[:-1])
+        anchor_ref, anchor_query = (int(value) for value in kept[-1])
+    return np.concatenate(path_parts).astype(np.int32)
+
+
+def get_alignment(ref_filep: Path, query_filep: Path, quran_data_folder: Path) -> np.ndarray:
+    """Returns the warping path between two audio files, cached by the content hashes of both."""
+    alignment_folder = quran_data_folder / ALIGNMENT_FOLDER_NAME
+    alignment_folder.mkdir(exist_ok=True)
+    path_file = alignment_folder / f"{get_proxy(ref_filep).stem}_{get_proxy(query_filep).stem}.npy"
+    if path_file.exists():
+        return np.load(path_file)
+    path = align_features(get_features(ref_filep), get_features(query_filep))
+    np.save(path_file, path)
+    return path
+
+
+def map_times(path: np.ndarray, ref_times_ms: List[float]) -> List[float]:
+    """Maps times on the reference timeline to the query timeline by interpolating along the warping path."""
+    ref_frames, first_idx = np.unique(path[:, 0], return_index=True)
+    # a reference frame matched to several query frames maps to their mean
+    query_sums = np.add.reduceat(path[:, 1].astype(np.float64), first_idx)
+    query_frames = query_sums / np.diff(np.append(first_idx, len(path)))
+    query_ms = np.interp(np.asarray(ref_times_ms) / FRAME_MS, ref_frames, query_frames) * FRAME_MS
+    return [float(ms) for ms in query_ms]
+
+
+def load_timings(rec_folder: Path, sura_num: int) -> Dict:
+    timings_path = rec_folder / TIMINGS_FOLDER_NAME / f"{sura_num:03d}.json"
+    if not timings_path.exists():
+        return None
+    with open(timings_path) as f:
+        return json.load(f)
+
+
+def align_sura(reference_folder: Path, rec_folder: Path, sura_num: int, quran_data_folder: Path) -> Dict:
+    """
+    Transfers the boundary timings of a sura from the reference reciter to another reciter and stores them in its timings folder.
+
+    Returns:
+        Dict: The written timings, None if the reference has no timings or one of the fixed files is missing.
+    """
+    reference_timings = load_timings(reference_folder, sura_num)
+    ref_files = [filep for filep in list_audio_files(reference_folder / "fixed") if int(filep.stem.split("_")[0]) == sura_num]
+    query_files = [filep for filep in list_audio_files(rec_folder / "fixed") if int(filep.stem.split("_")[0]) == sura_num]
+    if reference_timings is None or not ref_files or not query_files:
+        return None
+
+    path = get_alignment(ref_files[0], query_files[0], quran_data_folder)
+    boundaries = reference_timings["boundaries"]
+    mapped_ms = map_times(path, [boundary["ms"] for boundary in boundaries])
+    timings = {
+        "reference": reference_folder.name,
+        "boundaries": [{"label": boundary["label"], "ms": ms} for boundary, ms in zip(boundaries, mapped_ms)],
+    }
+    timings_folder = rec_folder / TIMINGS_FOLDER_NAME
+    timings_folder.mkdir(exist_ok=True)
+    with open(timings_folder / f"{sura_num:03d}.json", "w") as f:
+        json.dump(timings, f, indent=2)
+    return timings
+
+
+def transfer_timings(quran_data_folder: Path, reference_reciter: str, rec_folders: List[Path]) -> None:
+    """
+    Aligns every sura of the reciters which the reference reciter has timings for. Reciters with hand made timings
+    (timings without "reference") are left alone. Thanks to the caches, adding a reciter aligns only that reciter.
+    """
+    reference_folder = quran_data_folder / reference_reciter
+    timings_folder = reference_folder / TIMINGS_FOLDER_NAME
+    if not timings_folder.exists():
+        raise ValueError(F"The reference reciter {reference_reciter} has no {TIMINGS_FOLDER_NAME} folder.")
+    sura_nums = sorted(int(timings_path.stem) for timings_path in timings_folder.glob("*.json"))
+
+    for rec_folder in rec_folders:
+        if rec_folder.name == reference_reciter:
+            continue
+        for sura_num in sura_nums:
+            existing_timings = load_timings(rec_folder, sura_num)
+            if existing_timings is not None and "reference" not in existing_timings:
+                continue
+            try:
+                if align_sura(reference_folder, rec_folder, sura_num, quran_data_folder) is not None:
+                    print(F" - {rec_folder.name}: timings of sura {sura_num} aligned to {reference_reciter}")
+            except ValueError as e:
+                print(F" - {rec_folder.name}: sura {sura_num} could not be aligned: {e}")
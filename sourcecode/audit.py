@@ -0,0 +1,163 @@
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Dict, List
+
+import mutagen
+
+from encode_profiles import AUDIO_EXTENSIONS, get_profile, list_audio_files
+from file_io import clip_filename, clip_metadata, clip_windows
+from overlap_encode import samples_per_frame
+from range_extract import get_duration_ms
+from utils import clip_folder_name, find_median_folder
+
+
+AUDIT_REPORT_NAME = "audit_report.json"
+AUDITED_TAGS = ["title", "album", "artist", "genre"]
+
+
+def inspect_audio_file(file_path: str) -> Dict:
+    """
+    Reads the duration and the tags of an audio file from its headers only, nothing gets decoded.
+
+    Returns:
+        Dict: "path", "length_s" and "tags", or "error" if the file could not be parsed.
+    """
+    try:
+        audio = mutagen.File(file_path, easy=True)
+        if audio is None:
+            return {"path": file_path, "error": "unknown audio format"}
+        tags = {}
+        if audio.tags is not None:
+            for key in AUDITED_TAGS:
+                values = audio.tags.get(key)
+                if values:
+                    tags[key] = str(values[0])
+        return {"path": file_path, "length_s": audio.info.length, "tags": tags}
+    except Exception as e:
+        return {"path": file_path, "error": str(e)}
+
+
+def expected_clip_plan(
+        rec_folder: Path,
+        clip_length_ms: int,
+        overlap_ms: int,
+        speedup_factor: float,
+        clip_folder_prefix: str,
+        clip_profile: str = None,
+        rec_med_speedup: Dict[str, float] = None) -> Dict[str, Dict]:
+    """
+    Calculates which clips the clip run of a reciter should have written, with their lengths and tags.
+
+    Args:
+        rec_folder (Path): The reciter folder.
+        rec_med_speedup (Dict[str, float]): For fused renders (fused_render), the median speedup factors of the reciters.
+            The plan is then calculated from the fixed files. If None, it is calculated from the median files.
+        See split_all_median_files_to_clips for the other arguments.
+
+    Returns:
+        Dict[str, Dict]: Expected clip file name mapped to its "length_s" and "tags".
+    """
+    profile = get_profile(clip_profile)
+    reciter_name = rec_folder.name
+    # the clips of both flows are labeled with speed 1.00, the speed is only part of the folder name
+    name_speedup_factor = 1.0
+    if rec_med_speedup is None:
+        source_folder = find_median_folder(rec_folder)
+        speed_change = 1.0
+    else:
+        source_folder = rec_folder / "fixed"
+        speed_change = rec_med_speedup[reciter_name] * speedup_factor
+    if not source_folder.exists():
+        return {}
+
+    plan = {}
+    for source_file in list_audio_files(source_folder):
+        # the decoded length the clip writers split, the header length of mutagen includes the encoder delay and padding
+        try:
+            duration_ms = get_duration_ms(source_file)
+        except Exception:
+            continue
+        sura_num = int(source_file.stem.split("_")[0])
+        # the median flow splits the decoded AudioSegment, whose length is rounded to whole milliseconds
+        total_ms = round(duration_ms) if rec_med_speedup is None else duration_ms / speed_change
+        for clip_num, start_ms, end_ms in clip_windows(total_ms, clip_length_ms, overlap_ms):
+            filename = clip_filename(reciter_name, sura_num, name_speedup_factor, clip_num, clip_folder_prefix, profile["extension"])
+            tags = clip_metadata(None, reciter_name, sura_num, name_speedup_factor, clip_num, clip_folder_prefix)
+            plan[filename] = {"length_s": (end_ms - start_ms) / 1000.0, "tags": tags}
+    return plan
+
+
+def audit_clip_library(
+        quran_data_folder: Path,
+        rec_folders: List[Path],
+        clip_length_ms: int,
+        overlap_ms: int,
+        speedup_factor: float,
+        clip_folder_prefix: str,
+        clip_profile: str = None,
+        rec_med_speedup: Dict[str, float] = None,
+        max_workers: int = None) -> Dict[str, List]:
+    """
+    Checks the clip folders of all reciters against the expected clip plan, parsing only headers and tags of the files in parallel.
+    Reports missing clips, truncated clips, clips with wrong title/album/artist/genre tags and orphaned files
+    (files which are not part of the plan, like leftover temp_ files or clips of an older clip length).
+    The report is printed and stored as AUDIT_REPORT_NAME in the quran data folder.
+
+    Args:
+        quran_data_folder (Path): Path to the main data folder containing reciter subfolders.
+        rec_folders (List[Path]): The reciter folders to audit.
+        max_workers (int): Number of processes parsing the files, the number of cpus if None.
+        See expected_clip_plan for the other arguments.
+
+    Returns:
+        Dict[str, List]: The report with the lists "missing", "truncated", "mistagged", "orphaned" and "unreadable".
+    """
+    report = {"missing": [], "truncated": [], "mistagged": [], "orphaned": [], "unreadable": []}
+    profile = get_profile(clip_profile)
+    frame_s = samples_per_frame(profile["sample_rate"]) / profile["sample_rate"]
+    plans = {}
+    existing_files = []
+    for rec_folder in rec_folders:
+        output_dir = rec_folder / clip_folder_name(rec_folder.name, speedup_factor, clip_folder_prefix)
+        plans[output_dir] = expected_clip_plan(rec_folder, clip_length_ms, overlap_ms, speedup_factor, clip_folder_prefix,
+                                               clip_profile, rec_med_speedup)
+        if output_dir.exists():
+            existing_files += [str(file_path) for file_path in output_dir.iterdir()
+                               if file_path.is_file() and (file_path.suffix in AUDIO_EXTENSIONS or file_path.name.startswith("temp_"))]
+
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+    with ProcessPoolExecutor(max_workers=max_workers) as pool:
+        infos = {info["path"]: info for info in pool.map(inspect_audio_file, existing_files, chunksize=256)}
+
+    for output_dir, plan in plans.items():
+        for filename, expected in plan.items():
+            clip_path = str(output_dir / filename)
+            info = infos.pop(clip_path, None)
+            if info is None:
+                # the overlap encoder cuts on the frame grid and drops a trailing clip shorter than one frame
+                if expected["length_s"] >= frame_s:
+                    report["missing"].append(clip_path)
+                continue
+            if "error" in info:
+                report["unreadable"].append({"path": clip_path, "error": info["error"]})
+                continue
+            # encoder delay and padding make clips slightly longer, only shorter clips count as truncated
+            tolerance_s = max(0.5, 0.01 * expected["length_s"])
+            if info["length_s"] < expected["length_s"] - tolerance_s:
+                report["truncated"].append({"path": clip_path, "length_s": info["length_s"], "expected_s": expected["length_s"]})
+            wrong_tags = {key: {"found": info["tags"].get(key), "expected": expected["tags"][key]}
+                          for key in AUDITED_TAGS if info["tags"].get(key) != expected["tags"][key]}
+            if wrong_tags:
+                report["mistagged"].append({"path": clip_path, "tags": wrong_tags})
+    report["orphaned"] = sorted(infos)
+
+    print("\n", " Clip library audit ".center(80, "="))
+    print(f"Checked {len(existing_files)} files against {sum(len(plan) for plan in plans.values())} planned clips.")
+    for category, entries in report.items():
+        print(f" - {category}: {len(entries)}")
+    with open(quran_data_folder / AUDIT_REPORT_NAME, "w") as f:
+        json.dump(report, f, indent=2)
+    return report
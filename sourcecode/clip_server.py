@@ -0,0 +1,413 @@
+import hashlib
+import json
+import logging
+import os
+import subprocess
+import threading
+import time
+from collections import OrderedDict, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import BinaryIO, Dict, Tuple
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+from pydub import AudioSegment
+
+from encode_profiles import ffmpeg_output_args, get_profile, list_audio_files
+from file_io import clip_windows
+from pace import load_sura_pages
+from processflow import clip_envelope_regions, envelope_volume_expression
+from timeline import VirtualTimeline
+from utils import find_median_folder
+
+
+# Clip presets of the server, the same settings main.py uses for the pre-rendered clip folders
+CLIP_PRESETS = {
+    "thirds": {"clip_length_ms": 60000, "overlap_ms": 40000, "fade_ms": 20000, "duck": True},
+    "plain": {"clip_length_ms": 60000, "overlap_ms": 0, "fade_ms": 2000, "duck": False},
+}
+DEFAULT_PRESET = "thirds"
+CACHE_FOLDER_NAME = ".clip_cache"
+STREAM_CHUNK_BYTES = 64 * 1024
+# source audio decoded per step while streaming into the encoder
+RENDER_BLOCK_MS = 30000
+ENVELOPE_FRAME_SAMPLES = 256
+# speeds a client may ask for, the atempo chain of speedster handles this range in at most three steps
+SPEED_RANGE = (0.5, 4.0)
+# timelines kept for (reciter, speed) pairs, the least recently used one is dropped first
+MAX_TIMELINES = 16
+
+
+def parse_speed(value: str) -> float:
+    """Parses the speed of a request, raises ValueError outside of SPEED_RANGE (NaN included)."""
+    speed = float(value)
+    if not SPEED_RANGE[0] <= speed <= SPEED_RANGE[1]:
+        raise ValueError(F"The speed must be between {SPEED_RANGE[0]} and {SPEED_RANGE[1]}, not {value}.")
+    return speed
+
+
+class ClipCache:
+    """Size bounded disk cache of rendered clips, evicting the least recently used files first."""
+
+    def __init__(self, cache_dir: Path, max_bytes: int):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        # oldest first; after a restart the access order is taken from the mtimes, which hits refresh
+        files = sorted((cache_file for cache_file in cache_dir.iterdir() if not cache_file.name.startswith("temp_")),
+                       key=lambda cache_file: cache_file.stat().st_mtime)
+        self.entries = OrderedDict((cache_file.name, cache_file.stat().st_size) for cache_file in files)
+        self.total_bytes = sum(self.entries.values())
+
+    def open(self, key: str) -> BinaryIO:
+        """
+        Opens the cached file of the key for reading and marks it as recently used, None on a miss.
+        The file is opened under the lock, so an eviction right after the lookup cannot remove it before it is sent.
+        """
+        with self.lock:
+            if key not in self.entries:
+                return None
+            cache_file = self.cache_dir / key
+            try:
+                f = open(cache_file, "rb")
+            except FileNotFoundError:  # removed behind the back of the cache
+                self.total_bytes -= self.entries.pop(key)
+                return None
+            self.entries.move_to_end(key)
+        try:
+            os.utime(cache_file)
+        except OSError:  # evicted meanwhile, the open file can still be read
+            pass
+        return f
+
+    def temp_path(self, key: str) -> Path:
+        return self.cache_dir / f"temp_{key}"
+
+    def put(self, key: str) -> None:
+        """Moves the finished temp file of the key into the cache and evicts old files beyond max_bytes."""
+        cache_file = self.cache_dir / key
+        os.replace(self.temp_path(key), cache_file)
+        with self.lock:
+            self.total_bytes -= self.entries.pop(key, 0)
+            self.entries[key] = cache_file.stat().st_size
+            self.total_bytes += self.entries[key]
+            while self.total_bytes > self.max_bytes and len(self.entries) > 1:
+                old_key, old_size = self.entries.popitem(last=False)
+                try:
+                    (self.cache_dir / old_key).unlink(missing_ok=True)
+                except OSError as e:  # still open for a client on Windows, the next start picks it up again
+                    logging.warning(f"Could not evict {old_key} from the clip cache: {e}")
+                self.total_bytes -= old_size
+
+
+class ClipService:
+    """
+    Renders clips on demand from the median folders: the frames of the requested range are decoded block by block (VirtualTimeline)
+    and streamed into one encoder, which applies the tempo and the clip envelope. The encoder output is streamed to the client
+    while it is written to the cache.
+    Concurrent requests for the same clip wait for the one render in flight instead of rendering it again.
+    """
+
+    def __init__(self, quran_data_folder: Path, cache_max_bytes: int = 2 * 1024**3):
+        self.quran_data_folder = quran_data_folder
+        self.cache = ClipCache(quran_data_folder / CACHE_FOLDER_NAME, cache_max_bytes)
+        self.lock = threading.Lock()
+        self.in_flight: Dict[str, threading.Event] = {}
+        self.timelines: "OrderedDict[Tuple[str, float], Tuple[int, VirtualTimeline]]" = OrderedDict()
+        self.metrics = {"requests": 0, "hits": 0, "misses": 0, "coalesced": 0, "errors": 0}
+        self.render_seconds = deque(maxlen=1000)
+
+    def get_timeline(self, reciter_name: str, speed: float) -> VirtualTimeline:
+        """Returns the timeline of the median files of a reciter, rebuilt when the median folder changes."""
+        # the name comes from the query string, only the reciter folders directly in the data folder may be served
+        data_folder = self.quran_data_folder.resolve()
+        reciter_folder = (data_folder / reciter_name).resolve()
+        if reciter_folder.parent != data_folder or not reciter_folder.is_dir():
+            raise FileNotFoundError(F"No reciter '{reciter_name}'.")
+        median_folder = find_median_folder(reciter_folder)
+        if not median_folder.exists():
+            raise FileNotFoundError(F"No median folder for reciter '{reciter_name}'.")
+        folder_mtime = median_folder.stat().st_mtime_ns
+        with self.lock:
+            cached = self.timelines.get((reciter_name, speed))
+            if cached is not None:
+                self.timelines.move_to_end((reciter_name, speed))
+        if cached is None or cached[0] != folder_mtime:
+            cached = (folder_mtime, VirtualTimeline(list_audio_files(median_folder), speed_change=speed))
+            with self.lock:
+                self.timelines[(reciter_name, speed)] = cached
+                self.timelines.move_to_end((reciter_name, speed))
+                while len(self.timelines) > MAX_TIMELINES:
+                    self.timelines.popitem(last=False)
+        return cached[1]
+
+    def resolve_range(self, timeline: VirtualTimeline, query: Dict[str, str], preset: Dict) -> Tuple[float, float]:
+        """
+        Turns the query into [start_ms, end_ms) on the timeline:
+            sura=N            -> the whole sura
+            sura=N&clip=K     -> clip K of the sura with the clip length and overlap of the preset
+            start_page=P&end_page=Q -> pages P to Q, estimated from the page count of the suras
+        """
+        if "sura" in query:
+            sura_num = int(query["sura"])
+            entry = next((entry for entry in timeline.entries if entry["sura"] == sura_num), None)
+            if entry is None:
+                raise FileNotFoundError(F"Sura {sura_num} is missing.")
+            sura_start_ms = entry["source_start_ms"] / timeline.speed_change
+            sura_ms = entry["source_duration_ms"] / timeline.speed_change
+            if "clip" not in query:
+                return sura_start_ms, sura_start_ms + sura_ms
+            clip_num = int(query["clip"])
+            for window_num, start_ms, end_ms in clip_windows(sura_ms, preset["clip_length_ms"], preset["overlap_ms"]):
+                if window_num == clip_num:
+                    return sura_start_ms + start_ms, sura_start_ms + end_ms
+            raise FileNotFoundError(F"Sura {sura_num} has no clip {clip_num}.")
+
+        # pages are placed proportionally inside the suras, like pace.load_sura_pages counts them
+        sura_pages = load_sura_pages()
+        sura_positions = np.concatenate(([0.0], np.cumsum(sura_pages)))
+        start_page, end_page = float(query["start_page"]), float(query["end_page"])
+        if not 1.0 <= start_page <= end_page <= sura_positions[-1]:
+            raise ValueError(F"The pages must satisfy 1 <= start_page <= end_page <= {sura_positions[-1]:g}.")
+
+        def page_ms(page_position: float) -> float:
+            for entry in timeline.entries:
+                sura_index = entry["sura"] - 1
+                if sura_positions[sura_index] <= page_position < sura_positions[sura_index + 1]:
+                    fraction = (page_position - sura_positions[sura_index]) / sura_pages[sura_index]
+                    return (entry["source_start_ms"] + fraction * entry["source_duration_ms"]) / timeline.speed_change
+            # the page lies in a sura the reciter does not have, use the next sura the reciter has
+            following = [entry for entry in timeline.entries if sura_positions[entry["sura"] - 1] >= page_position]
+            return (following[0]["source_start_ms"] if following else timeline.source_length_ms) / timeline.speed_change
+
+        start_ms, end_ms = page_ms(start_page - 1.0), page_ms(end_page)
+        if end_ms <= start_ms:
+            raise FileNotFoundError(F"No sura of pages {start_page:g} to {end_page:g} is available.")
+        return start_ms, end_ms
+
+    def clip_key(self, reciter_name: str, timeline: VirtualTimeline, start_ms: float, end_ms: float, fade_ms: int, duck: bool, profile: Dict) -> str:
+        """Cache key of a clip, including the median files it is cut from so regenerated medians are not served from the cache."""
+        sources = [(str(entry["path"]), entry["path"].stat().st_mtime_ns) for entry in timeline.entries
+                   if f"{entry['sura']:03d}" in timeline.sura_range(start_ms, end_ms)]
+        description = json.dumps([reciter_name, round(start_ms), round(end_ms), timeline.speed_change, fade_ms, duck, profile, sources])
+        return hashlib.sha1(description.encode()).hexdigest() + profile["extension"]
+
+    def render(self, key: str, timeline: VirtualTimeline, start_ms: float, end_ms: float, fade_ms: int, duck: bool, profile: Dict, write_chunk) -> None:
+        """
+        Renders the clip into the temp file of the cache, passing every encoded chunk to write_chunk as soon as it is ready.
+        The source blocks are fed to the encoder while they are decoded, the encoder changes the tempo, pads or trims the clip
+        to its length and applies the envelope of clip_envelope_regions.
+        """
+        from speedster import atempo_filter_chain  # imported here, speedster pulls in pandas like in timeline.py
+
+        started = time.time()
+        clip_ms = int(end_ms - start_ms)
+        blocks = timeline.iter_source_blocks(start_ms, end_ms, RENDER_BLOCK_MS)
+        # the first block gives the input format of the encoder
+        first_block = next(blocks, AudioSegment.empty())
+        frame_rate = first_block.frame_rate if len(first_block) > 0 else 44100
+        channels = first_block.channels if len(first_block) > 0 else 1
+        # the volume is evaluated per frame, small frames keep the steps of the fades inaudible like the per ms steps of pydub
+        audio_filter = (f"{atempo_filter_chain(timeline.speed_change)},apad,atrim=end={clip_ms / 1000.0:.3f},"
+                        f"asetnsamples=n={ENVELOPE_FRAME_SAMPLES}:p=0,"
+                        f"volume='{envelope_volume_expression(clip_envelope_regions(clip_ms, fade_ms, duck))}':eval=frame")
+        encoder = subprocess.Popen(
+            ['ffmpeg', '-v', 'error', '-f', 's16le', '-ar', str(frame_rate), '-ac', str(channels), '-i', 'pipe:0', '-af', audio_filter]
+            + ffmpeg_output_args(profile) + ['pipe:1'],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        feed_errors = []
+
+        def feed_encoder():
+            try:
+                encoder.stdin.write(first_block.set_sample_width(2).raw_data)
+                for block in blocks:
+                    encoder.stdin.write(block.set_sample_width(2).raw_data)
+            except BrokenPipeError:  # the encoder stopped reading, its exit code tells why
+                pass
+            except Exception as e:  # raised in render once the encoder output is read
+                feed_errors.append(e)
+            finally:
+                try:
+                    encoder.stdin.close()
+                except BrokenPipeError:
+                    pass
+
+        feeder = threading.Thread(target=feed_encoder, daemon=True)
+        feeder.start()
+        try:
+            with open(self.cache.temp_path(key), "wb") as temp_file:
+                while chunk := encoder.stdout.read(STREAM_CHUNK_BYTES):
+                    temp_file.write(chunk)
+                    write_chunk(chunk)
+            feeder.join()
+            if encoder.wait() != 0:
+                raise RuntimeError(F"The encoder failed with exit code {encoder.returncode}.")
+            if feed_errors:
+                # the encoder finished the audio it got, but the clip is incomplete
+                raise feed_errors[0]
+        except BaseException:
+            encoder.kill()
+            encoder.wait()
+            self.cache.temp_path(key).unlink(missing_ok=True)
+            raise
+        self.cache.put(key)
+        self.render_seconds.append(time.time() - started)
+
+    def metrics_report(self) -> Dict:
+        render_seconds = sorted(self.render_seconds)
+        lookups = self.metrics["hits"] + self.metrics["misses"] + self.metrics["coalesced"]
+        return dict(
+            self.metrics,
+            hit_rate=(self.metrics["hits"] + self.metrics["coalesced"]) / lookups if lookups else None,
+            renders=len(render_seconds),
+            render_seconds_mean=sum(render_seconds) / len(render_seconds) if render_seconds else None,
+            render_seconds_p50=render_seconds[len(render_seconds) // 2] if render_seconds else None,
+            render_seconds_p95=render_seconds[int(0.95 * (len(render_seconds) - 1))] if render_seconds else None,
+            cache_files=len(self.cache.entries),
+            cache_bytes=self.cache.total_bytes,
+        )
+
+
+class ClipRequestHandler(BaseHTTPRequestHandler):
+    """
+    GET /clip?reciter=NAME&sura=N[&clip=K][&speed=1.2][&preset=thirds][&profile=mp3_64k_mono]
+    GET /clip?reciter=NAME&start_page=P&end_page=Q[...]
+    GET /metrics
+    """
+    service: ClipService = None
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == "/metrics":
+            self.send_body(200, json.dumps(self.service.metrics_report(), indent=2).encode(), "application/json")
+        elif url.path == "/clip":
+            self.serve_clip({name: values[0] for name, values in parse_qs(url.query).items()})
+        else:
+            self.send_body(404, b"Unknown path, use /clip or /metrics", "text/plain")
+
+    def send_body(self, status: int, body: bytes, content_type: str) -> None:
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_audio_headers(self, profile: Dict, content_length: int = None) -> None:
+        self.send_response(200)
+        self.send_header("Content-Type", "audio/mpeg" if profile["format"] == "mp3" else f"audio/{profile['format']}")
+        if content_length is not None:
+            self.send_header("Content-Length", str(content_length))
+        self.end_headers()
+
+    def send_cached(self, cache_file: BinaryIO, profile: Dict) -> None:
+        with cache_file:
+            self.send_audio_headers(profile, os.fstat(cache_file.fileno()).st_size)
+            while chunk := cache_file.read(STREAM_CHUNK_BYTES):
+                self.wfile.write(chunk)
+
+    def serve_clip(self, query: Dict[str, str]) -> None:
+        service = self.service
+        with service.lock:
+            service.metrics["requests"] += 1
+        try:
+            preset_name = query.get("preset", DEFAULT_PRESET)
+            preset = CLIP_PRESETS[preset_name]
+            profile = get_profile(query.get("profile"))
+            timeline = service.get_timeline(query["reciter"], parse_speed(query.get("speed", "1.0")))
+            start_ms, end_ms = service.resolve_range(timeline, query, preset)
+            # only clips get the ducked middle, whole suras and page ranges only fade in and out
+            duck = preset["duck"] and "clip" in query
+            key = service.clip_key(query["reciter"], timeline, start_ms, end_ms, preset["fade_ms"], duck, profile)
+        except (KeyError, ValueError, FileNotFoundError) as e:
+            with service.lock:
+                service.metrics["errors"] += 1
+            self.send_body(400 if not isinstance(e, FileNotFoundError) else 404, str(e).encode(), "text/plain")
+            return
+
+        cache_file = service.cache.open(key)
+        if cache_file is not None:
+            with service.lock:
+                service.metrics["hits"] += 1
+            self.send_cached(cache_file, profile)
+            return
+
+        with service.lock:
+            render_done = service.in_flight.get(key)
+            # a render which finished since the lookup above is a hit
+            cache_file = service.cache.open(key) if render_done is None else None
+            is_renderer = render_done is None and cache_file is None
+            if is_renderer:
+                render_done = service.in_flight[key] = threading.Event()
+            service.metrics["hits" if cache_file is not None else "misses" if is_renderer else "coalesced"] += 1
+        if cache_file is not None:
+            self.send_cached(cache_file, profile)
+            return
+
+        if not is_renderer:
+            render_done.wait()
+            cache_file = service.cache.open(key)
+            if cache_file is None:
+                self.send_body(500, b"The render of this clip failed.", "text/plain")
+            else:
+                self.send_cached(cache_file, profile)
+            return
+
+        client = {"connected": True, "headers_sent": False}
+
+        def write_chunk(chunk: bytes) -> None:
+            # a client that went away does not stop the render, the clip still goes into the cache
+            if client["connected"]:
+                try:
+                    # the status line goes out with the first encoded chunk, so a render failing before it gets a 500
+                    if not client["headers_sent"]:
+                        client["headers_sent"] = True
+                        self.send_audio_headers(profile)
+                    self.wfile.write(chunk)
+                except (BrokenPipeError, ConnectionResetError):
+                    client["connected"] = False
+
+        render_error = None
+        try:
+            service.render(key, timeline, start_ms, end_ms, preset["fade_ms"], duck, profile, write_chunk)
+        except Exception as e:
+            logging.error(f"Error rendering {self.path}: {e}")
+            render_error = e
+            with service.lock:
+                service.metrics["errors"] += 1
+        finally:
+            # the waiting clients are released before this one is answered
+            with service.lock:
+                service.in_flight.pop(key, None)
+            render_done.set()
+
+        if render_error is None:
+            if not client["headers_sent"]:
+                self.send_audio_headers(profile, 0)
+        elif not client["headers_sent"]:
+            self.send_body(500, F"The render of this clip failed: {render_error}".encode(), "text/plain")
+        else:
+            # the 200 is out already, the early close of the connection is the only signal left
+            self.close_connection = True
+
+
+def serve_clips(quran_data_folder: Path, host: str = "127.0.0.1", port: int = 8765, cache_max_bytes: int = 2 * 1024**3) -> None:
+    """
+    Starts the local clip server over the median folders of the quran data folder, see ClipRequestHandler for the requests.
+
+    Args:
+        quran_data_folder (Path): Path to the main data folder containing reciter subfolders.
+        host (str): Address to listen on, only the local machine by default.
+        port (int): Port to listen on.
+        cache_max_bytes (int): Size limit of the rendered clip cache in the quran data folder.
+    """
+    ClipRequestHandler.service = ClipService(quran_data_folder, cache_max_bytes)
+    server = ThreadingHTTPServer((host, port), ClipRequestHandler)
+    print(F"Serving clips of {quran_data_folder} on http://{host}:{port}/clip, metrics on /metrics")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
@@ -0,0 +1,304 @@
+import io
+import subprocess
+import time
+from fractions import Fraction
+from pathlib import Path
+from typing import Dict, List
+
+from pydub import AudioSegment
+from pydub.utils import mediainfo
+
+from encode_profiles import bitrate_to_int, ffmpeg_output_args, get_profile, pydub_export_kwargs
+
+try:
+    import av  # optional in-process libav bindings (PyAV)
+except ImportError:
+    av = None
+
+
+# Every clip used to cost several process launches (pydub decode/export, ffmpeg runs, ffprobe via mediainfo).
+# A codec backend bundles probe, decode, encode and filtering behind one small interface, so the in-process
+# PyAV backend can replace the process spawning, while the subprocess backend stays as the fallback.
+
+
+class SubprocessBackend:
+    """Codec backend spawning ffmpeg/ffprobe processes, directly or through pydub."""
+    name = "subprocess"
+
+    def probe(self, file_path: Path) -> Dict:
+        """Returns "duration_s", "sample_rate", "channels" and "bit_rate" of an audio file."""
+        info = mediainfo(str(file_path))
+        return {
+            "duration_s": float(info['duration']),
+            "sample_rate": int(info.get('sample_rate', 0) or 0),
+            "channels": int(info.get('channels', 0) or 0),
+            "bit_rate": int(info.get('bit_rate', 0) or 0),
+        }
+
+    def decode(self, file_path: Path, start_ms: float = None, end_ms: float = None) -> AudioSegment:
+        """Decodes an audio file, or only the window [start_ms, end_ms) of it."""
+        if start_ms is None and end_ms is None:
+            return AudioSegment.from_file(file_path)
+        start_ms = start_ms or 0.0
+        duration_s = None if end_ms is None else (end_ms - start_ms) / 1000.0
+        return AudioSegment.from_file(file_path, start_second=start_ms / 1000.0, duration=duration_s)
+
+    def decode_bytes(self, data: bytes, audio_format: str) -> AudioSegment:
+        """Decodes an in-memory audio file, e.g. a run of mp3 frames."""
+        return AudioSegment.from_file(io.BytesIO(data), format=audio_format)
+
+    def encode(self, segment: AudioSegment, output_filep: Path, profile: Dict) -> None:
+        """Encodes the segment into output_filep with the encode profile."""
+        segment.export(output_filep, **pydub_export_kwargs(profile))
+
+    def encode_bytes(self, segment: AudioSegment, profile: Dict, extra_args: List[str] = None) -> bytes:
+        """Encodes the segment with the encode profile in memory, piping its raw samples through ffmpeg."""
+        segment = segment.set_sample_width(2)
+        result = subprocess.run([
+            'ffmpeg', '-f', 's16le', '-ar', str(segment.frame_rate), '-ac', str(segment.channels), '-i', 'pipe:0'
+        ] + ffmpeg_output_args(profile) + (extra_args or []) + ['pipe:1'],
+            input=segment.raw_data, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        return result.stdout
+
+    def transcode(self, input_filep: Path, output_filep: Path, profile: Dict, filter_chain: str = None, extra_args: List[str] = None) -> None:
+        """Re-encodes a file with the encode profile, optionally through an ffmpeg audio filter chain."""
+        filter_args = ['-filter:a', filter_chain] if filter_chain else []
+        subprocess.run(['ffmpeg', '-y', '-i', str(input_filep)] + filter_args + ffmpeg_output_args(profile) + (extra_args or []) + [str(output_filep)],
+                       check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+    def filter_segment(self, segment: AudioSegment, filter_chain: str) -> AudioSegment:
+        """Runs an in-memory segment through an ffmpeg audio filter chain by piping its raw samples."""
+        segment = segment.set_sample_width(2)
+        result = subprocess.run([
+            'ffmpeg', '-f', 's16le', '-ar', str(segment.frame_rate), '-ac', str(segment.channels), '-i', 'pipe:0',
+            '-filter:a', filter_chain, '-f', 's16le', 'pipe:1'
+        ], input=segment.raw_data, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        return AudioSegment(data=result.stdout, sample_width=2, frame_rate=segment.frame_rate, channels=segment.channels)
+
+
+def _layout_name(channels: int) -> str:
+    return "mono" if channels == 1 else "stereo"
+
+
+def _segment_to_frames(segment: AudioSegment, samples_per_frame: int = 4096):
+    """Yields the samples of the segment as packed s16 PyAV frames."""
+    segment = segment.set_sample_width(2)
+    bytes_per_sample = 2 * segment.channels
+    raw_data = segment.raw_data
+    for offset in range(0, len(raw_data), samples_per_frame * bytes_per_sample):
+        chunk = raw_data[offset:offset + samples_per_frame * bytes_per_sample]
+        frame = av.AudioFrame(format="s16", layout=_layout_name(segment.channels), samples=len(chunk) // bytes_per_sample)
+        frame.planes[0].update(chunk)
+        frame.sample_rate = segment.frame_rate
+        yield frame
+
+
+def _packed_bytes(frame, channels: int) -> bytes:
+    """Returns the samples of a packed s16 frame, without the alignment padding of the plane buffer."""
+    return bytes(frame.planes[0])[:frame.samples * channels * 2]
+
+
+class PyAVBackend(SubprocessBackend):
+    """In-process codec backend based on the libav bindings of PyAV. No ffmpeg or ffprobe process gets spawned."""
+    name = "pyav"
+
+    def __init__(self):
+        if av is None:
+            raise ImportError("The pyav codec backend needs the 'av' package (pip install av).")
+
+    def probe(self, file_path: Path) -> Dict:
+        with av.open(str(file_path)) as container:
+            stream = container.streams.audio[0]
+            if container.duration is not None:
+                duration_s = container.duration / av.time_base
+            else:
+                duration_s = float(stream.duration * stream.time_base)
+            return {
+                "duration_s": duration_s,
+                "sample_rate": stream.rate,
+                "channels": len(stream.layout.channels),
+                "bit_rate": stream.bit_rate or container.bit_rate or 0,
+            }
+
+    def _decode_container(self, container, start_ms: float = None, end_ms: float = None) -> AudioSegment:
+        stream = container.streams.audio[0]
+        channels = min(len(stream.layout.channels), 2)
+        resampler = av.AudioResampler(format="s16", layout=_layout_name(channels), rate=stream.rate)
+        if start_ms:
+            # every audio frame is a key frame, so the seek lands at most one frame before start_ms
+            container.seek(int(start_ms / 1000.0 / stream.time_base), stream=stream)
+
+        chunks = []
+        first_ms = None
+        num_samples = 0
+        for frame in container.decode(stream):
+            if first_ms is None:
+                first_ms = float(frame.pts * frame.time_base) * 1000.0 if frame.pts is not None else (start_ms or 0.0)
+            for out_frame in resampler.resample(frame):
+                chunks.append(_packed_bytes(out_frame, channels))
+                num_samples += out_frame.samples
+            if end_ms is not None and first_ms + 1000.0 * num_samples / stream.rate >= end_ms:
+                break
+        for out_frame in resampler.resample(None):
+            chunks.append(_packed_bytes(out_frame, channels))
+
+        segment = AudioSegment(data=b"".join(chunks), sample_width=2, frame_rate=stream.rate, channels=channels)
+        # sliced in samples, a millisecond slice of pydub would drop the samples after the last whole millisecond
+        offset = int(round(max(0.0, (start_ms or 0.0) - (first_ms or 0.0)) * stream.rate / 1000.0))
+        if end_ms is None:
+            return segment.get_sample_slice(offset, None)
+        return segment.get_sample_slice(offset, offset + int(round((end_ms - (start_ms or 0.0)) * stream.rate / 1000.0)))
+
+    def decode(self, file_path: Path, start_ms: float = None, end_ms: float = None) -> AudioSegment:
+        with av.open(str(file_path)) as container:
+            return self._decode_container(container, start_ms, end_ms)
+
+    def decode_bytes(self, data: bytes, audio_format: str) -> AudioSegment:
+        with av.open(io.BytesIO(data), format=audio_format) as container:
+            return self._decode_container(container)
+
+    def _add_output_stream(self, container, profile: Dict):
+        options = {"profile": profile["profile"]} if "profile" in profile else {}
+        stream = container.add_stream(profile["codec"], rate=profile["sample_rate"], options=options)
+        stream.layout = _layout_name(profile["channels"])
+        stream.bit_rate = bitrate_to_int(profile["bitrate"])
+        return stream
+
+    def encode(self, segment: AudioSegment, output_filep: Path, profile: Dict) -> None:
+        with av.open(str(output_filep), "w", format=profile["format"]) as container:
+            stream = self._add_output_stream(container, profile)
+            # the codec context resamples and re-frames to what the encoder needs
+            for frame in _segment_to_frames(segment):
+                container.mux(stream.encode(frame))
+            container.mux(stream.encode(None))
+
+    def _build_filter_graph(self, filter_chain: str, template=None, sample_rate: int = None, channels: int = None):
+        graph = av.filter.Graph()
+        if template is not None:
+            nodes = [graph.add_abuffer(template=template)]
+        else:
+            nodes = [graph.add_abuffer(format="s16", sample_rate=sample_rate, layout=_layout_name(channels), time_base=Fraction(1, sample_rate))]
+        for audio_filter in filter_chain.split(","):
+            filter_name, _, filter_args = audio_filter.partition("=")
+            nodes.append(graph.add(filter_name, filter_args or None))
+        nodes.append(graph.add("abuffersink"))
+        for upstream, downstream in zip(nodes, nodes[1:]):
+            upstream.link_to(downstream)
+        graph.configure()
+        return graph
+
+    def _pull_filtered(self, graph) -> List:
+        frames = []
+        while True:
+            try:
+                frames.append(graph.pull())
+            except (av.error.BlockingIOError, av.error.EOFError):
+                return frames
+
+    def transcode(self, input_filep: Path, output_filep: Path, profile: Dict, filter_chain: str = None, extra_args: List[str] = None) -> None:
+        if extra_args:
+            # extra ffmpeg command line arguments have no in-process equivalent
+            return super().transcode(input_filep, output_filep, profile, filter_chain, extra_args)
+        with av.open(str(input_filep)) as input_container, av.open(str(output_filep), "w", format=profile["format"]) as output_container:
+            input_stream = input_container.streams.audio[0]
+            output_stream = self._add_output_stream(output_container, profile)
+            graph = self._build_filter_graph(filter_chain, template=input_stream) if filter_chain else None
+            for frame in input_container.decode(input_stream):
+                frame.pts = None
+                if graph is None:
+                    output_container.mux(output_stream.encode(frame))
+                    continue
+                graph.push(frame)
+                for filtered_frame in self._pull_filtered(graph):
+                    filtered_frame.pts = None
+                    output_container.mux(output_stream.encode(filtered_frame))
+            if graph is not None:
+                graph.push(None)
+                for filtered_frame in self._pull_filtered(graph):
+                    filtered_frame.pts = None
+                    output_container.mux(output_stream.encode(filtered_frame))
+            output_container.mux(output_stream.encode(None))
+
+    def filter_segment(self, segment: AudioSegment, filter_chain: str) -> AudioSegment:
+        segment = segment.set_sample_width(2)
+        graph = self._build_filter_graph(filter_chain, sample_rate=segment.frame_rate, channels=segment.channels)
+        resampler = av.AudioResampler(format="s16", layout=_layout_name(segment.channels), rate=segment.frame_rate)
+        chunks = []
+        frames = list(_segment_to_frames(segment)) + [None]
+        for frame in frames:
+            graph.push(frame)
+            for filtered_frame in self._pull_filtered(graph):
+                for out_frame in resampler.resample(filtered_frame):
+                    chunks.append(_packed_bytes(out_frame, segment.channels))
+        return AudioSegment(data=b"".join(chunks), sample_width=2, frame_rate=segment.frame_rate, channels=segment.channels)
+
+
+CODEC_BACKENDS = {
+    "subprocess": SubprocessBackend,
+    "pyav": PyAVBackend,
+}
+
+_active_backend = None
+
+
+def set_codec_backend(backend_name: str = "auto") -> None:
+    """
+    Selects the codec backend used by file_io, speedster, json_gen, split_concat and range_extract.
+
+    Args:
+        backend_name (str): "pyav", "subprocess" or "auto" (pyav if the av package is installed, subprocess otherwise).
+    """
+    global _active_backend
+    if backend_name == "auto":
+        backend_name = "pyav" if av is not None else "subprocess"
+    if backend_name not in CODEC_BACKENDS:
+        raise ValueError(F"Unknown codec backend '{backend_name}'. Available backends: {list(CODEC_BACKENDS)}")
+    _active_backend = CODEC_BACKENDS[backend_name]()
+
+
+def get_codec_backend():
+    """Returns the selected codec backend, selecting "auto" on first use."""
+    if _active_backend is None:
+        set_codec_backend("auto")
+    return _active_backend
+
+
+def benchmark_backends(sample_filep: Path, output_dir: Path, clip_lengths_ms: List[int] = (1000, 60000), num_clips: int = 10) -> Dict[str, Dict]:
+    """
+    Measures the time per clip (probe + window decode + encode) for every available backend.
+    The 1 second clips mostly show the fixed per-clip overhead, the 1 minute clips the real clip cost.
+
+    Returns:
+        Dict[str, Dict]: Backend name mapped to the average milliseconds per clip for each clip length.
+    """
+    profile = get_profile()
+    output_dir.mkdir(parents=True, exist_ok=True)
+    results = {}
+    for backend_name, backend_class in CODEC_BACKENDS.items():
+        try:
+            backend = backend_class()
+        except ImportError as e:
+            print(f" - skipping {backend_name}: {e}")
+            continue
+        results[backend_name] = {}
+        for clip_length_ms in clip_lengths_ms:
+            started = time.perf_counter()
+            for clip_num in range(num_clips):
+                duration_ms = 1000.0 * backend.probe(sample_filep)["duration_s"]
+                start_ms = (clip_num * clip_length_ms) % max(1.0, duration_ms - clip_length_ms)
+                clip = backend.decode(sample_filep, start_ms, start_ms + clip_length_ms)
+                backend.encode(clip, output_dir / f"bench_{backend_name}_{clip_num:03d}{profile['extension']}", profile)
+            results[backend_name][clip_length_ms] = 1000.0 * (time.perf_counter() - started) / num_clips
+
+    print(" Codec backend benchmark (ms per clip) ".center(80, "="))
+    for backend_name, timings in results.items():
+        print(f"{backend_name:>12}: " + ", ".join(f"{clip_length_ms / 1000.0:g}s clips {ms:.1f} ms" for clip_length_ms, ms in timings.items()))
+    return results
+
+
+if __name__ == "__main__":
+    import sys
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        benchmark_backends(Path(sys.argv[1]), Path(tmp_dir))
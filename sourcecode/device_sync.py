@@ -0,0 +1,180 @@
+import hashlib
+import json
+import os
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+from tqdm import tqdm
+
+from encode_profiles import list_audio_files
+from utils import file_hash, write_file_atomically
+
+
+# The manifest lives on the device, so a drive synced from another machine or a yanked drive is still compared correctly.
+# For every synced file ("folder/file name") it stores size and mtime of the source file and the content hash.
+MANIFEST_NAME = ".clip_sync_manifest.json"
+PARTIAL_SUFFIX = ".partial"
+
+# Large reads and writes keep slow FAT media writing sequentially
+COPY_BUFFER_BYTES = 8 * 1024 * 1024
+DEFAULT_BATCH_BYTES = 256 * 1024 * 1024
+
+
+def load_device_manifest(target_dir: Path) -> Dict:
+    manifest_path = target_dir / MANIFEST_NAME
+    if not manifest_path.exists():
+        return {"files": {}}
+    with open(manifest_path) as f:
+        return json.load(f)
+
+
+def save_device_manifest(target_dir: Path, manifest: Dict) -> None:
+    """Replaces the manifest atomically, a drive yanked during the write keeps the previous manifest."""
+    write_file_atomically(target_dir / MANIFEST_NAME, json.dumps(manifest))
+
+
+def playlist_order(source_folders: List[Path]) -> List[Tuple[str, Path]]:
+    """
+    Returns all clips of the source folders in playlist order (folder by folder, clips sorted by sura and clip number)
+    as (path relative to the device, source file).
+    """
+    return [(f"{source_folder.name}/{source_file.name}", source_file)
+            for source_folder in sorted(source_folders) for source_file in list_audio_files(source_folder)]
+
+
+def copy_file(source_file: Path, target_file: Path) -> str:
+    """
+    Copies a file through a .partial file which is renamed once the content is flushed to the device.
+    Returns the content hash, calculated while copying.
+    """
+    target_file.parent.mkdir(parents=True, exist_ok=True)
+    partial_file = target_file.with_name(target_file.name + PARTIAL_SUFFIX)
+    digest = hashlib.blake2b(digest_size=16)
+    with open(source_file, "rb") as src, open(partial_file, "wb") as dst:
+        while chunk := src.read(COPY_BUFFER_BYTES):
+            digest.update(chunk)
+            dst.write(chunk)
+        dst.flush()
+        os.fsync(dst.fileno())
+    os.replace(partial_file, target_file)
+    return digest.hexdigest()
+
+
+def plan_device_sync(source_folders: List[Path], target_dir: Path, manifest: Dict, strict_order: bool = False) -> Tuple[List, List[str]]:
+    """
+    Compares the source clip folders with the manifest and the files on the device.
+    A file counts as unchanged if size and mtime of the source match the manifest and the device file has the right size.
+    Otherwise the hashes decide, so regenerated but identical clips and files copied right before a yanked drive are not copied again.
+    Only the folders of source_folders are touched: folders synced by earlier runs with other folders keep their files and manifest entries,
+    and a source folder which does not exist (e.g. not generated yet) is skipped instead of being emptied on the device.
+
+    Args:
+        strict_order (bool): Rewrite every changed folder completely, so the directory order on the device is the playlist order
+            even for players which play in write order and for FAT file systems which reuse the entries of deleted files.
+
+    Returns:
+        Tuple[List, List[str]]: The files to copy as (relative path, source file) in playlist order
+            and the relative paths to delete from the device.
+    """
+    files = manifest["files"]
+    missing_folders = [source_folder for source_folder in source_folders if not source_folder.is_dir()]
+    for source_folder in missing_folders:
+        print(f" - Skipping {source_folder.name}, the folder does not exist")
+    source_folders = [source_folder for source_folder in source_folders if source_folder not in missing_folders]
+    synced_folder_names = {source_folder.name for source_folder in source_folders}
+    order = playlist_order(source_folders)
+    to_copy = []
+    changed_folders = set()
+    for rel_path, source_file in order:
+        stat = source_file.stat()
+        entry = files.get(rel_path)
+        target_file = target_dir / rel_path
+        target_size = target_file.stat().st_size if target_file.exists() else None
+        if entry and entry["size"] == stat.st_size and entry["mtime_ns"] == stat.st_mtime_ns and target_size == stat.st_size:
+            continue
+        if target_size == stat.st_size:
+            source_hash = file_hash(source_file)
+            if (entry and entry["hash"] == source_hash) or file_hash(target_file) == source_hash:
+                files[rel_path] = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "hash": source_hash}
+                continue
+        to_copy.append((rel_path, source_file))
+        changed_folders.add(rel_path.split("/")[0])
+
+    # stale files: synced before but no longer generated, or not tracked at all inside a synced folder
+    source_paths = {rel_path for rel_path, _ in order}
+    device_paths = {rel_path for rel_path in files if rel_path.split("/")[0] in synced_folder_names}
+    for source_folder in source_folders:
+        target_folder = target_dir / source_folder.name
+        if target_folder.exists():
+            device_paths.update(f"{source_folder.name}/{target_file.name}" for target_file in target_folder.iterdir()
+                                if target_file.is_file() and not target_file.name.endswith(PARTIAL_SUFFIX))
+    to_delete = sorted(device_paths - source_paths)
+    changed_folders.update(rel_path.split("/")[0] for rel_path in to_delete)
+
+    if strict_order:
+        to_delete = sorted(set(to_delete) | {rel_path for rel_path in device_paths & source_paths if rel_path.split("/")[0] in changed_folders})
+        to_copy = [(rel_path, source_file) for rel_path, source_file in order if rel_path.split("/")[0] in changed_folders]
+    return to_copy, to_delete
+
+
+def sync_clip_folders(
+        source_folders: List[Path],
+        target_dir: Path,
+        batch_bytes: int = DEFAULT_BATCH_BYTES,
+        strict_order: bool = False,
+        dry_run: bool = False) -> Dict[str, int]:
+    """
+    Mirrors the clip folders onto a mounted device (phone, USB stick, SD card), each into a subfolder of target_dir with the same name.
+    Only new or changed clips are copied, in playlist order, and clips which are no longer generated are deleted.
+    The manifest is updated after every batch_bytes of copied data, so after a yanked drive the next sync continues where it stopped.
+
+    Args:
+        source_folders (List[Path]): The clip folders to sync, e.g. the "thirds_clips ..." folders of the reciters.
+        target_dir (Path): The directory on the mounted device.
+        batch_bytes (int): Amount of copied data after which the manifest is written.
+        strict_order (bool): See plan_device_sync.
+        dry_run (bool): Only print what would be copied and deleted.
+
+    Returns:
+        Dict[str, int]: Number of "copied" and "deleted" files and "copied_bytes".
+    """
+    target_dir.mkdir(parents=True, exist_ok=True)
+    # leftovers of copies interrupted by a yanked drive
+    for partial_file in target_dir.rglob("*" + PARTIAL_SUFFIX):
+        if not dry_run:
+            partial_file.unlink()
+
+    manifest = load_device_manifest(target_dir)
+    to_copy, to_delete = plan_device_sync(source_folders, target_dir, manifest, strict_order)
+    total_bytes = sum(source_file.stat().st_size for _, source_file in to_copy)
+    print(f"Syncing to {target_dir}: {len(to_copy)} files to copy ({total_bytes / 1024**2:.0f} MB), {len(to_delete)} files to delete")
+    if dry_run:
+        for rel_path in to_delete:
+            print(f" - delete {rel_path}")
+        for rel_path, _ in to_copy:
+            print(f" + copy {rel_path}")
+        return {"copied": 0, "deleted": 0, "copied_bytes": 0}
+
+    # deleting first frees the space the new clips need
+    for rel_path in to_delete:
+        target_file = target_dir / rel_path
+        if target_file.exists():
+            target_file.unlink()
+        manifest["files"].pop(rel_path, None)
+    save_device_manifest(target_dir, manifest)
+
+    copied_bytes = 0
+    batch_copied_bytes = 0
+    with tqdm(total=total_bytes, desc="Copying clips", unit="B", unit_scale=True) as progress:
+        for rel_path, source_file in to_copy:
+            stat = source_file.stat()
+            source_hash = copy_file(source_file, target_dir / rel_path)
+            manifest["files"][rel_path] = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "hash": source_hash}
+            copied_bytes += stat.st_size
+            batch_copied_bytes += stat.st_size
+            progress.update(stat.st_size)
+            if batch_copied_bytes >= batch_bytes:
+                save_device_manifest(target_dir, manifest)
+                batch_copied_bytes = 0
+    save_device_manifest(target_dir, manifest)
+    return {"copied": len(to_copy), "deleted": len(to_delete), "copied_bytes": copied_bytes}
@@ -0,0 +1,142 @@
+from pathlib import Path
+from typing import Dict, List
+
+
+# Named output profiles. Each profile describes everything needed to write one audio file:
+#   codec/bitrate/sample_rate/channels -> the ffmpeg encoder settings
+#   format      -> the ffmpeg/pydub container name
+#   extension   -> the filename suffix of files written with this profile
+#   tagging     -> which tag system mutagen has to use for the container ("id3", "vorbis", "mp4")
+ENCODE_PROFILES: Dict[str, Dict] = {
+    # The historic default: what every encode used before profiles existed
+    "mp3_128k": {
+        "codec": "libmp3lame",
+        "bitrate": "128k",
+        "sample_rate": 44100,
+        "channels": 2,
+        "format": "mp3",
+        "extension": ".mp3",
+        "tagging": "id3",
+    },
+    # Speech optimized mp3, plays on every car stereo and usb stick player
+    "mp3_64k_mono": {
+        "codec": "libmp3lame",
+        "bitrate": "64k",
+        "sample_rate": 22050,
+        "channels": 1,
+        "format": "mp3",
+        "extension": ".mp3",
+        "tagging": "id3",
+    },
+    # Opus only supports 8/12/16/24/48 kHz, 32k mono is transparent for recitation
+    "opus_32k": {
+        "codec": "libopus",
+        "bitrate": "32k",
+        "sample_rate": 48000,
+        "channels": 1,
+        "format": "opus",
+        "extension": ".opus",
+        "tagging": "vorbis",
+    },
+    # HE-AAC needs an ffmpeg build with libfdk_aac, the native aac encoder has no HE profile
+    "aac_he_48k": {
+        "codec": "libfdk_aac",
+        "profile": "aac_he",
+        "bitrate": "48k",
+        "sample_rate": 44100,
+        "channels": 2,
+        "format": "ipod",
+        "extension": ".m4a",
+        "tagging": "mp4",
+    },
+}
+
+DEFAULT_PROFILE = "mp3_128k"
+
+# all extensions any profile can produce, used when globbing for generated audio files
+AUDIO_EXTENSIONS = sorted({profile["extension"] for profile in ENCODE_PROFILES.values()})
+
+
+def get_profile(profile_name: str = None) -> Dict:
+    """
+    Returns the encode profile with the given name.
+
+    Args:
+        profile_name (str): Name of the profile in ENCODE_PROFILES. None returns the default profile.
+
+    Returns:
+        Dict: The profile settings.
+    """
+    if profile_name is None:
+        profile_name = DEFAULT_PROFILE
+    if profile_name not in ENCODE_PROFILES:
+        raise ValueError(F"Unknown encode profile '{profile_name}'. Available profiles: {list(ENCODE_PROFILES)}")
+    return ENCODE_PROFILES[profile_name]
+
+
+def bitrate_to_int(bitrate: str) -> int:
+    """Turns "128k" into 128000."""
+    return int(float(bitrate[:-1]) * 1000) if bitrate.endswith("k") else int(bitrate)
+
+
+def matches_profile(file_path: Path, info: Dict, profile: Dict) -> bool:
+    """
+    Returns whether an audio file already is what the profile would encode, so it can be copied or remuxed instead.
+
+    Args:
+        file_path (Path): The audio file.
+        info (Dict): The probe result of the file, see codec.SubprocessBackend.probe.
+        profile (Dict): The encode profile.
+
+    Returns:
+        bool: True if the container, sample rate, channels and bitrate (within 2%, VBR files average around it) match.
+    """
+    bitrate = bitrate_to_int(profile["bitrate"])
+    return (file_path.suffix == profile["extension"]
+            and info["sample_rate"] == profile["sample_rate"]
+            and info["channels"] == profile["channels"]
+            and abs(info["bit_rate"] - bitrate) <= 0.02 * bitrate)
+
+
+def ffmpeg_output_args(profile: Dict) -> List[str]:
+    """
+    Returns the ffmpeg command line arguments which encode the output with the given profile.
+    The arguments also force the container, so temporary files with other suffixes get written correctly.
+    """
+    args = ['-c:a', profile["codec"]]
+    if "profile" in profile:
+        args += ['-profile:a', profile["profile"]]
+    args += [
+        '-b:a', profile["bitrate"],
+        '-ar', str(profile["sample_rate"]),
+        '-ac', str(profile["channels"]),
+        '-f', profile["format"],
+    ]
+    return args
+
+
+def pydub_export_kwargs(profile: Dict) -> Dict:
+    """Returns the keyword arguments for AudioSegment.export to encode with the given profile."""
+    parameters = ['-ar', str(profile["sample_rate"]), '-ac', str(profile["channels"])]
+    if "profile" in profile:
+        parameters += ['-profile:a', profile["profile"]]
+    return {
+        "format": profile["format"],
+        "codec": profile["codec"],
+        "bitrate": profile["bitrate"],
+        "parameters": parameters,
+    }
+
+
+def with_profile_extension(file_path: Path, profile: Dict) -> Path:
+    """Returns the file path with the suffix replaced by the extension of the profile."""
+    return file_path.with_suffix(profile["extension"])
+
+
+def list_audio_files(folder: Path) -> List[Path]:
+    """
+    Returns all audio files in the folder which could have been written by any of the profiles, sorted by name.
+    Unfinished temp_ files are left out.
+    """
+    return sorted(file_path for file_path in folder.iterdir()
+                  if file_path.is_file() and file_path.suffix in AUDIO_EXTENSIONS and not file_path.name.startswith("temp_"))
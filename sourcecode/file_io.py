@@ -1,12 +1,14 @@
-import ffmpeg
 from pydub import AudioSegment
 import logging
 import os
 from pathlib import Path
-from typing import Dict
+from typing import Dict, Union
 
-from processflow import postprocess_clip, postprocess_file
+from codec import get_codec_backend
+from encode_profiles import get_profile
+from processflow import apply_clip_envelope, postprocess_clip, postprocess_file
 from split_concat import get_sura_range
+from timeline import VirtualTimeline
 from utils import load_quran_numbers
 
 
@@ -24,7 +26,9 @@ def save_clips_no_concat(audio: AudioSegment,
     fade_ms: int, 
     metadata: Dict[str, str], 
     speedup_factor:float,
-    clip_folder_prefix: str) -> None:
+    clip_folder_prefix: str,
+    profile: Dict = None,
+    duck: bool = True) -> None:
     """
     Saves audio clips of a specified length with overlapping intervals from a combined audio segment.
 
@@ -37,52 +41,73 @@ def save_clips_no_concat(audio: AudioSegment,
         input_dir (Path): Directory where the sura MP3 files are located.
         fade_ms (int): The duration of the fade in and fade out effect in milliseconds.
         metadata (Dict[str, str]): A dictionary containing metadata parameters.
+        profile (Dict): The encode profile of the clips, None for the default profile.
+        duck (bool): Whether the middle of the clips is faded out and in again like postprocess_clip does.
 
     Returns:
         None
     """
-    start = 0
-    clip_num = 1
+    if profile is None:
+        profile = get_profile()
 
-    while start < len(audio):
-        end = start + clip_length_ms
+    for clip_num, start, end in clip_windows(len(audio), clip_length_ms, overlap_ms):
         audio_clip = audio[start:end]
-        audio_clip = postprocess_clip(audio_clip, fade_ms / 1000.0)
-
-        reciter_str = "REC-" + reciter_name.replace(' ', '-')
-        sura_str = f"SUR{sura_num:03d}"
-        speedup_factor_str = f"SPD{speedup_factor:.2f}"
-        clip_str = f"CLP{clip_num:03d}-{clip_folder_prefix.replace('_', '')}"
+        audio_clip = apply_clip_envelope(audio_clip, fade_ms, duck)
 
-        filename = "_".join([reciter_str, sura_str, speedup_factor_str, clip_str]) + ".mp3"
+        filename = clip_filename(reciter_name, sura_num, speedup_factor, clip_num, clip_folder_prefix, profile["extension"])
         # results in REC-Abdel-Fattah_SUR001_SPD1.00_CLP001.mp3
 
+        output_path = output_dir / filename
+        # tagged under a temp_ name and renamed at the end, so a partial clip is never visible
         temp_path = output_dir / f"temp_{filename}"
+        get_codec_backend().encode(audio_clip, temp_path, profile)
+
+        metadata = clip_metadata(metadata, reciter_name, sura_num, speedup_factor, clip_num, clip_folder_prefix)
+        postprocess_file(temp_path, metadata, profile["tagging"])
+        os.replace(temp_path, output_path)
 
-        audio_clip.export(temp_path, format="mp3")
-        output_path = output_dir / filename
-        ffmpeg.input(str(temp_path)).output(str(output_path), codec='mp3', audio_bitrate='128k').run(overwrite_output=True)
-        os.remove(temp_path)
-
-        if metadata is None:
-            metadata = {}
-        metadata["album"] = f"Speed {speedup_factor:.2f}x"
-        metadata["artist"] = reciter_name
-        metadata["genre"] = "Quran" + " " + clip_folder_prefix.replace('_', '')
-        sura_name = NUM_TO_SURA[sura_num]
-        metadata["title"] = f"{sura_name} - C{clip_num:03d} S{speedup_factor:.2f}"
-        postprocess_file(output_path, metadata)
 
+def clip_windows(total_ms: float, clip_length_ms: float, overlap_ms: float):
+    """
+    Yields (clip_num, start_ms, end_ms) for the overlapping clips of an audio of total_ms length. The last clip may be shorter.
+    """
+    start = 0
+    clip_num = 1
+    while start < total_ms:
+        end = start + clip_length_ms
+        yield clip_num, start, min(end, total_ms)
         start = end - overlap_ms
         clip_num += 1
 
 
-def save_clips(audio: AudioSegment, clip_length_ms: int, overlap_ms: int, output_dir: Path, sura_start_times: Dict[str, int], input_dir: Path, fade_duration: int, metadata: Dict[str, str], speedup_factor:float) -> None:
+def clip_filename(reciter_name: str, sura_num: int, speedup_factor: float, clip_num: int, clip_folder_prefix: str, extension: str) -> str:
+    """Returns the file name of a clip, e.g. REC-Abdel-Fattah_SUR001_SPD1.00_CLP001-thirds.mp3"""
+    reciter_str = "REC-" + reciter_name.replace(' ', '-')
+    sura_str = f"SUR{sura_num:03d}"
+    speedup_factor_str = f"SPD{speedup_factor:.2f}"
+    clip_str = f"CLP{clip_num:03d}-{clip_folder_prefix.replace('_', '')}"
+    return "_".join([reciter_str, sura_str, speedup_factor_str, clip_str]) + extension
+
+
+def clip_metadata(metadata: Dict[str, str], reciter_name: str, sura_num: int, speedup_factor: float, clip_num: int, clip_folder_prefix: str) -> Dict[str, str]:
+    """Fills the album, artist, genre and title tags of a clip into the metadata dict (a new dict if metadata is None)."""
+    if metadata is None:
+        metadata = {}
+    metadata["album"] = f"Speed {speedup_factor:.2f}x"
+    metadata["artist"] = reciter_name
+    metadata["genre"] = "Quran" + " " + clip_folder_prefix.replace('_', '')
+    sura_name = NUM_TO_SURA[sura_num]
+    metadata["title"] = f"{sura_name} - C{clip_num:03d} S{speedup_factor:.2f}"
+    return metadata
+
+
+def save_clips(audio: Union[AudioSegment, VirtualTimeline], clip_length_ms: int, overlap_ms: int, output_dir: Path, sura_start_times: Dict[str, int], input_dir: Path, fade_duration: int, metadata: Dict[str, str], speedup_factor:float, profile: Dict = None) -> None:
     """
     Saves audio clips of a specified length with overlapping intervals from a combined audio segment.
+    With a VirtualTimeline (see split_concat.build_virtual_timeline) each clip is rendered lazily and no combined audio exists.
 
     Args:
-        audio (AudioSegment): The combined audio segment.
+        audio (Union[AudioSegment, VirtualTimeline]): The combined audio segment or the virtual timeline of the suras.
         clip_length_ms (int): Length of each clip in milliseconds.
         overlap_ms (int): Overlap between consecutive clips in milliseconds.
         output_dir (Path): Directory where the output clips will be saved.
@@ -90,10 +115,13 @@ def save_clips(audio: AudioSegment, clip_length_ms: int, overlap_ms: int, output
         input_dir (Path): Directory where the sura MP3 files are located.
         fade_duration (int): The duration of the fade in and fade out effect in milliseconds.
         metadata (Dict[str, str]): A dictionary containing metadata parameters.
+        profile (Dict): The encode profile of the clips, None for the default profile.
 
     Returns:
         None
     """
+    if profile is None:
+        profile = get_profile()
     start = 0
     clip_num = 1
 
@@ -101,17 +129,17 @@ def save_clips(audio: AudioSegment, clip_length_ms: int, overlap_ms: int, output
         end = start + clip_length_ms
         clip = audio[start:end]
         clip = postprocess_clip(clip, fade_duration / 1000.0)
-        sura_range = get_sura_range(start, end, sura_start_times, input_dir, speedup_factor)
+        if isinstance(audio, VirtualTimeline):
+            sura_range = audio.sura_range(start, end)
+        else:
+            sura_range = get_sura_range(start, end, sura_start_times, input_dir, speedup_factor)
         sura_range_str = "_".join(sura_range) if len(sura_range) > 1 else sura_range[0]
-        filename = f"sura_{sura_range_str}_c{clip_num:03d}.mp3"
-        temp_path = output_dir / f"temp_{filename}"
+        filename = f"sura_{sura_range_str}_c{clip_num:03d}" + profile["extension"]
 
         try:
-            clip.export(temp_path, format="mp3")
             output_path = output_dir / filename
-            ffmpeg.input(str(temp_path)).output(str(output_path), codec='mp3', audio_bitrate='128k').run(overwrite_output=True)
-            os.remove(temp_path)
-            postprocess_file(output_path, metadata)
+            get_codec_backend().encode(clip, output_path, profile)
+            postprocess_file(output_path, metadata, profile["tagging"])
         except Exception as e:
             logging.error(f"Error exporting clip {filename}: {e}")
 
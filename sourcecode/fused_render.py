@@ -0,0 +1,157 @@
+import logging
+import os
+import subprocess
+import tempfile
+from pathlib import Path
+from typing import Dict, List
+
+from tqdm import tqdm
+
+from encode_profiles import ffmpeg_output_args, get_profile, list_audio_files
+from file_io import clip_filename, clip_metadata, clip_windows
+from processflow import clip_envelope_regions, envelope_volume_expression, postprocess_file
+from range_extract import get_duration_ms
+from speedster import atempo_filter_chain
+from utils import clip_folder_name
+
+
+def build_clip_filter_graph(speed_change: float, windows: List, fade_ms: int, duck: bool = True) -> str:
+    """
+    Builds one ffmpeg filter graph which changes the tempo of the whole input once and splits it into all clips.
+    Every clip branch trims its window, restarts its timestamps and applies the fade/duck envelope of postprocess_clip.
+
+    Args:
+        speed_change (float): Tempo factor from the fixed file to the clips.
+        windows (List): (clip_num, start_ms, end_ms) of every clip on the sped up timeline, see file_io.clip_windows.
+        fade_ms (int): The duration of the fade in and fade out effect in milliseconds.
+        duck (bool): Whether the middle of the clips is faded out and in again.
+
+    Returns:
+        str: The filter graph, its outputs are labeled [c1], [c2], ... by clip number.
+    """
+    split_labels = "".join(f"[s{clip_num}]" for clip_num, _, _ in windows)
+    lines = [f"[0:a]{atempo_filter_chain(speed_change)},asplit=outputs={len(windows)}{split_labels}"]
+    for clip_num, start_ms, end_ms in windows:
+        envelope = envelope_volume_expression(clip_envelope_regions(int(end_ms - start_ms), fade_ms, duck))
+        lines.append(
+            f"[s{clip_num}]atrim=start={start_ms / 1000.0:.3f}:end={end_ms / 1000.0:.3f},asetpts=PTS-STARTPTS,"
+            f"volume='{envelope}':eval=frame[c{clip_num}]"
+        )
+    return ";\n".join(lines)
+
+
+def render_clips_from_fixed(
+        fixed_filep: Path,
+        output_dir: Path,
+        reciter_name: str,
+        speed_change: float,
+        speedup_factor: float,
+        clip_length_ms: int,
+        overlap_ms: int,
+        fade_ms: int,
+        metadata: Dict[str, str],
+        clip_folder_prefix: str,
+        profile: Dict = None,
+        duck: bool = True) -> None:
+    """
+    Renders all clips of one sura directly from its fixed file with a single ffmpeg run:
+    one decode, one tempo change and one encode per clip, no median file in between.
+
+    Args:
+        fixed_filep (Path): The fixed file of the sura.
+        output_dir (Path): Directory where the clips will be saved.
+        reciter_name (str): Name of the reciter, used for file names and tags.
+        speed_change (float): Tempo factor from the fixed file to the clips (median factor times speedup_factor).
+        speedup_factor (float): Speed written into the file names and tags, the median based clips always carry 1.0.
+        clip_length_ms (int): Length of each clip in milliseconds.
+        overlap_ms (int): Overlap between consecutive clips in milliseconds.
+        fade_ms (int): The duration of the fade in and fade out effect in milliseconds.
+        metadata (Dict[str, str]): A dictionary containing metadata parameters.
+        clip_folder_prefix (str): Prefix of the clip preset, e.g. "thirds_".
+        profile (Dict): The encode profile of the clips, None for the default profile.
+        duck (bool): Whether the middle of the clips is faded out and in again like postprocess_clip does.
+    """
+    if profile is None:
+        profile = get_profile()
+    sura_num = int(fixed_filep.stem.split("_")[0])
+    total_ms = get_duration_ms(fixed_filep) / speed_change
+    windows = list(clip_windows(total_ms, clip_length_ms, overlap_ms))
+    if not windows:
+        return
+
+    output_args = []
+    temp_paths = {}
+    for clip_num, _, _ in windows:
+        filename = clip_filename(reciter_name, sura_num, speedup_factor, clip_num, clip_folder_prefix, profile["extension"])
+        temp_paths[clip_num] = output_dir / f"temp_{filename}"
+        output_args += ['-map', f"[c{clip_num}]"] + ffmpeg_output_args(profile) + [str(temp_paths[clip_num])]
+
+    # long suras have hundreds of branches, the graph goes through a script file instead of the command line
+    with tempfile.NamedTemporaryFile("w", suffix=".ffgraph", delete=False) as graph_file:
+        graph_file.write(build_clip_filter_graph(speed_change, windows, int(fade_ms), duck))
+    try:
+        subprocess.run(['ffmpeg', '-y', '-i', str(fixed_filep), '-filter_complex_script', graph_file.name] + output_args,
+                       check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except subprocess.CalledProcessError as e:
+        logging.error(f"Error rendering the clips of {reciter_name}/{fixed_filep.name}:\n{e.stderr.decode(errors='ignore')[-2000:]}")
+        for temp_path in temp_paths.values():
+            if temp_path.exists():
+                temp_path.unlink()
+        return
+    finally:
+        os.remove(graph_file.name)
+
+    for clip_num, temp_path in temp_paths.items():
+        clip_tags = clip_metadata(dict(metadata) if metadata else None, reciter_name, sura_num, speedup_factor, clip_num, clip_folder_prefix)
+        postprocess_file(temp_path, clip_tags, profile["tagging"])
+        os.replace(temp_path, temp_path.with_name(temp_path.name[len("temp_"):]))
+
+
+def render_all_fixed_files_to_clips(
+        rec_folders: List[Path],
+        rec_med_speedup: Dict[str, float],
+        clip_length_ms: int,
+        overlap_ms: int,
+        fade_duration: int,
+        speedup_factor: float,
+        metadata: dict,
+        clip_folder_prefix: str,
+        clip_profile: str = None,
+        duck: bool = True) -> None:
+    """
+    Fused counterpart of create_median_length_tracks + split_all_median_files_to_clips.
+    Writes the clips of every reciter at speedup_factor times the median speed straight from the fixed files, so trying a new
+    speed costs one decode per sura and needs no median folder. The clips land in the same folders with the same names and tags
+    as the median flow at that speed (median tracks at speedup_factor times the median speed, then split_all_median_files_to_clips):
+    the speed is only part of the folder name, the clip names and tags carry speed 1.00 like all median based clips.
+
+    Args:
+        rec_folders (List[Path]): The reciter folders.
+        rec_med_speedup (Dict[str, float]): Speedup factor of every reciter to reach the median, see json_gen.compute_median_speedups.
+        speedup_factor (float): Additional speed on top of the median speed.
+        See split_all_median_files_to_clips for the other arguments.
+    """
+    profile = get_profile(clip_profile)
+    for rec_folder in rec_folders:
+        fixed_folder = rec_folder / "fixed"
+        if not fixed_folder.exists():
+            continue
+        reciter_name = rec_folder.name
+        output_dir = rec_folder / clip_folder_name(reciter_name, speedup_factor, clip_folder_prefix)
+        output_dir.mkdir(exist_ok=True)
+        speed_change = rec_med_speedup[reciter_name] * speedup_factor
+        for fixed_filep in tqdm(list_audio_files(fixed_folder), desc=f"Rendering clips of {reciter_name}", unit="sura"):
+            render_clips_from_fixed(
+                fixed_filep=fixed_filep,
+                output_dir=output_dir,
+                reciter_name=reciter_name,
+                speed_change=speed_change,
+                speedup_factor=1.0,
+                clip_length_ms=clip_length_ms,
+                overlap_ms=overlap_ms,
+                fade_ms=fade_duration,
+                metadata=metadata,
+                clip_folder_prefix=clip_folder_prefix,
+                profile=profile,
+                duck=duck,
+            )
@@ -0,0 +1,411 @@
+import hashlib
+import json
+import logging
+import os
+import random
+import socket
+import threading
+import time
+import traceback
+import uuid
+from pathlib import Path
+from typing import Callable, Dict, List
+
+from encode_profiles import get_profile, list_audio_files
+from utils import clip_folder_name, find_median_folder, split_median_file_to_clips, write_file_atomically
+
+
+# The queue lives inside the shared quran data folder, so every machine mounting it (NFS/SMB) sees the same jobs.
+# A job is claimed by exclusively creating its .lease file, which carries a random token of the claim.
+# An expired lease is taken over by exclusively creating a .takeover file named after its token, so only one worker
+# can replace it; os.link is not needed, which SMB and FAT shares do not support. Finished jobs get a .done marker and
+# jobs which raised an error get a .failed marker with the traceback and the number of attempts.
+# A failed job is retried until it failed max_attempts times, after failed_expiry_seconds the failures are forgotten.
+# The job ids contain a hash of the job parameters, so a run with another speed, profile or clip preset gets new jobs.
+# reset_queue removes the markers, e.g. to force a rerun after replacing the input files.
+QUEUE_FOLDER_NAME = ".jobs"
+LEASE_SUFFIX = ".lease"
+TAKEOVER_SUFFIX = ".takeover"
+DONE_SUFFIX = ".done"
+FAILED_SUFFIX = ".failed"
+
+DEFAULT_LEASE_SECONDS = 300
+DEFAULT_MAX_ATTEMPTS = 3
+DEFAULT_FAILED_EXPIRY_SECONDS = 24 * 3600
+
+
+def default_worker_id() -> str:
+    """Returns a worker id which is unique across the machines sharing the folder."""
+    return f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+
+
+def params_hash(params: Dict) -> str:
+    """Returns a short hash of the job parameters, independent of the order of the keys."""
+    return hashlib.blake2b(json.dumps(params, sort_keys=True, default=str).encode(), digest_size=4).hexdigest()
+
+
+def job_id(stage: str, reciter_name: str, sura_num: int, params: Dict = None) -> str:
+    """
+    Returns the id of a (reciter, sura, stage) job, which is also the file name of its markers.
+    The hash of params (speed, encode profile, clip preset...) is appended, so changed settings never match old markers.
+    """
+    base_id = f"{stage}__{reciter_name.replace(' ', '-')}__{sura_num:03d}"
+    if params is None:
+        return base_id
+    return f"{base_id}__{params_hash(params)}"
+
+
+def lease_is_expired(lease_path: Path, lease_seconds: float) -> bool:
+    """A lease expires if its worker did not touch it for lease_seconds (the mtime is the heartbeat)."""
+    try:
+        return time.time() - lease_path.stat().st_mtime > lease_seconds
+    except FileNotFoundError:
+        return False
+
+
+def read_lease(lease_path: Path) -> Dict:
+    """Returns the content of a lease, an empty dict if it is gone or still being written."""
+    try:
+        with open(lease_path) as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+def new_lease(worker_id: str) -> Dict:
+    return {"worker": worker_id, "token": uuid.uuid4().hex, "claimed_at": time.time()}
+
+
+def take_over_stale_lease(lease_path: Path, worker_id: str, lease_seconds: float) -> str:
+    """
+    Takes over an expired lease in one atomic step: the worker which exclusively creates the takeover file named after
+    the token of the stale lease may replace the lease. Afterwards the lease is read back to check that it carries the new token.
+    A takeover file left behind by a worker dying in between is removed once it is older than lease_seconds.
+
+    Returns:
+        str: The token of the new lease, None if another worker got the job or the lease turned out to be alive.
+    """
+    stale_lease = read_lease(lease_path)
+    stale_token = stale_lease.get("token", "unknown")
+    takeover_path = lease_path.with_name(lease_path.name + f"{TAKEOVER_SUFFIX}-{stale_token}")
+    try:
+        fd = os.open(takeover_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        if lease_is_expired(takeover_path, lease_seconds):
+            takeover_path.unlink(missing_ok=True)
+        return None
+    lease = new_lease(worker_id)
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump({"worker": worker_id, "token": lease["token"]}, f)
+        # the lease may have been released or refreshed since it was found expired
+        if read_lease(lease_path).get("token", "unknown") != stale_token or not lease_is_expired(lease_path, lease_seconds):
+            return None
+        write_file_atomically(lease_path, json.dumps(lease))
+        if read_lease(lease_path).get("token") != lease["token"]:
+            return None
+    finally:
+        takeover_path.unlink(missing_ok=True)
+    print(f" - [{worker_id}] took over the expired lease {lease_path.name} of {stale_lease.get('worker', 'an unknown worker')}")
+    return lease["token"]
+
+
+def failed_attempts(queue_dir: Path, job: str, failed_expiry_seconds: float = DEFAULT_FAILED_EXPIRY_SECONDS) -> int:
+    """Returns how often the job failed, 0 if it never failed or its .failed marker is older than failed_expiry_seconds."""
+    failed_path = queue_dir / (job + FAILED_SUFFIX)
+    try:
+        if time.time() - failed_path.stat().st_mtime > failed_expiry_seconds:
+            return 0
+        with open(failed_path) as f:
+            return int(json.load(f)["attempts"])
+    except FileNotFoundError:
+        return 0
+
+
+def job_is_closed(
+        queue_dir: Path,
+        job: str,
+        max_attempts: int = DEFAULT_MAX_ATTEMPTS,
+        failed_expiry_seconds: float = DEFAULT_FAILED_EXPIRY_SECONDS) -> bool:
+    """A job is closed if it is done or failed max_attempts times within failed_expiry_seconds."""
+    if (queue_dir / (job + DONE_SUFFIX)).exists():
+        return True
+    return failed_attempts(queue_dir, job, failed_expiry_seconds) >= max_attempts
+
+
+def reset_queue(queue_dir: Path, stage: str = None, failed_only: bool = False) -> int:
+    """
+    Removes the .done and .failed markers of the queue, so the jobs run again. Leases of running jobs are kept.
+
+    Args:
+        queue_dir (Path): The shared queue folder.
+        stage (str): Only reset the jobs of this stage (the start of the job id, e.g. "median"), all stages if None.
+        failed_only (bool): Only reset failed jobs, e.g. after fixing the cause of the errors.
+
+    Returns:
+        int: The number of removed markers.
+    """
+    suffixes = [FAILED_SUFFIX] if failed_only else [DONE_SUFFIX, FAILED_SUFFIX]
+    num_removed = 0
+    for suffix in suffixes:
+        for marker_path in queue_dir.glob(f"{stage + '__' if stage else ''}*{suffix}"):
+            marker_path.unlink(missing_ok=True)
+            num_removed += 1
+    print(f" - Reset {num_removed} job markers in {queue_dir}")
+    return num_removed
+
+
+def try_claim(
+        queue_dir: Path,
+        job: str,
+        worker_id: str,
+        lease_seconds: float,
+        max_attempts: int = DEFAULT_MAX_ATTEMPTS,
+        failed_expiry_seconds: float = DEFAULT_FAILED_EXPIRY_SECONDS) -> str:
+    """
+    Tries to claim the job by exclusively creating its lease file, or by taking over its expired lease.
+
+    Returns:
+        str: The token of the lease if this worker now owns the job, None otherwise.
+    """
+    if job_is_closed(queue_dir, job, max_attempts, failed_expiry_seconds):
+        return None
+    lease_path = queue_dir / (job + LEASE_SUFFIX)
+    try:
+        fd = os.open(lease_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        if not lease_is_expired(lease_path, lease_seconds):
+            return None
+        token = take_over_stale_lease(lease_path, worker_id, lease_seconds)
+    else:
+        lease = new_lease(worker_id)
+        with os.fdopen(fd, "w") as f:
+            json.dump(lease, f)
+        token = lease["token"]
+    if token is None:
+        return None
+    # a worker may have finished the job between the first check and the claim
+    if job_is_closed(queue_dir, job, max_attempts, failed_expiry_seconds):
+        release_lease(lease_path, token)
+        return None
+    return token
+
+
+def release_lease(lease_path: Path, token: str) -> None:
+    """Removes the lease, unless another worker took it over meanwhile."""
+    if read_lease(lease_path).get("token") == token:
+        lease_path.unlink(missing_ok=True)
+
+
+def heartbeat(lease_path: Path, token: str, interval_seconds: float, stop_event: threading.Event) -> None:
+    """Touches the lease regularly while the job runs, so other workers do not consider it expired."""
+    while not stop_event.wait(interval_seconds):
+        if read_lease(lease_path).get("token") != token:
+            logging.warning(f"Lease {lease_path.name} was taken away, the job may run twice.")
+            return
+        try:
+            os.utime(lease_path)
+        except FileNotFoundError:
+            logging.warning(f"Lease {lease_path.name} was taken away, the job may run twice.")
+            return
+
+
+def run_claimed_job(
+        queue_dir: Path,
+        job: Dict,
+        handler: Callable[[Dict], None],
+        worker_id: str,
+        lease_seconds: float,
+        failed_expiry_seconds: float = DEFAULT_FAILED_EXPIRY_SECONDS,
+        token: str = None) -> None:
+    """Runs a claimed job with a heartbeat and marks it as done or failed, counting the failed attempts."""
+    lease_path = queue_dir / (job["id"] + LEASE_SUFFIX)
+    if token is None:
+        token = read_lease(lease_path).get("token")
+    stop_event = threading.Event()
+    heartbeat_thread = threading.Thread(target=heartbeat, args=(lease_path, token, lease_seconds / 3.0, stop_event), daemon=True)
+    heartbeat_thread.start()
+    try:
+        print(f" - [{worker_id}] running {job['id']}")
+        handler(job)
+        write_file_atomically(queue_dir / (job["id"] + DONE_SUFFIX), json.dumps({"worker": worker_id, "finished_at": time.time()}))
+        (queue_dir / (job["id"] + FAILED_SUFFIX)).unlink(missing_ok=True)
+    except Exception as e:
+        attempts = failed_attempts(queue_dir, job["id"], failed_expiry_seconds) + 1
+        logging.error(f"Job {job['id']} failed on {worker_id} (attempt {attempts}): {e}")
+        write_file_atomically(queue_dir / (job["id"] + FAILED_SUFFIX), json.dumps(
+            {"worker": worker_id, "failed_at": time.time(), "attempts": attempts, "traceback": traceback.format_exc()}))
+    finally:
+        stop_event.set()
+        heartbeat_thread.join()
+        release_lease(lease_path, token)
+
+
+def run_worker(
+        queue_dir: Path,
+        jobs: List[Dict],
+        handler: Callable[[Dict], None],
+        worker_id: str = None,
+        lease_seconds: float = DEFAULT_LEASE_SECONDS,
+        poll_seconds: float = 5.0,
+        max_attempts: int = DEFAULT_MAX_ATTEMPTS,
+        failed_expiry_seconds: float = DEFAULT_FAILED_EXPIRY_SECONDS) -> int:
+    """
+    Claims and runs jobs from the shared queue until every job is done or failed max_attempts times.
+    Several workers on several machines can run this on the same queue_dir at the same time.
+
+    Args:
+        queue_dir (Path): The shared queue folder.
+        jobs (List[Dict]): All jobs of the stage, each with a unique "id". Every worker has to get the same list.
+        handler (Callable): Function running a single job. It has to publish its outputs atomically.
+        worker_id (str): Unique id of this worker, generated if None.
+        lease_seconds (float): Time without heartbeat after which a lease of a dead worker gets broken.
+        poll_seconds (float): Wait time when all remaining jobs are leased by other workers.
+        max_attempts (int): Number of failed runs after which a job is given up.
+        failed_expiry_seconds (float): Age after which the failures of a job are forgotten and it is retried.
+
+    Returns:
+        int: The number of jobs this worker ran.
+    """
+    if worker_id is None:
+        worker_id = default_worker_id()
+    queue_dir.mkdir(parents=True, exist_ok=True)
+    num_ran = 0
+
+    while True:
+        open_jobs = [job for job in jobs if not job_is_closed(queue_dir, job["id"], max_attempts, failed_expiry_seconds)]
+        if not open_jobs:
+            break
+        # start at a random job so the workers do not all compete for the same lease
+        start = random.randrange(len(open_jobs))
+        claimed_any = False
+        for job in open_jobs[start:] + open_jobs[:start]:
+            token = try_claim(queue_dir, job["id"], worker_id, lease_seconds, max_attempts, failed_expiry_seconds)
+            if token is not None:
+                claimed_any = True
+                run_claimed_job(queue_dir, job, handler, worker_id, lease_seconds, failed_expiry_seconds, token)
+                num_ran += 1
+        if not claimed_any:
+            # the remaining jobs are leased by other workers, wait until they finish or their leases expire
+            time.sleep(poll_seconds)
+
+    print(f" - [{worker_id}] no open jobs left, ran {num_ran} jobs")
+    return num_ran
+
+
+def median_jobs(rec_folders: List[Path], rec_med_speedup: Dict[str, float], intermediate_profile: str = None) -> List[Dict]:
+    """Returns one median job per fixed file of every reciter."""
+    jobs = []
+    for rec_folder in rec_folders:
+        fixed_folder = rec_folder / "fixed"
+        if not fixed_folder.exists():
+            continue
+        for fixed_filep in list_audio_files(fixed_folder):
+            sura_num = int(fixed_filep.stem.split("_")[0])
+            params = {"speed_change": rec_med_speedup[rec_folder.name], "profile": get_profile(intermediate_profile)}
+            jobs.append({
+                "id": job_id("median", rec_folder.name, sura_num, params),
+                "stage": "median",
+                "fixed_filep": str(fixed_filep),
+                "median_folder": str(rec_folder / "median"),
+                "speed_change": rec_med_speedup[rec_folder.name],
+                "profile": intermediate_profile,
+            })
+    return jobs
+
+
+def clip_jobs(
+        rec_folders: List[Path],
+        clip_length_ms: int,
+        overlap_ms: int,
+        fade_duration: int,
+        speedup_factor: float,
+        metadata: dict,
+        clip_folder_prefix: str,
+        clip_profile: str = None) -> List[Dict]:
+    """Returns one clip job per median file of every reciter, see utils.split_all_median_files_to_clips for the arguments."""
+    jobs = []
+    for rec_folder in rec_folders:
+        median_folder = find_median_folder(rec_folder)
+        if not median_folder.exists():
+            continue
+        output_dir = rec_folder / clip_folder_name(rec_folder.name, speedup_factor, clip_folder_prefix)
+        for median_file in list_audio_files(median_folder):
+            sura_num = int(median_file.stem.split("_")[0])
+            # the mtime of the median file gives regenerated medians (e.g. with a new speed) new clip jobs
+            params = {"clip_length_ms": clip_length_ms, "overlap_ms": overlap_ms, "fade_duration": fade_duration,
+                      "speedup_factor": speedup_factor, "metadata": metadata, "profile": get_profile(clip_profile),
+                      "median_mtime_ns": median_file.stat().st_mtime_ns}
+            jobs.append({
+                "id": job_id(clip_folder_prefix + "clips", rec_folder.name, sura_num, params),
+                "stage": "clips",
+                "median_file": str(median_file),
+                "output_dir": str(output_dir),
+                "reciter_name": rec_folder.name,
+                "clip_length_ms": clip_length_ms,
+                "overlap_ms": overlap_ms,
+                "fade_duration": fade_duration,
+                "metadata": metadata,
+                "clip_folder_prefix": clip_folder_prefix,
+                "profile": clip_profile,
+            })
+    return jobs
+
+
+def run_audio_job(job: Dict) -> None:
+    """Handler for the median and clips jobs. Both stages publish their files with an atomic rename."""
+    from speedster import create_median_track  # imported here, speedster pulls in pandas
+    if job["stage"] == "median":
+        median_folder = Path(job["median_folder"])
+        median_folder.mkdir(exist_ok=True)
+        create_median_track(Path(job["fixed_filep"]), median_folder, job["speed_change"], get_profile(job["profile"]))
+    elif job["stage"] == "clips":
+        output_dir = Path(job["output_dir"])
+        output_dir.mkdir(exist_ok=True)
+        split_median_file_to_clips(
+            median_file=Path(job["median_file"]),
+            output_dir=output_dir,
+            reciter_name=job["reciter_name"],
+            clip_length_ms=job["clip_length_ms"],
+            overlap_ms=job["overlap_ms"],
+            fade_duration=job["fade_duration"],
+            metadata=dict(job["metadata"]) if job["metadata"] is not None else None,
+            clip_folder_prefix=job["clip_folder_prefix"],
+            clip_profile=job["profile"],
+        )
+    else:
+        raise ValueError(F"Unknown job stage '{job['stage']}'.")
+
+
+def _demo_job(job: Dict) -> None:
+    """Job of the local demo: waits a bit and publishes a small output file."""
+    time.sleep(random.uniform(0.05, 0.2))
+    output_path = Path(job["output_dir"]) / (job["id"] + ".txt")
+    write_file_atomically(output_path, job["id"])
+
+
+if __name__ == "__main__":
+    # Local check of the queue: several worker processes share one temp folder, every job has to run exactly once.
+    import multiprocessing
+    import tempfile
+
+    NUM_WORKERS = 4
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        demo_queue_dir = Path(tmp_dir) / QUEUE_FOLDER_NAME
+        demo_output_dir = Path(tmp_dir) / "outputs"
+        demo_output_dir.mkdir()
+        demo_jobs = [{"id": job_id("demo", f"Reciter {r}", sura), "output_dir": str(demo_output_dir)}
+                     for r in range(3) for sura in range(1, 21)]
+
+        workers = [multiprocessing.Process(target=run_worker, args=(demo_queue_dir, demo_jobs, _demo_job),
+                                           kwargs={"worker_id": f"worker{i}", "lease_seconds": 5.0, "poll_seconds": 0.1})
+                   for i in range(NUM_WORKERS)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+        outputs = sorted(demo_output_dir.iterdir())
+        print(f"{len(outputs)} outputs for {len(demo_jobs)} jobs, "
+              f"{len(list(demo_queue_dir.glob('*' + DONE_SUFFIX)))} done markers, "
+              f"{len(list(demo_queue_dir.glob('*' + LEASE_SUFFIX)))} leases left")
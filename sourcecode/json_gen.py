@@ -2,16 +2,20 @@ import os
 import shutil
 import subprocess
 import csv
-from typing import List
+import statistics
+from typing import Dict, List, Tuple
 from tqdm import tqdm
 import pandas as pd
 import json
 from pathlib import Path
-from pydub.utils import mediainfo
 import gc
 from mutagen.mp3 import MP3
 from mutagen.easyid3 import EasyID3
-from utils import load_quran_numbers, set_mp3_title
+from codec import get_codec_backend
+from encode_profiles import get_profile, matches_profile
+from mp3_frames import count_mp3_frames
+from proxies import proxy_duration_s
+from utils import load_quran_numbers, tag_audio_file
 
 print("json_gen.py")
 
@@ -22,9 +26,10 @@ script_dir = Path(__file__).parent  # Get the directory of the current script
 csv_path = script_dir / "quran_numbers.csv"
 NUM_TO_SURA = load_quran_numbers(csv_path)
 
-def load_folder_dfs(quran_data_folder: Path, rec_folders: List[Path]):
+def load_folder_dfs(quran_data_folder: Path, rec_folders: List[Path], intermediate_profile: str = None, repair_mode: str = "remux"):
     """
     Loads the ORIG_JSON_NAME dataframes for all reciters. It also creates missing json files.
+    Missing fixed files are created with the repair_mode and the intermediate_profile (None for the default profile).
     Returns sura_stat_df, rec_sura_df
     """
     print(F"\nStarting load folder dfs")
@@ -42,7 +47,7 @@ def load_folder_dfs(quran_data_folder: Path, rec_folders: List[Path]):
             except:
                 print(f" - {ORIG_JSON_NAME} was not found")
                 rec_folder = orig_metadata_json_path.parent
-                create_folder_df(rec_folder)
+                create_folder_df(rec_folder, intermediate_profile, repair_mode)
                 fixed_dfs.append(pd.read_json(orig_metadata_json_path, lines=True))
 
         combined_df = pd.concat(fixed_dfs, ignore_index=True)
@@ -73,23 +78,14 @@ def load_folder_dfs(quran_data_folder: Path, rec_folders: List[Path]):
 
     rec_sura_df.to_json(quran_data_folder / "rec_sura_df.json", orient='records', lines=True)
 
-    # Filter to only keep suras where all reciters have an entry
-    sura_counts = rec_sura_df['trk_num'].value_counts()
-    common_suras = sura_counts[sura_counts == len(rec_folders)].index
-    rec_sura_df = rec_sura_df[rec_sura_df['trk_num'].isin(common_suras)]
-    print(F"\nFiltered dataset to only include suras present for all reciters. Remaining suras: {len(common_suras)}")
-    print(F" - those suras are: {common_suras}")
-
-    print(F"\nCalculating sum of sura lengths per reciter for common suras.")
-    reciter_sums = rec_sura_df.groupby('artist')['len'].sum().to_dict()
-    print(F"Sum of sura lengths per reciter for the common suras: {reciter_sums}")
+    reciter_sums, rec_sura_df, common_suras = common_sura_sums(rec_sura_df, len(rec_folders))
     
     rec_sura_df.to_json(quran_data_folder / "filtered_rec_sura_df.json", orient='records', lines=True)
     with open(quran_data_folder / "reciter_sura_sums.json", "w") as f:
         json.dump(reciter_sums, f, indent=2)
 
     # Memory optimization - only after all variables are used
-    del combined_df, rec_sura_df, sura_counts
+    del combined_df, rec_sura_df
     gc.collect()
     
     sura_stat_df = "not calculated because of logical issues"
@@ -107,75 +103,61 @@ def load_folder_dfs(quran_data_folder: Path, rec_folders: List[Path]):
         
     return reciter_sums
 
-def create_folder_df(rec_folder: Path):
+def common_sura_sums(rec_sura_df: pd.DataFrame, num_reciters: int):
+    """
+    Filters the dataframe to the suras which all reciters have and sums the sura lengths per reciter over those common suras.
+    Returns reciter_sums, filtered rec_sura_df, common_suras
+    """
+    # Filter to only keep suras where all reciters have an entry
+    sura_counts = rec_sura_df['trk_num'].value_counts()
+    common_suras = sura_counts[sura_counts == num_reciters].index
+    rec_sura_df = rec_sura_df[rec_sura_df['trk_num'].isin(common_suras)]
+    print(F"\nFiltered dataset to only include suras present for all reciters. Remaining suras: {len(common_suras)}")
+    print(F" - those suras are: {common_suras}")
+
+    print(F"\nCalculating sum of sura lengths per reciter for common suras.")
+    reciter_sums = rec_sura_df.groupby('artist')['len'].sum().to_dict()
+    print(F"Sum of sura lengths per reciter for the common suras: {reciter_sums}")
+    return reciter_sums, rec_sura_df, common_suras
+
+
+def compute_median_speedups(reciter_sums_dict: Dict[str, float]) -> Dict[str, float]:
+    """
+    Calculates for each reciter the speedup factor which brings the reciter to the median sum of sura lengths.
+    """
+    median_reciter = statistics.median(reciter_sums_dict.values())
+    print("")
+    print(F"Median of all reciters: {median_reciter}")
+    rec_med_speedup = {}
+    for reciter, reciter_sum in reciter_sums_dict.items():
+        rec_med_speedup[reciter] = reciter_sum/median_reciter
+        print(F"Speedup factor for {reciter} to reach median: {rec_med_speedup[reciter]}")
+    return rec_med_speedup
+
+
+def create_folder_df(rec_folder: Path, intermediate_profile: str = None, repair_mode: str = "remux"):
     """
     Creates a dataframe which for each fixed original mp3 file contains ['artist', 'sura', 'len', 'file', 'trk_num', 'sample_rate', 'bit_rate',
-       'genre', 'parent_folder'].
+       'genre', 'parent_folder', 'fix_method'].
+    The fixed files are encoded with the intermediate_profile (None for the default profile).
+    With repair_mode "remux" only the header of the originals is rebuilt where possible, see correct_mp3_file.
     """
     tracks_metadata = []
+    profile = get_profile(intermediate_profile)
 
     sura_fileps = sorted([sura_filep for sura_filep in rec_folder.iterdir() if sura_filep.is_file() and sura_filep.suffix == ".mp3"])
 
-    def correct_mp3_file(sura_filep: Path):
-        """ Fixes the file-error where some mp3 files have a header where the length is corrupt. Saves the fixed files with _fixed as a suffix in separate folder. """
-
-        fixed_folder = sura_filep.parent / "fixed"
-        if sura_filep.name.find("_") == -1: # if the file does not contain "_" which signifies any suffix, so it is the original file
-            tmp_fixed_path = sura_filep.with_suffix('.fixedtmp.mp3') 
-            fixed_sura_filep = fixed_folder / (sura_filep.stem + "_fixed" + ".mp3")
-            
-            if tmp_fixed_path.exists(): # Remove tmp_fixed_path if it exists
-                os.remove(tmp_fixed_path)
-    
-            if not fixed_sura_filep.exists():
-                print(f"\n - Fixing {sura_filep.name} from {sura_filep.parent.stem}.")
-                subprocess.run(['ffmpeg', '-i', str(sura_filep), '-ar', '44100', '-c:a', 'mp3', '-b:a', '128k', str(tmp_fixed_path)], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-                shutil.move(tmp_fixed_path, fixed_sura_filep)
-                
-                # Set the track title using sura name from CSV
-                sura_id = int(sura_filep.stem[:3])
-                sura_name = NUM_TO_SURA.get(sura_id, f"Sura {sura_id:03d}")
-                set_mp3_title(fixed_sura_filep, sura_name)
-            else:
-                pass
-            return fixed_sura_filep
-
-        else:
-            raise ValueError(F"File {sura_filep.name} was given as input to be fixed, but it is not an original mp3 file.")
-
-    def get_track_length(sura_filep: Path):
-        """Gets the corrected file length."""
-        fixed_sura_filep = correct_mp3_file(sura_filep)
-        track_info = mediainfo(fixed_sura_filep)
-        track_length = float(track_info['duration'])/60.0
-        return track_length
-
     print(F" - reading the metadata for all mp3s")
     fixed_folder = rec_folder / "fixed"
     os.makedirs(fixed_folder, exist_ok=True)
     for sura_filep in tqdm(sura_fileps, desc="Reading metadata and fixing mp3s", unit="sura"):
         if sura_filep.is_file() and sura_filep.suffix == ".mp3":
-            track_info = mediainfo(sura_filep)
-            track_length = get_track_length(sura_filep)
-            track_number = sura_filep.stem[:3]
-            parent_folder = rec_folder.name
-            sura_ID = sura_filep.stem[:3]
-
-            track_md = {
-                'artist': rec_folder.name,
-                'sura': NUM_TO_SURA[int(sura_ID)],
-                'len': track_length,
-                'file': str(sura_filep.relative_to(rec_folder)),
-                'trk_num': track_number,
-                'sample_rate': track_info['sample_rate'],
-                'bit_rate': track_info['bit_rate'],
-                'genre': "Quran",
-                'parent_folder': parent_folder,
-            }
-            tracks_metadata.append(track_md)
+            tracks_metadata.append(build_track_metadata(rec_folder, sura_filep, profile, repair_mode))
 
     rec_metadata_df = pd.DataFrame(tracks_metadata)
     print(rec_metadata_df)
+    if not rec_metadata_df.empty:
+        print(F" - repair paths of the fixed files: {rec_metadata_df['fix_method'].value_counts().to_dict()}")
 
     # Save the dataframe as a JSON file in the input directory
     json_output_path = rec_folder / ORIG_JSON_NAME
@@ -185,3 +167,147 @@ def create_folder_df(rec_folder: Path):
     # Memory optimization
     del tracks_metadata, rec_metadata_df
     gc.collect()
+
+
+def update_folder_df(rec_folder: Path, sura_fileps: List[Path], removed_files: List[str], intermediate_profile: str = None, repair_mode: str = "remux"):
+    """
+    Updates the ORIG_JSON_NAME dataframe of a reciter for single original files instead of re-reading the whole folder.
+    The rows of sura_fileps are (re)built with build_track_metadata, the rows of removed_files (names relative to rec_folder) are dropped.
+    """
+    profile = get_profile(intermediate_profile)
+    json_path = rec_folder / ORIG_JSON_NAME
+    if json_path.exists():
+        rec_metadata_df = pd.read_json(json_path, lines=True, dtype={'trk_num': str})
+    else:
+        rec_metadata_df = pd.DataFrame()
+
+    updated_files = [str(sura_filep.relative_to(rec_folder)) for sura_filep in sura_fileps]
+    if not rec_metadata_df.empty:
+        rec_metadata_df = rec_metadata_df[~rec_metadata_df['file'].isin(updated_files + list(removed_files))]
+
+    os.makedirs(rec_folder / "fixed", exist_ok=True)
+    tracks_metadata = [build_track_metadata(rec_folder, sura_filep, profile, repair_mode)
+                       for sura_filep in tqdm(sura_fileps, desc=f"Fixing new mp3s of {rec_folder.name}", unit="sura")]
+    rec_metadata_df = pd.concat([rec_metadata_df, pd.DataFrame(tracks_metadata)], ignore_index=True)
+    if not rec_metadata_df.empty:
+        rec_metadata_df = rec_metadata_df.sort_values('file')
+
+    rec_metadata_df.to_json(json_path, orient='records', lines=True)
+    print(F" - {ORIG_JSON_NAME} of {rec_folder.name} updated: {len(sura_fileps)} files added, {len(removed_files)} removed")
+
+
+def build_track_metadata(rec_folder: Path, sura_filep: Path, profile: Dict, repair_mode: str = "remux") -> Dict:
+    """
+    Fixes a single original mp3 file and returns its row for the ORIG_JSON_NAME dataframe.
+    """
+    track_info = get_codec_backend().probe(sura_filep)
+    # Gets the corrected file length and the repair path the fixed file took.
+    # The length is the decoded length of the analysis proxy, which gets written here once for all later analysis passes.
+    fixed_sura_filep, fix_method = correct_mp3_file(sura_filep, profile, repair_mode)
+    track_length = proxy_duration_s(fixed_sura_filep)/60.0
+    track_number = sura_filep.stem[:3]
+    parent_folder = rec_folder.name
+    sura_ID = sura_filep.stem[:3]
+
+    return {
+        'artist': rec_folder.name,
+        'sura': NUM_TO_SURA[int(sura_ID)],
+        'len': track_length,
+        'file': str(sura_filep.relative_to(rec_folder)),
+        'trk_num': track_number,
+        'sample_rate': track_info['sample_rate'],
+        'bit_rate': track_info['bit_rate'],
+        'genre': "Quran",
+        'parent_folder': parent_folder,
+        'fix_method': fix_method,
+    }
+
+
+def remux_mp3_header(sura_filep: Path, tmp_fixed_path: Path) -> bool:
+    """
+    Copies the mp3 frames of the original without re-encoding, so ffmpeg writes a fresh Xing/LAME header.
+    The remux only counts as successful if it kept every frame of the original and the duration in the new header
+    matches the duration given by the frame count of the original.
+
+    Returns:
+        bool: True if tmp_fixed_path now contains a repaired file.
+    """
+    result = subprocess.run(['ffmpeg', '-y', '-i', str(sura_filep), '-map', '0:a:0', '-c:a', 'copy', '-write_xing', '1', '-f', 'mp3', str(tmp_fixed_path)],
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if result.returncode != 0 or not tmp_fixed_path.exists():
+        return False
+    try:
+        header_duration = MP3(str(tmp_fixed_path)).info.length
+        num_frames, frames_duration = count_mp3_frames(sura_filep)
+        num_remuxed_frames, _ = count_mp3_frames(tmp_fixed_path)
+    except Exception as e:
+        print(f"   Remux check failed for {sura_filep.name}: {e}")
+        return False
+    if num_frames == 0 or num_remuxed_frames != num_frames:
+        print(f"   Remux wrote {num_remuxed_frames} frames but the original has {num_frames}.")
+        return False
+    # allow half a second or 0.2% of deviation for encoder delay and padding
+    tolerance = max(0.5, 0.002 * frames_duration)
+    if abs(header_duration - frames_duration) > tolerance:
+        print(f"   Remuxed header says {header_duration:.1f}s but the {num_frames} frames of the original last {frames_duration:.1f}s.")
+        return False
+    return True
+
+
+def correct_mp3_file(sura_filep: Path, profile: Dict = None, repair_mode: str = "remux") -> Tuple[Path, str]:
+    """
+    Fixes the file-error where some mp3 files have a header where the length is corrupt. Saves the fixed files with _fixed as a suffix in separate folder.
+
+    Args:
+        sura_filep (Path): The original mp3 file of a sura.
+        profile (Dict): The encode profile for transcoded fixed files, None for the default profile.
+        repair_mode (str): "remux" first tries to only rebuild the header by a stream-copy and transcodes the files where this fails.
+                           "transcode" always re-encodes with the profile. Remuxing is only possible if the original already has
+                           the format, sample rate, channels and bitrate of the profile (see encode_profiles.matches_profile).
+
+    Returns:
+        Tuple[Path, str]: The fixed file and the path it took: "remux", "transcode" or "existing".
+        If the transcode fails, its error is raised and no fixed file is written.
+    """
+    if profile is None:
+        profile = get_profile()
+    if repair_mode not in ("remux", "transcode"):
+        raise ValueError(F"Unknown repair mode '{repair_mode}'.")
+
+    fixed_folder = sura_filep.parent / "fixed"
+    if sura_filep.name.find("_") != -1: # if the file contains "_" which signifies any suffix, it is not the original file
+        raise ValueError(F"File {sura_filep.name} was given as input to be fixed, but it is not an original mp3 file.")
+
+    tmp_fixed_path = sura_filep.with_suffix('.fixedtmp' + profile["extension"]) 
+    fixed_sura_filep = fixed_folder / (sura_filep.stem + "_fixed" + profile["extension"])
+    
+    if tmp_fixed_path.exists(): # Remove tmp_fixed_path if it exists
+        os.remove(tmp_fixed_path)
+
+    if fixed_sura_filep.exists():
+        return fixed_sura_filep, "existing"
+
+    print(f"\n - Fixing {sura_filep.name} from {sura_filep.parent.stem}.")
+    fix_method = "transcode"
+    can_remux = repair_mode == "remux" and matches_profile(sura_filep, get_codec_backend().probe(sura_filep), profile)
+    if can_remux and remux_mp3_header(sura_filep, tmp_fixed_path):
+        fix_method = "remux"
+    else:
+        if tmp_fixed_path.exists():
+            os.remove(tmp_fixed_path)
+        try:
+            get_codec_backend().transcode(sura_filep, tmp_fixed_path, profile)
+        except Exception as e:
+            # never publish a partial fixed file, the existing fixed file would stop later runs from repairing it
+            print(f"   Transcoding {sura_filep.name} failed: {e}")
+            if tmp_fixed_path.exists():
+                os.remove(tmp_fixed_path)
+            raise
+    shutil.move(tmp_fixed_path, fixed_sura_filep)
+    print(f"   Fixed by {fix_method}.")
+    
+    # Set the track title using sura name from CSV
+    sura_id = int(sura_filep.stem[:3])
+    sura_name = NUM_TO_SURA.get(sura_id, f"Sura {sura_id:03d}")
+    tag_audio_file(fixed_sura_filep, {"title": sura_name}, profile["tagging"])
+    return fixed_sura_filep, fix_method
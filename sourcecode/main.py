@@ -1,18 +1,33 @@
 from pathlib import Path
-import statistics
+import json
+from typing import Dict
 
 from speedster import create_median_length_tracks
-from json_gen import load_folder_dfs
-from utils import split_all_median_files_to_clips
+from json_gen import compute_median_speedups, load_folder_dfs
+from utils import clip_folder_name, pace_folder_name, split_all_median_files_to_clips
+from alignment import transfer_timings
+from audit import audit_clip_library
+from clip_server import serve_clips
+from codec import set_codec_backend
+from device_sync import sync_clip_folders
+from pace import per_sura_speedups
+from fused_render import render_all_fixed_files_to_clips
+from job_queue import QUEUE_FOLDER_NAME, clip_jobs, median_jobs, run_audio_job, run_worker
+from scheduler import annotate_audio_jobs, run_scheduled
+from watcher import watch_quran_data_folder
 
 
 def analyze_n_generate_medians(
-        quran_data_folder: Path):
+        quran_data_folder: Path,
+        intermediate_profile: str = None,
+        repair_mode: str = "remux"):
     """
     A function to generate median length tracks for all reciters in the given folder.
 
     Args:
         quran_data_folder (Path): Directory where for each reciter a folder with the MP3 files is stored.
+        intermediate_profile (str): Name of the encode profile for the fixed and median files, None for the default profile.
+        repair_mode (str): "remux" only rebuilds the headers of the originals where possible, "transcode" always re-encodes them.
 
     Does:
         - Loads/generates metadata dataframes for all reciters.
@@ -23,28 +38,34 @@ def analyze_n_generate_medians(
 
 
     print("\n"*2, " Fixing files and analyzing them ".center(80, "="), "\n"*2)
-    rec_folders = sorted([folder for folder in quran_data_folder.iterdir() if folder.is_dir()])
+    rec_folders = list_reciter_folders(quran_data_folder)
     
 
     # create_folder_dfs(rec_folders)
-    reciter_sums_dict = load_folder_dfs(quran_data_folder, rec_folders)
+    reciter_sums_dict = load_folder_dfs(quran_data_folder, rec_folders, intermediate_profile, repair_mode)
 
     median_reciter_sum = reciter_sums_dict.values()
-    median_reciter = statistics.median(median_reciter_sum)
-    print("")
-    print(F"Median of all reciters: {median_reciter}")
-    rec_med_speedup = {}
-    for reciter, reciter_sum in reciter_sums_dict.items():
-        rec_med_speedup[reciter] = reciter_sum/median_reciter
-        print(F"Speedup factor for {reciter} to reach median: {rec_med_speedup[reciter]}")
+    rec_med_speedup = compute_median_speedups(reciter_sums_dict)
     
-    create_median_length_tracks(rec_folders, rec_med_speedup) # in own subfolder
+    create_median_length_tracks(rec_folders, rec_med_speedup, intermediate_profile) # in own subfolder
 
     print("\n"*2, " Done: Generating median files for all reciters ".center(80, "="), "\n"*2)
     
     # Memory optimization
     return rec_folders, reciter_sums_dict, median_reciter_sum, rec_med_speedup
 
+def list_reciter_folders(quran_data_folder: Path):
+    """Returns the reciter folders inside the quran data folder. Hidden folders like the .jobs queue are left out."""
+    return sorted([folder for folder in quran_data_folder.iterdir() if folder.is_dir() and not folder.name.startswith(".")])
+
+
+def load_median_speedups(quran_data_folder: Path) -> Dict[str, float]:
+    """Loads the reciter_sura_sums.json written by load_folder_dfs and calculates the median speedup factors from it."""
+    with open(quran_data_folder / "reciter_sura_sums.json") as f:
+        reciter_sums_dict = json.load(f)
+    return compute_median_speedups(reciter_sums_dict)
+
+
 """
 def speedup_medians_to_spedfull(
         quran_data_folder: Path, 
@@ -118,10 +139,19 @@ if __name__ == "__main__":
     # output_directory.mkdir(parents=True, exist_ok=True)
 
 
+    # "pyav" decodes/encodes in-process (needs the optional av package), "subprocess" spawns ffmpeg, "auto" picks pyav if installed
+    CODEC_BACKEND = "auto"
+    set_codec_backend(CODEC_BACKEND)
+
+    # see encode_profiles.ENCODE_PROFILES, e.g. "mp3_64k_mono" or "opus_32k" for smaller and faster output
+    INTERMEDIATE_PROFILE = "mp3_128k"
+    CLIP_PROFILE = "mp3_128k"
+
     GENERATE_MEDIANS = False
     if GENERATE_MEDIANS:
         analyze_n_generate_medians(
             quran_data_path,
+            intermediate_profile=INTERMEDIATE_PROFILE,
             )
 
 
@@ -133,7 +163,112 @@ if __name__ == "__main__":
         "genre": "Quran",
     }
 
-    GENERATE_CLIPS = True
+    # Pace mode: instead of one median factor per reciter, every sura gets the tempo which reads it at PAGES_PER_HOUR.
+    # Needs the rec_sura_df.json of a previous analyze_n_generate_medians run. The pace tracks go to pace_<pph>pph folders
+    # and their clips to pace<pph>_ prefixed clip folders, the median tracks and clips stay untouched.
+    PACE_NORMALIZE = False
+    PAGES_PER_HOUR = 20
+    if PACE_NORMALIZE:
+        rec_sura_speedup = per_sura_speedups(quran_data_path, PAGES_PER_HOUR)
+        create_median_length_tracks(
+            [rec_folder for rec_folder in list_reciter_folders(quran_data_path) if rec_folder.name in rec_sura_speedup],
+            rec_sura_speedup,
+            INTERMEDIATE_PROFILE,
+            median_folder_name=pace_folder_name(PAGES_PER_HOUR),
+            )
+        split_all_median_files_to_clips(
+            quran_data_folder=quran_data_path,
+            clip_length_ms=CLIP_LENGTH_MINUTES*60*1000,
+            overlap_ms=OVERLAP_SECONDS*1000,
+            fade_duration=FADE_SECONDS*1000,
+            speedup_factor=SPEEDUP_FACTOR,
+            metadata=None,
+            clip_folder_prefix="thirds_",
+            clip_profile=CLIP_PROFILE,
+            pages_per_hour=PAGES_PER_HOUR,
+            )
+
+    # Worker mode: start this script on several machines which mount the same quran_data_path.
+    # The medians need the reciter_sura_sums.json of a previous analyze_n_generate_medians run.
+    # Finished jobs are skipped until their settings change, job_queue.reset_queue(queue_dir) forces a full rerun.
+    WORKER_MODE = False
+    if WORKER_MODE:
+        rec_folders = list_reciter_folders(quran_data_path)
+        queue_dir = quran_data_path / QUEUE_FOLDER_NAME
+        run_worker(queue_dir, median_jobs(rec_folders, load_median_speedups(quran_data_path), INTERMEDIATE_PROFILE), run_audio_job)
+        run_worker(queue_dir, clip_jobs(
+            rec_folders,
+            clip_length_ms=CLIP_LENGTH_MINUTES*60*1000,
+            overlap_ms=OVERLAP_SECONDS*1000,
+            fade_duration=FADE_SECONDS*1000,
+            speedup_factor=SPEEDUP_FACTOR,
+            metadata=None,
+            clip_folder_prefix="thirds_",
+            clip_profile=CLIP_PROFILE,
+            ), run_audio_job)
+
+    # Fused mode: clips straight from the fixed files, one decode per sura and no median folder
+    FUSED_RENDER = False
+    if FUSED_RENDER:
+        render_all_fixed_files_to_clips(
+            rec_folders=list_reciter_folders(quran_data_path),
+            rec_med_speedup=load_median_speedups(quran_data_path),
+            clip_length_ms=CLIP_LENGTH_MINUTES*60*1000,
+            overlap_ms=OVERLAP_SECONDS*1000,
+            fade_duration=FADE_SECONDS*1000,
+            speedup_factor=SPEEDUP_FACTOR,
+            metadata=None,
+            clip_folder_prefix="thirds_",
+            clip_profile=CLIP_PROFILE,
+            )
+
+    # Scheduled mode: medians and clips in parallel worker processes, admitted against a RAM budget
+    SCHEDULED = False
+    RAM_BUDGET_GB = 8
+    if SCHEDULED:
+        rec_folders = list_reciter_folders(quran_data_path)
+        run_scheduled(
+            annotate_audio_jobs(median_jobs(rec_folders, load_median_speedups(quran_data_path), INTERMEDIATE_PROFILE)),
+            run_audio_job,
+            ram_budget_bytes=RAM_BUDGET_GB * 1024**3,
+            )
+        run_scheduled(
+            annotate_audio_jobs(clip_jobs(
+                rec_folders,
+                clip_length_ms=CLIP_LENGTH_MINUTES*60*1000,
+                overlap_ms=OVERLAP_SECONDS*1000,
+                fade_duration=FADE_SECONDS*1000,
+                speedup_factor=SPEEDUP_FACTOR,
+                metadata=None,
+                clip_folder_prefix="thirds_",
+                clip_profile=CLIP_PROFILE,
+                )),
+            run_audio_job,
+            ram_budget_bytes=RAM_BUDGET_GB * 1024**3,
+            )
+
+    # Watch mode: keeps polling the data folder and processes new reciters/suras as they are downloaded,
+    # regenerating only the medians and clips whose speedup factor changed
+    WATCH_MODE = False
+    if WATCH_MODE:
+        watch_quran_data_folder(
+            quran_data_folder=quran_data_path,
+            clip_length_ms=CLIP_LENGTH_MINUTES*60*1000,
+            overlap_ms=OVERLAP_SECONDS*1000,
+            fade_duration=FADE_SECONDS*1000,
+            speedup_factor=SPEEDUP_FACTOR,
+            metadata=None,
+            clip_folder_prefix="thirds_",
+            intermediate_profile=INTERMEDIATE_PROFILE,
+            clip_profile=CLIP_PROFILE,
+            )
+
+    GENERATE_CLIPS = not WORKER_MODE and not FUSED_RENDER and not SCHEDULED and not WATCH_MODE
+    # assembles the clips from mp3 frames shared between overlapping clips instead of encoding every clip on its own.
+    # Only the full level middle of clips without ducking is shared, so it pays off with DUCK_CLIPS off and short fades;
+    # with the ducked thirds clips every frame carries a fade and the clips are encoded one by one as usual.
+    OVERLAP_ENCODE = False
+    DUCK_CLIPS = True
     if GENERATE_CLIPS:
         # now generate the clips for each file inside the reciter/median/reciter folder
         split_all_median_files_to_clips(
@@ -143,9 +278,49 @@ if __name__ == "__main__":
             fade_duration=FADE_SECONDS*1000,
             speedup_factor=SPEEDUP_FACTOR,
             metadata=None,
-            clip_folder_prefix="thirds_"
+            clip_folder_prefix="thirds_",
+            clip_profile=CLIP_PROFILE,
+            overlap_encode=OVERLAP_ENCODE,
+            duck=DUCK_CLIPS,
             )
 
 
-    
+    # Alignment: transfers the ayah/page timings (timings/NNN.json) of the reference reciter to all other reciters
+    ALIGN_TIMINGS = False
+    REFERENCE_RECITER = "Mishary Alafasy"
+    if ALIGN_TIMINGS:
+        transfer_timings(quran_data_path, REFERENCE_RECITER, list_reciter_folders(quran_data_path))
+
+    # Audit: checks every expected clip exists with the right length and tags, without decoding anything
+    AUDIT = False
+    if AUDIT:
+        audit_clip_library(
+            quran_data_folder=quran_data_path,
+            rec_folders=list_reciter_folders(quran_data_path),
+            clip_length_ms=CLIP_LENGTH_MINUTES*60*1000,
+            overlap_ms=OVERLAP_SECONDS*1000,
+            speedup_factor=SPEEDUP_FACTOR,
+            clip_folder_prefix="thirds_",
+            clip_profile=CLIP_PROFILE,
+            rec_med_speedup=load_median_speedups(quran_data_path) if FUSED_RENDER else None,
+            )
+
+    # Device sync: copies only new/changed clips onto a mounted phone, USB stick or SD card and deletes stale ones
+    DEVICE_SYNC = False
+    DEVICE_PATH = Path('/Volumes/QURAN_USB/')
+    STRICT_ORDER = False  # rewrites changed folders completely, for car players which play in write order
+    if DEVICE_SYNC:
+        sync_clip_folders(
+            source_folders=[rec_folder / clip_folder_name(rec_folder.name, SPEEDUP_FACTOR, "thirds_")
+                            for rec_folder in list_reciter_folders(quran_data_path)
+                            if (rec_folder / clip_folder_name(rec_folder.name, SPEEDUP_FACTOR, "thirds_")).exists()],
+            target_dir=DEVICE_PATH,
+            strict_order=STRICT_ORDER,
+            )
 
+    # Clip server: renders clips on demand from the median folders instead of pre-rendering every combination,
+    # e.g. http://127.0.0.1:8765/clip?reciter=Mishary%20Alafasy&sura=2&clip=5&speed=1.2
+    SERVE_CLIPS = False
+    CLIP_CACHE_GB = 2
+    if SERVE_CLIPS:
+        serve_clips(quran_data_path, cache_max_bytes=CLIP_CACHE_GB * 1024**3)
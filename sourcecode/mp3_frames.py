@@ -0,0 +1,193 @@
+import mmap
+from array import array
+from pathlib import Path
+from typing import NamedTuple, Optional, Tuple
+
+
+# MPEG audio layer III tables, indexed by the header fields
+BITRATES_KBPS = {
+    "mpeg1": [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 0],
+    "mpeg2": [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160, 0],
+}
+SAMPLE_RATES = {
+    3: [44100, 48000, 32000],  # MPEG1
+    2: [22050, 24000, 16000],  # MPEG2
+    0: [11025, 12000, 8000],   # MPEG2.5
+}
+# samples every layer III decoder outputs before the first encoded sample, gapless decoders drop them with the encoder delay
+DECODER_DELAY_SAMPLES = 529
+
+
+class Mp3FrameHeader(NamedTuple):
+    frame_size: int
+    sample_rate: int
+    samples_per_frame: int
+    channels: int
+    side_info_size: int
+
+
+class Mp3FrameIndex(NamedTuple):
+    offsets: array          # byte offset of every audio frame, Xing/Info/VBRI frames excluded
+    audio_end: int          # byte offset where the last audio frame ends
+    sample_rate: int
+    samples_per_frame: int
+    channels: int
+    start_skip: int = 0     # samples a gapless decoder drops at the start, from the LAME tag of the Info frame
+    end_skip: int = 0       # samples a gapless decoder drops at the end
+
+
+def parse_frame_header(header: bytes) -> Optional[Mp3FrameHeader]:
+    """
+    Parses a 4 byte MPEG audio layer III frame header.
+
+    Returns:
+        Mp3FrameHeader: The parsed header, None if the bytes are no valid layer III header.
+    """
+    if len(header) < 4 or header[0] != 0xFF or (header[1] & 0xE0) != 0xE0:
+        return None
+    version = (header[1] >> 3) & 0x03
+    layer = (header[1] >> 1) & 0x03
+    bitrate_index = header[2] >> 4
+    sample_rate_index = (header[2] >> 2) & 0x03
+    if version == 1 or layer != 1 or bitrate_index in (0, 15) or sample_rate_index == 3:
+        # reserved version, not layer III, free format or reserved values
+        return None
+
+    padding = (header[2] >> 1) & 0x01
+    channels = 1 if (header[3] >> 6) == 3 else 2
+    sample_rate = SAMPLE_RATES[version][sample_rate_index]
+    if version == 3:
+        bitrate = BITRATES_KBPS["mpeg1"][bitrate_index] * 1000
+        frame_size = 144 * bitrate // sample_rate + padding
+        samples_per_frame = 1152
+        side_info_size = 17 if channels == 1 else 32
+    else:
+        bitrate = BITRATES_KBPS["mpeg2"][bitrate_index] * 1000
+        frame_size = 72 * bitrate // sample_rate + padding
+        samples_per_frame = 576
+        side_info_size = 9 if channels == 1 else 17
+    return Mp3FrameHeader(frame_size, sample_rate, samples_per_frame, channels, side_info_size)
+
+
+def id3v2_size(data) -> int:
+    """Returns the size of the ID3v2 tag at the start of the data, 0 if there is none."""
+    if len(data) < 10 or data[:3] != b"ID3":
+        return 0
+    size = (data[6] << 21) | (data[7] << 14) | (data[8] << 7) | data[9]
+    footer = 10 if data[5] & 0x10 else 0
+    return 10 + size + footer
+
+
+def is_info_frame(data, offset: int, header: Mp3FrameHeader) -> bool:
+    """Checks if the frame at offset is a Xing/Info/VBRI header frame, which carries no audio."""
+    xing_offset = offset + 4 + header.side_info_size
+    if data[xing_offset:xing_offset + 4] in (b"Xing", b"Info"):
+        return True
+    return data[offset + 36:offset + 40] == b"VBRI"
+
+
+def parse_gapless_skips(data, offset: int, header: Mp3FrameHeader) -> Tuple[int, int]:
+    """
+    Reads the encoder delay and padding from the LAME tag of a Xing/Info frame, like ffmpeg and its gapless decoding do.
+
+    Returns:
+        Tuple[int, int]: The samples dropped at the start and at the end of the decoded stream, (0, 0) without a LAME tag.
+    """
+    xing_offset = offset + 4 + header.side_info_size
+    if data[xing_offset:xing_offset + 4] not in (b"Xing", b"Info"):
+        return 0, 0
+    flags = int.from_bytes(data[xing_offset + 4:xing_offset + 8], "big")
+    # optional frame count, byte count, table of contents and quality fields
+    lame_offset = xing_offset + 8 + 4 * bool(flags & 1) + 4 * bool(flags & 2) + 100 * bool(flags & 4) + 4 * bool(flags & 8)
+    if data[lame_offset:lame_offset + 4] not in (b"LAME", b"Lavf", b"Lavc"):
+        return 0, 0
+    # encoder string, revision, lowpass, replay gain, flags and abr bitrate come before the 12 bit delay and padding
+    delays = int.from_bytes(data[lame_offset + 21:lame_offset + 24], "big")
+    start_pad, end_pad = delays >> 12, delays & 0xFFF
+    return start_pad + DECODER_DELAY_SAMPLES, max(0, end_pad - DECODER_DELAY_SAMPLES)
+
+
+def scan_mp3_frames(data) -> Mp3FrameIndex:
+    """
+    Walks all layer III frames of the mp3 bytes without decoding them.
+    Garbage between frames is skipped by searching for the next pair of consecutive valid headers.
+
+    Args:
+        data: The complete mp3 file as bytes or mmap.
+
+    Returns:
+        Mp3FrameIndex: The byte offsets of all audio frames and the stream parameters.
+    """
+    offsets = array("q")
+    stream_header = None
+    start_skip, end_skip = 0, 0
+    audio_end = 0
+    position = id3v2_size(data)
+    data_len = len(data)
+
+    while position + 4 <= data_len:
+        header = parse_frame_header(data[position:position + 4])
+        if header is None or position + header.frame_size > data_len:
+            # lost sync, search for the next frame whose successor also is a valid frame
+            next_sync = data.find(b"\xff", position + 1)
+            if next_sync == -1:
+                break
+            position = next_sync
+            candidate = parse_frame_header(data[next_sync:next_sync + 4])
+            if candidate is not None:
+                successor = next_sync + candidate.frame_size
+                if successor != data_len and parse_frame_header(data[successor:successor + 4]) is None:
+                    position += 1  # a single header lookalike inside audio data
+            else:
+                position += 1
+            continue
+
+        if stream_header is None:
+            stream_header = header
+            if is_info_frame(data, position, header):
+                start_skip, end_skip = parse_gapless_skips(data, position, header)
+                position += header.frame_size
+                continue
+        offsets.append(position)
+        position += header.frame_size
+        audio_end = position
+
+    if stream_header is None:
+        raise ValueError("No mp3 frames found.")
+    return Mp3FrameIndex(offsets, audio_end, stream_header.sample_rate, stream_header.samples_per_frame, stream_header.channels,
+                         start_skip, end_skip)
+
+
+def index_mp3_file(file_path: Path) -> Mp3FrameIndex:
+    """Builds the frame index for an mp3 file by memory mapping it."""
+    with open(file_path, "rb") as file:
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            return scan_mp3_frames(data)
+
+
+def frame_duration_ms(index: Mp3FrameIndex) -> float:
+    """Returns the duration of a single frame in milliseconds."""
+    return 1000.0 * index.samples_per_frame / index.sample_rate
+
+
+def index_num_samples(index: Mp3FrameIndex) -> int:
+    """Returns the number of samples a gapless decoder outputs, the frames without the encoder delay and padding."""
+    return max(0, len(index.offsets) * index.samples_per_frame - index.start_skip - index.end_skip)
+
+
+def index_duration_s(index: Mp3FrameIndex) -> float:
+    """Returns the exact duration of the stream from the number of frames, as decoded by a gapless decoder."""
+    return index_num_samples(index) / index.sample_rate
+
+
+def frame_byte_range(index: Mp3FrameIndex, first_frame: int, end_frame: int) -> Tuple[int, int]:
+    """Returns the byte range [start, end) covering the frames [first_frame, end_frame)."""
+    start = index.offsets[first_frame]
+    end = index.offsets[end_frame] if end_frame < len(index.offsets) else index.audio_end
+    return start, end
+
+
+def count_mp3_frames(file_path: Path) -> Tuple[int, float]:
+    """Returns the number of audio frames and the duration in seconds calculated from them."""
+    index = index_mp3_file(file_path)
+    return len(index.offsets), index_duration_s(index)
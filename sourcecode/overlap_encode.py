@@ -0,0 +1,238 @@
+import os
+from functools import lru_cache
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+from pydub import AudioSegment
+
+from codec import get_codec_backend
+from encode_profiles import get_profile
+from file_io import clip_filename, clip_metadata, clip_windows, save_clips_no_concat
+from mp3_frames import scan_mp3_frames
+from processflow import SILENCE_DB, apply_clip_envelope, clip_envelope_regions, postprocess_file
+
+
+# With 2/3 overlap every second of a sura is part of three clips and save_clips_no_concat encodes it three times.
+# Here every clip is assembled from mp3 frames instead:
+#   unity   -> frames where the clip envelope keeps the full level are cut from one shared encode of the source
+#   silence -> frames inside the ducked middle are copies of one encoded silence frame
+#   boundary-> frames carrying a fade are encoded fresh per clip, from the enveloped clip audio
+# The frames are encoded CBR without bit reservoir, so every frame decodes on its own and frames of different encodes
+# can be spliced. All encodes share the same frame grid: clips start on source frame borders and every encoded block
+# gets CONTEXT_FRAMES of real audio on both sides, so the MDCT overlap at a splice sees the same audio from both encodes.
+MP3_FRAME_RUN_ARGS = ['-reservoir', '0', '-write_xing', '0', '-id3v2_version', '0']
+CONTEXT_FRAMES = 2
+# LAME encoder delay (576) plus decoder delay (529): decoded sample t of a raw LAME stream is input sample t - 1105
+ENCODER_DELAY_SAMPLES = 1105
+
+UNITY = "unity"
+SILENCE = "silence"
+BOUNDARY = "boundary"
+
+
+def samples_per_frame(sample_rate: int) -> int:
+    """Layer III frames hold 1152 samples for MPEG-1 sample rates and 576 for the MPEG-2 ones."""
+    return 1152 if sample_rate >= 32000 else 576
+
+
+def classify_clip_frames(num_frames: int, frame_ms: float, fade_ms: int, duck: bool = True) -> List[str]:
+    """
+    Classifies every frame of a clip as UNITY, SILENCE or BOUNDARY by the envelope of clip_envelope_regions.
+    The frames next to a change of class are BOUNDARY as well, so a splice always lies between frames with matching audio.
+    """
+    regions = clip_envelope_regions(int(num_frames * frame_ms), fade_ms, duck)
+    kinds = []
+    for frame_num in range(num_frames):
+        frame_start_ms, frame_end_ms = frame_num * frame_ms, (frame_num + 1) * frame_ms
+        kind = BOUNDARY
+        for start_ms, end_ms, start_db, end_db in regions:
+            if start_ms <= frame_start_ms and frame_end_ms <= end_ms:
+                if start_db == end_db == 0.0:
+                    kind = UNITY
+                elif start_db == end_db == SILENCE_DB:
+                    kind = SILENCE
+                break
+        kinds.append(kind)
+    return [BOUNDARY if any(kinds[neighbour] != kind for neighbour in (frame_num - 1, frame_num + 1) if 0 <= neighbour < num_frames)
+            else kind for frame_num, kind in enumerate(kinds)]
+
+
+def frame_runs(frame_nums: List[int]) -> List[Tuple[int, int]]:
+    """Groups sorted frame numbers into maximal runs [first, end)."""
+    runs = []
+    for frame_num in frame_nums:
+        if runs and runs[-1][1] == frame_num:
+            runs[-1][1] += 1
+        else:
+            runs.append([frame_num, frame_num + 1])
+    return [tuple(run) for run in runs]
+
+
+def encode_frame_blocks(blocks: List[Tuple[AudioSegment, int]], profile: Dict) -> List[List[bytes]]:
+    """
+    Encodes blocks of audio in a single encoder run and returns the mp3 frames of every block body.
+
+    Args:
+        blocks (List[Tuple[AudioSegment, int]]): (audio, body_frames) per block. The audio holds CONTEXT_FRAMES of context,
+            body_frames frames of body and CONTEXT_FRAMES of context again, all full frames of the profile's sample format.
+        profile (Dict): An mp3 encode profile.
+
+    Returns:
+        List[List[bytes]]: The encoded frames of the body of every block.
+    """
+    if not blocks:
+        return []
+    frame_samples = samples_per_frame(profile["sample_rate"])
+    # leading samples which move the encoder delay onto the frame grid: encoded frame j is block stream frame j - delay_frames
+    lead_samples = -ENCODER_DELAY_SAMPLES % frame_samples
+    delay_frames = (ENCODER_DELAY_SAMPLES + lead_samples) // frame_samples
+    first_block = blocks[0][0]
+    stream = AudioSegment(
+        data=b"\x00" * (lead_samples * 2 * first_block.channels) + b"".join(audio.raw_data for audio, _ in blocks),
+        sample_width=2, frame_rate=first_block.frame_rate, channels=first_block.channels)
+
+    data = get_codec_backend().encode_bytes(stream, profile, MP3_FRAME_RUN_ARGS)
+    index = scan_mp3_frames(data)
+    offsets = list(index.offsets) + [index.audio_end]
+
+    encoded_blocks = []
+    block_start_frame = 0
+    for audio, body_frames in blocks:
+        first_frame = block_start_frame + CONTEXT_FRAMES + delay_frames
+        encoded_blocks.append([data[offsets[frame_num]:offsets[frame_num + 1]] for frame_num in range(first_frame, first_frame + body_frames)])
+        block_start_frame += body_frames + 2 * CONTEXT_FRAMES
+    return encoded_blocks
+
+
+def padded_frames(audio: AudioSegment, first_frame: int, end_frame: int, frame_samples: int) -> AudioSegment:
+    """Cuts the frames [first_frame, end_frame) out of 16 bit audio, padded with silence where they reach outside of it."""
+    start_sample = first_frame * frame_samples
+    end_sample = end_frame * frame_samples
+    total_samples = int(audio.frame_count())
+    bytes_per_sample = 2 * audio.channels
+    samples = audio.get_sample_slice(min(max(0, start_sample), total_samples), max(0, min(end_sample, total_samples))).raw_data
+    lead_padding = b"\x00" * (max(0, -start_sample) * bytes_per_sample)
+    tail_padding = b"\x00" * ((end_sample - start_sample) * bytes_per_sample - len(samples) - len(lead_padding))
+    return AudioSegment(data=lead_padding + samples + tail_padding, sample_width=2, frame_rate=audio.frame_rate, channels=audio.channels)
+
+
+def frame_block(audio: AudioSegment, first_frame: int, end_frame: int, frame_samples: int) -> AudioSegment:
+    """Returns the frames [first_frame, end_frame) with CONTEXT_FRAMES of context on both sides, see encode_frame_blocks."""
+    return padded_frames(audio, first_frame - CONTEXT_FRAMES, end_frame + CONTEXT_FRAMES, frame_samples)
+
+
+@lru_cache(maxsize=8)
+def _encoded_silence_frame(profile_items: Tuple) -> bytes:
+    profile = dict(profile_items)
+    frame_samples = samples_per_frame(profile["sample_rate"])
+    body_frames = 4
+    silence_block = AudioSegment(data=b"\x00" * (2 * profile["channels"] * frame_samples * (body_frames + 2 * CONTEXT_FRAMES)),
+                                 sample_width=2, frame_rate=profile["sample_rate"], channels=profile["channels"])
+    return encode_frame_blocks([(silence_block, body_frames)], profile)[0][body_frames // 2]
+
+
+def encoded_silence_frame(profile: Dict) -> bytes:
+    """Returns one encoded frame of digital silence, taken from the middle of a silence run and cached per profile."""
+    return _encoded_silence_frame(tuple(sorted(profile.items())))
+
+
+def save_clips_overlap_encoded(
+        audio: AudioSegment,
+        reciter_name: str,
+        sura_num: int,
+        clip_length_ms: int,
+        overlap_ms: int,
+        output_dir: Path,
+        fade_ms: int,
+        metadata: Dict[str, str],
+        speedup_factor: float,
+        clip_folder_prefix: str,
+        profile: Dict = None,
+        duck: bool = True) -> Dict[str, int]:
+    """
+    Overlap-aware counterpart of save_clips_no_concat, writing the same clips with the same names and tags.
+    Source frames at full level are encoded once for all clips containing them, so that part of the encode work no longer
+    grows with the overlap. Clip borders are moved onto the mp3 frame grid (at most half a frame, 13 ms at 44.1 kHz).
+    Profiles other than mp3, and clip plans which would not encode fewer frames than encoding every clip on its own,
+    fall back to save_clips_no_concat. The latter is the case for ducked clips whose fades cover the whole overlap,
+    like the thirds preset, where no frame of a clip is at full level.
+
+    Args:
+        duck (bool): Whether the middle of the clips is faded out and in again like postprocess_clip does.
+        See save_clips_no_concat for the other arguments.
+
+    Returns:
+        Dict[str, int]: Number of "clip_frames" written and "encoded_frames" encoded (including the context frames).
+    """
+    if profile is None:
+        profile = get_profile()
+    if profile["format"] != "mp3":
+        save_clips_no_concat(audio, reciter_name, sura_num, clip_length_ms, overlap_ms, output_dir, fade_ms, metadata,
+                             speedup_factor, clip_folder_prefix, profile, duck)
+        return {"clip_frames": 0, "encoded_frames": 0}
+
+    audio = audio.set_frame_rate(profile["sample_rate"]).set_channels(profile["channels"]).set_sample_width(2)
+    frame_samples = samples_per_frame(profile["sample_rate"])
+    frame_ms = 1000.0 * frame_samples / profile["sample_rate"]
+    total_frames = -(-int(audio.frame_count()) // frame_samples)
+
+    # segment planner: clip windows on the frame grid and the class of every frame of every clip
+    clips = []
+    for clip_num, start_ms, end_ms in clip_windows(len(audio), clip_length_ms, overlap_ms):
+        first_frame = int(round(start_ms / frame_ms))
+        end_frame = total_frames if end_ms >= len(audio) else min(total_frames, int(round(end_ms / frame_ms)))
+        if end_frame > first_frame:
+            clips.append((clip_num, first_frame, classify_clip_frames(end_frame - first_frame, frame_ms, fade_ms, duck)))
+
+    # unity frames: one shared encode of the source, boundary frames: encoded per clip
+    unity_frames = sorted({first_frame + frame_num for _, first_frame, kinds in clips
+                           for frame_num, kind in enumerate(kinds) if kind == UNITY})
+    unity_runs = frame_runs(unity_frames)
+    boundary_runs = [(clip_num, frame_runs([frame_num for frame_num, kind in enumerate(kinds) if kind == BOUNDARY]))
+                     for clip_num, _, kinds in clips]
+    encoded_frames = sum(end - first + 2 * CONTEXT_FRAMES for first, end in unity_runs) + \
+        sum(end - first + 2 * CONTEXT_FRAMES for _, runs in boundary_runs for first, end in runs)
+    clip_frames = sum(len(kinds) for _, _, kinds in clips)
+    if encoded_frames >= clip_frames:
+        save_clips_no_concat(audio, reciter_name, sura_num, clip_length_ms, overlap_ms, output_dir, fade_ms, metadata,
+                             speedup_factor, clip_folder_prefix, profile, duck)
+        return {"clip_frames": clip_frames, "encoded_frames": clip_frames}
+
+    encoded_runs = encode_frame_blocks([(frame_block(audio, first, end, frame_samples), end - first) for first, end in unity_runs], profile)
+    source_frames = {}
+    for (first, _), encoded_run in zip(unity_runs, encoded_runs):
+        for frame_num, frame in enumerate(encoded_run, start=first):
+            source_frames[frame_num] = frame
+
+    # boundary frames: the enveloped clips, all boundary runs of the sura in one encode
+    boundary_blocks = []
+    boundary_keys = []
+    for (clip_num, first_frame, kinds), (_, runs) in zip(clips, boundary_runs):
+        clip_audio = apply_clip_envelope(padded_frames(audio, first_frame, first_frame + len(kinds), frame_samples), fade_ms, duck)
+        for first, end in runs:
+            boundary_blocks.append((frame_block(clip_audio, first, end, frame_samples), end - first))
+            boundary_keys.append((clip_num, first))
+    boundary_frames = {}
+    for (clip_num, first), encoded_run in zip(boundary_keys, encode_frame_blocks(boundary_blocks, profile)):
+        for frame_num, frame in enumerate(encoded_run, start=first):
+            boundary_frames[(clip_num, frame_num)] = frame
+
+    silence_frame = encoded_silence_frame(profile)
+    for clip_num, first_frame, kinds in clips:
+        frames = []
+        for frame_num, kind in enumerate(kinds):
+            if kind == UNITY:
+                frames.append(source_frames[first_frame + frame_num])
+            elif kind == SILENCE:
+                frames.append(silence_frame)
+            else:
+                frames.append(boundary_frames[(clip_num, frame_num)])
+
+        filename = clip_filename(reciter_name, sura_num, speedup_factor, clip_num, clip_folder_prefix, profile["extension"])
+        temp_path = output_dir / f"temp_{filename}"
+        with open(temp_path, "wb") as f:
+            f.write(b"".join(frames))
+        metadata = clip_metadata(metadata, reciter_name, sura_num, speedup_factor, clip_num, clip_folder_prefix)
+        postprocess_file(temp_path, metadata, profile["tagging"])
+        os.replace(temp_path, output_dir / filename)
+    return {"clip_frames": clip_frames, "encoded_frames": encoded_frames}
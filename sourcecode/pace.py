@@ -0,0 +1,128 @@
+import csv
+import json
+from pathlib import Path
+from typing import Dict, Tuple
+
+import numpy as np
+import pandas as pd
+
+
+# Start page of every sura in the 604 page Madani mushaf, next to quran_numbers.csv
+script_dir = Path(__file__).parent
+pages_csv_path = script_dir / "quran_pages.csv"
+NUM_SURAS = 114
+MUSHAF_PAGES = 604
+
+PACE_CACHE_NAME = "pace_matrix.npz"
+# tempo factors outside this range are clamped, atempo chains beyond it make a recitation unlistenable.
+# The short suras of the last pages share a page, so a pace would otherwise slow them down to a fifth.
+TEMPO_FACTOR_RANGE = (0.5, 2.0)
+
+
+def load_sura_pages(csv_path: Path = pages_csv_path) -> np.ndarray:
+    """
+    Reads quran_pages.csv and returns the fractional page count of every sura (index sura number - 1).
+    A sura starting alone on a page is taken to start at the top of it, suras starting on the same page share it evenly.
+    """
+    start_pages = np.zeros(NUM_SURAS)
+    with open(csv_path, mode='r', encoding='utf-8') as file:
+        for row in csv.reader(file):
+            if len(row) >= 2:
+                start_pages[int(row[0].strip()) - 1] = int(row[1].strip())
+
+    # position of every sura start in pages from the beginning of the mushaf
+    positions = start_pages - 1
+    for page in np.unique(start_pages):
+        same_page = np.flatnonzero(start_pages == page)
+        positions[same_page] += np.arange(len(same_page)) / len(same_page)
+    return np.diff(np.append(positions, MUSHAF_PAGES))
+
+
+def build_duration_matrix(quran_data_folder: Path) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Builds the reciters x suras matrix of recitation durations in seconds from the rec_sura_df.json of load_folder_dfs,
+    with NaN where a reciter does not have a sura. All suras are used, not only the ones common to all reciters.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: The reciter names and the float32 duration matrix.
+    """
+    rec_sura_df = pd.read_json(quran_data_folder / "rec_sura_df.json", lines=True)
+    reciter_codes, reciters = pd.factorize(rec_sura_df['artist'], sort=True)
+    durations = np.full((len(reciters), NUM_SURAS), np.nan, dtype=np.float32)
+    durations[reciter_codes, rec_sura_df['trk_num'].astype(int).to_numpy() - 1] = rec_sura_df['len'].to_numpy() * 60.0
+    return np.asarray(reciters, dtype=str), durations
+
+
+def load_duration_matrix(quran_data_folder: Path) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Returns the duration matrix of build_duration_matrix, cached as PACE_CACHE_NAME in the quran data folder
+    until rec_sura_df.json changes. Re-planning a pace only needs this small array, no audio file is touched.
+    """
+    cache_path = quran_data_folder / PACE_CACHE_NAME
+    source_mtime_ns = (quran_data_folder / "rec_sura_df.json").stat().st_mtime_ns
+    if cache_path.exists():
+        with np.load(cache_path) as cache:
+            if int(cache["source_mtime_ns"]) == source_mtime_ns:
+                return cache["reciters"], cache["durations"]
+
+    reciters, durations = build_duration_matrix(quran_data_folder)
+    np.savez_compressed(cache_path, reciters=reciters, durations=durations, source_mtime_ns=np.int64(source_mtime_ns))
+    return reciters, durations
+
+
+def tempo_factor_matrix(durations: np.ndarray, sura_pages: np.ndarray, pages_per_hour: float,
+                        factor_range: Tuple[float, float] = TEMPO_FACTOR_RANGE) -> np.ndarray:
+    """
+    Calculates the tempo factor of every (reciter, sura) which makes the recitation take pages / pages_per_hour hours.
+    Like the median speedups, a factor above 1 speeds the recitation up. Missing suras stay NaN.
+    The factors are clamped to factor_range, None returns the unclamped factors.
+    """
+    target_seconds = sura_pages / pages_per_hour * 3600.0
+    factors = durations / target_seconds[np.newaxis, :]
+    if factor_range is not None:
+        factors = np.clip(factors, *factor_range)
+    return factors
+
+
+def per_sura_speedups(quran_data_folder: Path, pages_per_hour: float) -> Dict[str, Dict[int, float]]:
+    """
+    Returns for every reciter the tempo factor of every sura it has, for create_median_length_tracks.
+
+    Args:
+        quran_data_folder (Path): Path to the main data folder with the rec_sura_df.json of load_folder_dfs.
+        pages_per_hour (float): The target pace, e.g. 20 pages per hour.
+    """
+    reciters, durations = load_duration_matrix(quran_data_folder)
+    raw_factors = tempo_factor_matrix(durations, load_sura_pages(), pages_per_hour, factor_range=None)
+    factors = np.clip(raw_factors, *TEMPO_FACTOR_RANGE)
+    rec_sura_speedup = {}
+    for reciter, reciter_raw_factors, reciter_factors in zip(reciters, raw_factors, factors):
+        clamped = np.flatnonzero(~np.isnan(reciter_raw_factors) & (reciter_raw_factors != reciter_factors))
+        if len(clamped):
+            print(F" - {reciter}: {len(clamped)} suras need a tempo factor outside {TEMPO_FACTOR_RANGE} for {pages_per_hour:g} pages/hour "
+                  F"and are clamped: " + ", ".join(F"{sura_num + 1} ({reciter_raw_factors[sura_num]:.2f})" for sura_num in clamped))
+        sura_nums = np.flatnonzero(~np.isnan(reciter_factors))
+        rec_sura_speedup[str(reciter)] = {int(sura_num) + 1: float(reciter_factors[sura_num]) for sura_num in sura_nums}
+    return rec_sura_speedup
+
+
+def reciter_paces(quran_data_folder: Path) -> Dict[str, float]:
+    """Returns the natural pace of every reciter in pages per hour, over all suras the reciter has."""
+    reciters, durations = load_duration_matrix(quran_data_folder)
+    sura_pages = load_sura_pages()
+    present = ~np.isnan(durations)
+    pages = (present * sura_pages[np.newaxis, :]).sum(axis=1)
+    hours = np.nansum(durations, axis=1) / 3600.0
+    return {str(reciter): float(reciter_pages / reciter_hours) for reciter, reciter_pages, reciter_hours in zip(reciters, pages, hours)}
+
+
+if __name__ == "__main__":
+    quran_data_path = Path('/Users/hm/Documents/Quran_Recordings/')
+    PAGES_PER_HOUR = 20
+
+    print(json.dumps(reciter_paces(quran_data_path), indent=2))
+    factors = per_sura_speedups(quran_data_path, PAGES_PER_HOUR)
+    for reciter, sura_factors in factors.items():
+        values = np.array(list(sura_factors.values()))
+        print(f"{reciter}: {len(values)} suras, tempo factor for {PAGES_PER_HOUR} pages/hour "
+              f"min {values.min():.2f}, median {np.median(values):.2f}, max {values.max():.2f}")
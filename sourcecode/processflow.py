@@ -1,8 +1,8 @@
 from pathlib import Path
-from typing import Dict
+from typing import Dict, List, Tuple
 from pydub import AudioSegment
-from mutagen.mp3 import MP3
-from mutagen.easyid3 import EasyID3
+
+from utils import tag_audio_file
 
 
 def postprocess_clip(clip: AudioSegment, fade_seconds: float) -> AudioSegment:
@@ -48,24 +48,84 @@ def postprocess_clip(clip: AudioSegment, fade_seconds: float) -> AudioSegment:
         return clip
 
 
-def postprocess_file(output_path: Path, metadata: Dict[str, str]) -> None:
+def apply_clip_envelope(clip: AudioSegment, fade_ms: int, duck: bool = True) -> AudioSegment:
+    """
+    Applies the envelope of clip_envelope_regions to a clip. With duck this is postprocess_clip,
+    without it the clip only gets the fade in and fade out.
+    """
+    if duck or len(clip) < fade_ms*2:
+        return postprocess_clip(clip, fade_ms / 1000.0)
+    return clip.fade_in(int(fade_ms)).fade_out(int(fade_ms))
+
+
+# pydub fades change the gain linearly in dB, starting from (or ending at) -120 dB
+SILENCE_DB = -120.0
+
+
+def clip_envelope_regions(clip_length_ms: int, fade_ms: int, duck: bool = True) -> List[Tuple[int, int, float, float]]:
+    """
+    Describes the gain envelope which postprocess_clip applies to a clip of the given length,
+    so the same envelope can be rendered by ffmpeg or reused without an AudioSegment.
+
+    Args:
+        clip_length_ms (int): Length of the clip in milliseconds.
+        fade_ms (int): The duration of the fade in and fade out effect in milliseconds.
+        duck (bool): Whether the middle of the clip is faded out and in again like postprocess_clip does.
+                     Without ducking the middle keeps its full level.
+
+    Returns:
+        List[Tuple[int, int, float, float]]: Regions (start_ms, end_ms, start_db, end_db) covering the clip, the gain changes linearly in dB.
+    """
+    if clip_length_ms < fade_ms*2:
+        # for short clips
+        if clip_length_ms < fade_ms:
+            return [(0, clip_length_ms, SILENCE_DB, 0.0)]
+        return [(0, fade_ms, SILENCE_DB, 0.0), (fade_ms, clip_length_ms, 0.0, 0.0)]
+
+    middle_end = clip_length_ms - fade_ms
+    regions = [(0, fade_ms, SILENCE_DB, 0.0)]
+    if duck:
+        # same quarters as postprocess_clip: fade out, two quarters silence, fade in, rest unchanged
+        quarter_ms = int((middle_end - fade_ms)/4)
+        regions += [
+            (fade_ms, fade_ms + quarter_ms, 0.0, SILENCE_DB),
+            (fade_ms + quarter_ms, fade_ms + 3*quarter_ms, SILENCE_DB, SILENCE_DB),
+            (fade_ms + 3*quarter_ms, fade_ms + 4*quarter_ms, SILENCE_DB, 0.0),
+            (fade_ms + 4*quarter_ms, middle_end, 0.0, 0.0),
+        ]
+    else:
+        regions.append((fade_ms, middle_end, 0.0, 0.0))
+    regions.append((middle_end, clip_length_ms, 0.0, SILENCE_DB))
+    return [region for region in regions if region[1] > region[0]]
+
+
+def envelope_volume_expression(regions: List[Tuple[int, int, float, float]]) -> str:
+    """
+    Turns envelope regions into an expression for the ffmpeg volume filter (evaluated per frame, t in seconds since the clip start).
+    """
+    expression = "1"
+    for start_ms, end_ms, start_db, end_db in reversed(regions):
+        if start_db == end_db:
+            gain = "0" if start_db <= SILENCE_DB else f"{10 ** (start_db / 20.0):.6f}"
+        else:
+            start_s = start_ms / 1000.0
+            duration_s = (end_ms - start_ms) / 1000.0
+            gain = f"pow(10,({start_db}+({end_db - start_db})*(t-{start_s:.3f})/{duration_s:.3f})/20)"
+        expression = f"if(lt(t,{end_ms / 1000.0:.3f}),{gain},{expression})"
+    return expression
+
+
+def postprocess_file(output_path: Path, metadata: Dict[str, str], tagging: str = "id3") -> None:
     """
     Edit the resulting clip file to add metadata such as album art, album name, composer, genre, and title.
 
     Args:
         output_path (Path): The path to the output clip file to edit.
         metadata (Dict[str, str]): A dictionary containing metadata parameters.
+        tagging (str): The tag system of the container, as given by the "tagging" key of the encode profile.
 
     Returns:
         None
     """
     if metadata is not None:
-        # Ensure file has an ID3 tag
-        mp3 = MP3(str(output_path))
-        if mp3.tags is None:
-            mp3.add_tags()
-            mp3.save()
-        audio = EasyID3(str(output_path))
-        for key, value in metadata.items():
-            audio[key] = value
-        audio.save()
\ No newline at end of file
+        tag_audio_file(output_path, metadata, tagging)
\ No newline at end of file
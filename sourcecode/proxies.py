@@ -0,0 +1,145 @@
+import hashlib
+import json
+import os
+import subprocess
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+from utils import file_hash, write_file_atomically
+
+
+# Analysis passes (lengths, silences, loudness, alignment) read 16 kHz mono 16 bit proxies instead of decoding the
+# 44.1 kHz stereo mp3s again: about 5.5x less data and no mp3 decode. The proxies live in one store per quran data folder,
+# named by the content hash of their source, so renamed or copied files share a proxy. Every source file has a small
+# sidecar in the sources folder of the store with its size, mtime and content hash, so unchanged files are not hashed again.
+# One sidecar per source keeps concurrent workers from overwriting each other's entries. Renders still use the full quality files.
+PROXY_FOLDER_NAME = ".proxies"
+PROXY_SOURCES_FOLDER_NAME = "sources"
+PROXY_SAMPLE_RATE = 16000
+PROXY_DTYPE = np.dtype("<i2")
+
+
+def proxy_store_for(file_path: Path) -> Path:
+    """Returns the proxy store of a fixed or median file, which lives in the quran data folder (reciter/fixed/file)."""
+    return file_path.resolve().parents[2] / PROXY_FOLDER_NAME
+
+
+def source_sidecar_path(store_dir: Path, source_filep: Path) -> Path:
+    """Returns the sidecar of a source file in the store, named by the hash of its resolved path."""
+    path_hash = hashlib.blake2b(str(source_filep.resolve()).encode(), digest_size=16).hexdigest()
+    return store_dir / PROXY_SOURCES_FOLDER_NAME / f"{path_hash}.json"
+
+
+def load_source_sidecar(sidecar_path: Path) -> Dict:
+    """Returns the sidecar entry of a source file, None if the file was never seen."""
+    try:
+        with open(sidecar_path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def write_proxy(source_filep: Path, proxy_path: Path) -> None:
+    """Decodes the source once into a raw 16 kHz mono s16le proxy, written under a temp_ name and renamed."""
+    temp_path = proxy_path.with_name(f"temp_{os.getpid()}_{proxy_path.name}")
+    try:
+        subprocess.run(['ffmpeg', '-y', '-i', str(source_filep), '-map', '0:a:0', '-ac', '1', '-ar', str(PROXY_SAMPLE_RATE),
+                        '-f', 's16le', '-c:a', 'pcm_s16le', str(temp_path)],
+                       check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        os.replace(temp_path, proxy_path)
+    finally:
+        if temp_path.exists():
+            temp_path.unlink()
+
+
+def get_proxy(source_filep: Path, store_dir: Path = None) -> Path:
+    """
+    Returns the proxy of an audio file, writing it first if the store has none for its content.
+
+    Args:
+        source_filep (Path): A fixed or median file.
+        store_dir (Path): The proxy store, see proxy_store_for if None.
+
+    Returns:
+        Path: The raw proxy file, see read_proxy.
+    """
+    if store_dir is None:
+        store_dir = proxy_store_for(source_filep)
+    (store_dir / PROXY_SOURCES_FOLDER_NAME).mkdir(parents=True, exist_ok=True)
+    stat = source_filep.stat()
+    sidecar_path = source_sidecar_path(store_dir, source_filep)
+    entry = load_source_sidecar(sidecar_path)
+    if entry and entry["size"] == stat.st_size and entry["mtime_ns"] == stat.st_mtime_ns:
+        proxy_path = store_dir / f"{entry['hash']}.s16"
+        if proxy_path.exists():
+            return proxy_path
+
+    content_hash = file_hash(source_filep)
+    proxy_path = store_dir / f"{content_hash}.s16"
+    if not proxy_path.exists():
+        write_proxy(source_filep, proxy_path)
+    write_file_atomically(sidecar_path, json.dumps(
+        {"path": str(source_filep.resolve()), "size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "hash": content_hash}))
+    return proxy_path
+
+
+def read_proxy(source_filep: Path) -> np.memmap:
+    """Returns the samples of the proxy of an audio file as a read only memory map, nothing is loaded up front."""
+    proxy_path = get_proxy(source_filep)
+    if proxy_path.stat().st_size == 0:
+        return np.zeros(0, dtype=PROXY_DTYPE)
+    return np.memmap(proxy_path, dtype=PROXY_DTYPE, mode="r")
+
+
+def proxy_duration_s(source_filep: Path) -> float:
+    """Returns the decoded duration of an audio file, from the size of its proxy."""
+    return get_proxy(source_filep).stat().st_size / PROXY_DTYPE.itemsize / PROXY_SAMPLE_RATE
+
+
+def window_rms_db(samples: np.ndarray, window_ms: float = 20.0) -> np.ndarray:
+    """Returns the RMS level in dBFS of consecutive windows of the samples, the last partial window is dropped."""
+    window = int(PROXY_SAMPLE_RATE * window_ms / 1000.0)
+    num_windows = len(samples) // window
+    frames = np.asarray(samples[:num_windows * window], dtype=np.float32).reshape(num_windows, window) / 32768.0
+    rms = np.sqrt(np.mean(frames * frames, axis=1))
+    return 20.0 * np.log10(np.maximum(rms, 1e-6))
+
+
+def proxy_loudness_db(source_filep: Path, block_seconds: float = 60.0) -> float:
+    """Returns the RMS level of a whole file in dBFS, reading the proxy block by block."""
+    samples = read_proxy(source_filep)
+    if len(samples) == 0:
+        return -120.0
+    block = int(block_seconds * PROXY_SAMPLE_RATE)
+    energy = 0.0
+    for start in range(0, len(samples), block):
+        chunk = np.asarray(samples[start:start + block], dtype=np.float64) / 32768.0
+        energy += float(np.dot(chunk, chunk))
+    return 20.0 * np.log10(max(np.sqrt(energy / len(samples)), 1e-6))
+
+
+def detect_silences(
+        source_filep: Path,
+        threshold_db: float = -40.0,
+        min_silence_ms: float = 500.0,
+        window_ms: float = 20.0) -> List[Tuple[float, float]]:
+    """
+    Finds the pauses of a recitation on its proxy.
+
+    Args:
+        source_filep (Path): A fixed or median file.
+        threshold_db (float): Windows below this RMS level in dBFS count as silent.
+        min_silence_ms (float): Minimum length of a pause.
+        window_ms (float): Length of the analysis windows.
+
+    Returns:
+        List[Tuple[float, float]]: (start_ms, end_ms) of every pause.
+    """
+    silent = window_rms_db(read_proxy(source_filep), window_ms) < threshold_db
+    edges = np.diff(np.concatenate(([0], silent.astype(np.int8), [0])))
+    starts = np.flatnonzero(edges == 1)
+    ends = np.flatnonzero(edges == -1)
+    long_enough = (ends - starts) * window_ms >= min_silence_ms
+    return [(float(start * window_ms), float(end * window_ms)) for start, end in zip(starts[long_enough], ends[long_enough])]
@@ -0,0 +1,166 @@
+import logging
+from functools import lru_cache
+from pathlib import Path
+from typing import Dict, List
+
+from pydub import AudioSegment
+
+from codec import get_codec_backend
+from encode_profiles import get_profile, list_audio_files
+from mp3_frames import Mp3FrameIndex, frame_byte_range, index_duration_s, index_mp3_file, index_num_samples
+from processflow import postprocess_file
+from utils import find_median_folder
+
+
+# Frames decoded in front of the requested window. Layer III frames can borrow bits from up to ~511 bytes
+# of the previous frames (bit reservoir), so the first frames of a cut stream do not decode correctly.
+PREROLL_FRAMES = 4
+
+
+@lru_cache(maxsize=256)
+def _cached_frame_index(file_path: str, mtime_ns: int, size: int) -> Mp3FrameIndex:
+    return index_mp3_file(Path(file_path))
+
+
+def get_frame_index(file_path: Path) -> Mp3FrameIndex:
+    """Returns the frame index of an mp3 file, cached as long as the file does not change."""
+    stat = file_path.stat()
+    return _cached_frame_index(str(file_path), stat.st_mtime_ns, stat.st_size)
+
+
+def get_duration_ms(file_path: Path) -> float:
+    """Returns the duration of an audio file, from the frame count for mp3 files and from the codec backend otherwise."""
+    if file_path.suffix == ".mp3":
+        return 1000.0 * index_duration_s(get_frame_index(file_path))
+    return 1000.0 * get_codec_backend().probe(file_path)["duration_s"]
+
+
+def build_sura_timeline(median_folder: Path) -> List[Dict]:
+    """
+    Orders the median files of a reciter one after another on a common timeline.
+
+    Args:
+        median_folder (Path): Folder with the NNN_median files of a reciter.
+
+    Returns:
+        List[Dict]: For each sura in order a dict with "sura", "path", "start_ms" and "duration_ms".
+    """
+    timeline = []
+    current_ms = 0.0
+    for median_file in list_audio_files(median_folder):
+        duration_ms = get_duration_ms(median_file)
+        timeline.append({
+            "sura": int(median_file.stem.split("_")[0]),
+            "path": median_file,
+            "start_ms": current_ms,
+            "duration_ms": duration_ms,
+        })
+        current_ms += duration_ms
+    return timeline
+
+
+def decode_window(file_path: Path, start_ms: float, end_ms: float, preroll_frames: int = PREROLL_FRAMES) -> AudioSegment:
+    """
+    Decodes only the window [start_ms, end_ms) of an audio file.
+    For mp3 files the frames of the window (plus a few pre-roll frames) are cut out of the file and only those bytes are decoded.
+    Other containers are seeked by the codec backend.
+
+    Args:
+        file_path (Path): The audio file.
+        start_ms (float): Start of the window inside the file in milliseconds.
+        end_ms (float): End of the window inside the file in milliseconds.
+        preroll_frames (int): Number of frames decoded before the window and thrown away afterwards.
+
+    Returns:
+        AudioSegment: The decoded window.
+    """
+    window_ms = end_ms - start_ms
+    if file_path.suffix != ".mp3":
+        return get_codec_backend().decode(file_path, start_ms, end_ms)[:int(round(window_ms))]
+
+    index = get_frame_index(file_path)
+    # positions in samples of the gapless decoded file, the way a full decode by any backend counts them
+    start_sample = int(round(start_ms * index.sample_rate / 1000.0))
+    end_sample = min(int(round(end_ms * index.sample_rate / 1000.0)), index_num_samples(index))
+    # the decoder output of a cut frame run starts exactly at its first frame, the delay and padding of the LAME tag
+    # are only dropped when the whole file is decoded
+    stream_start = start_sample + index.start_skip
+    stream_end = end_sample + index.start_skip
+    spf = index.samples_per_frame
+    num_frames = len(index.offsets)
+    first_frame = max(0, stream_start // spf - preroll_frames)
+    end_frame = min(num_frames, -(-stream_end // spf) + 1)
+    if first_frame >= end_frame or start_sample >= end_sample:
+        return AudioSegment.empty()
+
+    byte_start, byte_end = frame_byte_range(index, first_frame, end_frame)
+    with open(file_path, "rb") as file:
+        file.seek(byte_start)
+        chunk = file.read(byte_end - byte_start)
+    window = get_codec_backend().decode_bytes(chunk, "mp3")
+    # cut in samples instead of milliseconds, so windows with a common border join without a gap or an overlap
+    offset = stream_start - first_frame * spf
+    return window.get_sample_slice(offset, offset + end_sample - start_sample)
+
+
+def extract_range(reciter_folder: Path, start_ms: float, end_ms: float, timeline: List[Dict] = None) -> AudioSegment:
+    """
+    Extracts the range [start_ms, end_ms) of the reciters concatenated median files, decoding only the frames of that range.
+    The range may cross the borders between sura files.
+
+    Args:
+        reciter_folder (Path): Folder of the reciter containing the median folder.
+        start_ms (float): Start of the range on the concatenated timeline in milliseconds.
+        end_ms (float): End of the range on the concatenated timeline in milliseconds.
+        timeline (List[Dict]): Timeline from build_sura_timeline, built from the median folder if None.
+
+    Returns:
+        AudioSegment: The audio of the range.
+    """
+    if timeline is None:
+        timeline = build_sura_timeline(find_median_folder(reciter_folder))
+
+    audio = AudioSegment.empty()
+    for sura_entry in timeline:
+        sura_start_ms = sura_entry["start_ms"]
+        sura_end_ms = sura_start_ms + sura_entry["duration_ms"]
+        if sura_end_ms <= start_ms or sura_start_ms >= end_ms:
+            continue
+        window_start_ms = max(start_ms, sura_start_ms) - sura_start_ms
+        window_end_ms = min(end_ms, sura_end_ms) - sura_start_ms
+        audio += decode_window(sura_entry["path"], window_start_ms, window_end_ms)
+    return audio
+
+
+def export_range_for_reciters(
+        quran_data_folder: Path,
+        reciter_names: List[str],
+        start_ms: float,
+        end_ms: float,
+        output_dir: Path,
+        title: str,
+        clip_profile: str = None) -> None:
+    """
+    Exports the same range of the median timeline for multiple reciters into one album folder.
+    Because all median files are normalized to the median speed, the same range contains roughly the same ayat for every reciter.
+
+    Args:
+        quran_data_folder (Path): Path to the main data folder containing reciter subfolders.
+        reciter_names (List[str]): The reciters to export.
+        start_ms (float): Start of the range in milliseconds.
+        end_ms (float): End of the range in milliseconds.
+        output_dir (Path): Folder for the exported files.
+        title (str): Title and album name, e.g. "Pages 515 to 535".
+        clip_profile (str): Name of the encode profile, None for the default profile.
+    """
+    profile = get_profile(clip_profile)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    for reciter_name in reciter_names:
+        try:
+            audio = extract_range(quran_data_folder / reciter_name, start_ms, end_ms)
+        except Exception as e:
+            logging.error(f"Error extracting {title} for {reciter_name}: {e}")
+            continue
+        output_path = output_dir / (f"{title} - {reciter_name}".replace("/", "-") + profile["extension"])
+        get_codec_backend().encode(audio, output_path, profile)
+        postprocess_file(output_path, {"title": title, "album": title, "artist": reciter_name, "genre": "Quran"}, profile["tagging"])
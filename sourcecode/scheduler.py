@@ -0,0 +1,134 @@
+import logging
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
+from pathlib import Path
+from typing import Callable, Dict, List
+
+import psutil
+
+from codec import get_codec_backend
+from range_extract import get_duration_ms, get_frame_index
+
+
+MB = 1024 * 1024
+
+# Peak memory model per processing mode: fixed overhead plus a factor times the decoded PCM size of the input.
+#   pydub  -> the whole sura is decoded into an AudioSegment, slicing and fading create further copies (save_clips_no_concat)
+#   ffmpeg -> ffmpeg streams the file through its filters, memory barely depends on the duration (speedup_audio_ffmpeg)
+#   fused  -> one ffmpeg with a branch and encoder per clip, buffers grow with the number of clips (fused_render)
+MODE_MEMORY = {
+    "pydub": {"base_bytes": 150 * MB, "pcm_factor": 3.0},
+    "ffmpeg": {"base_bytes": 80 * MB, "pcm_factor": 0.0},
+    "fused": {"base_bytes": 120 * MB, "pcm_factor": 0.3},
+}
+
+# decoded 16 bit pcm bytes per second, 44.1 kHz stereo if a job has no probed stream format
+DEFAULT_PCM_BYTES_PER_SECOND = 44100 * 2 * 2
+
+
+def estimate_job_memory(job: Dict) -> int:
+    """
+    Estimates the peak memory of a job in bytes from its probed duration and its processing mode.
+
+    Args:
+        job (Dict): Job with "duration_s" and "mode", optionally "pcm_bytes_per_second".
+
+    Returns:
+        int: The estimated peak memory in bytes.
+    """
+    model = MODE_MEMORY[job["mode"]]
+    pcm_bytes = job["duration_s"] * job.get("pcm_bytes_per_second", DEFAULT_PCM_BYTES_PER_SECOND)
+    return int(model["base_bytes"] + model["pcm_factor"] * pcm_bytes)
+
+
+def probe_pcm_bytes_per_second(file_path: Path) -> int:
+    """Returns the decoded 16 bit pcm bytes per second of an audio file, from the mp3 frame headers or the codec backend."""
+    if file_path.suffix == ".mp3":
+        index = get_frame_index(file_path)
+        sample_rate, channels = index.sample_rate, index.channels
+    else:
+        info = get_codec_backend().probe(file_path)
+        sample_rate, channels = info["sample_rate"], info["channels"]
+    if not sample_rate or not channels:
+        return DEFAULT_PCM_BYTES_PER_SECOND
+    return sample_rate * channels * 2
+
+
+def annotate_audio_jobs(jobs: List[Dict]) -> List[Dict]:
+    """
+    Adds "duration_s", "pcm_bytes_per_second" and "mode" to median and clip jobs of job_queue.
+    The duration and the stream format of the input are probed in-process without decoding.
+    """
+    for job in jobs:
+        if job["stage"] == "median":
+            input_filep, mode = Path(job["fixed_filep"]), "ffmpeg"
+        elif job["stage"] == "clips":
+            input_filep, mode = Path(job["median_file"]), "pydub"
+        else:
+            raise ValueError(F"Unknown job stage '{job['stage']}'.")
+        job["duration_s"] = get_duration_ms(input_filep) / 1000.0
+        job["pcm_bytes_per_second"] = probe_pcm_bytes_per_second(input_filep)
+        job["mode"] = mode
+    return jobs
+
+
+def run_scheduled(
+        jobs: List[Dict],
+        run_job: Callable[[Dict], None],
+        ram_budget_bytes: int = None,
+        max_workers: int = None,
+        memory_pressure_percent: float = 85.0,
+        poll_seconds: float = 1.0) -> None:
+    """
+    Runs the jobs in worker processes, admitting a job only if its estimated memory fits into the remaining RAM budget.
+    Long jobs are started first and short jobs fill the remaining budget around them.
+    No new job is admitted while the system memory usage is above memory_pressure_percent.
+
+    Args:
+        jobs (List[Dict]): The jobs, each with "duration_s" and "mode" (see annotate_audio_jobs) and an "id".
+        run_job (Callable): Picklable function running a single job, e.g. job_queue.run_audio_job.
+        ram_budget_bytes (int): Memory the jobs may use together, 70% of the available memory if None.
+        max_workers (int): Maximum number of parallel jobs, the number of physical cores if None.
+        memory_pressure_percent (float): System memory usage above which the admission backs off.
+        poll_seconds (float): Interval for re-checking the memory pressure.
+    """
+    if ram_budget_bytes is None:
+        ram_budget_bytes = int(0.7 * psutil.virtual_memory().available)
+    if max_workers is None:
+        max_workers = psutil.cpu_count(logical=False) or os.cpu_count() or 1
+
+    pending = sorted(jobs, key=estimate_job_memory, reverse=True)
+    running: Dict[Future, Dict] = {}
+    reserved_bytes = 0
+    print(f"Scheduling {len(pending)} jobs on {max_workers} workers with a budget of {ram_budget_bytes / MB:.0f} MB")
+
+    with ProcessPoolExecutor(max_workers=max_workers) as pool:
+        while pending or running:
+            while pending and len(running) < max_workers:
+                if running and psutil.virtual_memory().percent >= memory_pressure_percent:
+                    # back off until running jobs finish and free their memory
+                    break
+                free_bytes = ram_budget_bytes - reserved_bytes
+                job = next((job for job in pending if estimate_job_memory(job) <= free_bytes), None)
+                if job is None and not running:
+                    # a job above the whole budget still has to run, but alone
+                    job = pending[0]
+                    logging.warning(f"Job {job['id']} needs about {estimate_job_memory(job) / MB:.0f} MB, above the budget. Running it alone.")
+                if job is None:
+                    break
+                pending.remove(job)
+                reserved_bytes += estimate_job_memory(job)
+                running[pool.submit(run_job, job)] = job
+
+            if not running:
+                time.sleep(poll_seconds)
+                continue
+            done, _ = wait(list(running), timeout=poll_seconds, return_when=FIRST_COMPLETED)
+            for future in done:
+                job = running.pop(future)
+                reserved_bytes -= estimate_job_memory(job)
+                try:
+                    future.result()
+                except Exception as e:
+                    logging.error(f"Job {job['id']} failed: {e}")
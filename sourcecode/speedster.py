@@ -2,17 +2,18 @@ import logging
 import math
 import os
 import shutil
-import subprocess
 from pathlib import Path
-from typing import Dict, List
+from typing import Dict, List, Union
 from pandas import DataFrame
-from pydub.utils import mediainfo
+from pydub import AudioSegment
 from tqdm import tqdm
 import gc
 from mutagen.mp3 import MP3
 from mutagen.easyid3 import EasyID3
 import csv
-from utils import load_quran_numbers, set_mp3_title
+from codec import get_codec_backend
+from encode_profiles import get_profile, matches_profile
+from utils import load_quran_numbers, tag_audio_file
 
 
 # read the json file for sura names
@@ -21,120 +22,190 @@ csv_path = script_dir / "quran_numbers.csv"
 NUM_TO_SURA = load_quran_numbers(csv_path)
 
 
-def create_median_length_tracks(rec_folders: List[Path], rec_med_speedup: Dict[str, float]):
+def create_median_length_tracks(
+        rec_folders: List[Path],
+        rec_med_speedup: Dict[str, Union[float, Dict[int, float]]],
+        intermediate_profile: str = None,
+        median_folder_name: str = "median") -> List[Path]:
     """
     Iterates through each recitor in the rec_folders and turns the fixed tracks into median-len tracks based on the reciters speedup factor.
-    Stores the generated audio files with _median suffix in own folder.
+    Stores the generated audio files with _median suffix in own folder, encoded with the intermediate_profile (None for the default profile).
+    Instead of one factor a reciter can have a dict of factors per sura number (see pace.per_sura_speedups), suras without a factor are skipped.
+    Such tracks go to their own median_folder_name (see utils.pace_folder_name), so they never replace the median tracks.
+    A sura which fails does not stop the others, the failed suras are reported at the end.
+
+    Returns:
+        List[Path]: The fixed files whose median track could not be created.
     """
+    profile = get_profile(intermediate_profile)
+    failed_fileps = []
 
     for rec_folder in rec_folders:
-        median_folder = rec_folder / "median"
+        median_folder = rec_folder / median_folder_name
         fixed_folder = rec_folder / "fixed"
         os.makedirs(median_folder, exist_ok=True)
 
         speed_change = rec_med_speedup[rec_folder.stem]
         for fixed_filep in tqdm(sorted(fixed_folder.iterdir()), desc="Creating median suras", unit="sura"):
-            if fixed_filep.stem.endswith("_fixed"):
-                fixed_file_name = fixed_filep.stem # number plus "_fixed" suffix
-                curr_sura_ID = str(fixed_file_name.split("_")[0])
-
-                median_file_name = curr_sura_ID + "_median.mp3"
-                sura_median_filep = median_folder / median_file_name
-                if not sura_median_filep.exists():
-                    speedup_audio_ffmpeg(
-                        input_filep=fixed_filep, 
-                        output_filep=sura_median_filep, 
-                        speed_change=speed_change
-                        )
-                else: # median already exists but may have a different old median
-                    # Check if the existing median file has the correct length
-                    existing_median_len = float(mediainfo(sura_median_filep)['duration'])/60.0
-                    input_file_len = float(mediainfo(fixed_filep)['duration'])/60.0
-                    expected_median_len = input_file_len / speed_change
-
-                    if not math.isclose(existing_median_len, expected_median_len, abs_tol=1e-5):
-                        print(f" - Regenerating {sura_median_filep.name} (existing length: {existing_median_len:.2f}, expected: {expected_median_len:.2f})")
-                        speedup_audio_ffmpeg(
-                            input_filep=fixed_filep, 
-                            output_filep=sura_median_filep, 
-                            speed_change=speed_change
-                            )
-                    else: 
-                        print(f" - Skipping {sura_median_filep.name} (already correct length: {existing_median_len:.2f})")
+            if isinstance(speed_change, dict):
+                sura_speed_change = speed_change.get(int(fixed_filep.stem.split("_")[0]))
+                if sura_speed_change is None:
+                    continue
             else:
-                raise ValueError(F"Unexpected filename: {fixed_filep} does not end with '_fixed'.")
+                sura_speed_change = speed_change
+            try:
+                create_median_track(fixed_filep, median_folder, sura_speed_change, profile)
+            except Exception:
+                # speedup_audio_ffmpeg already logged the error and removed its partial files
+                failed_fileps.append(fixed_filep)
         
         # Memory optimization after processing each reciter
         gc.collect()
 
+    if failed_fileps:
+        print(F" - {len(failed_fileps)} median tracks could not be created:")
+        for failed_filep in failed_fileps:
+            print(F"   {failed_filep.parent.parent.name}/{failed_filep.name}")
+    return failed_fileps
+
+
+def create_median_track(fixed_filep: Path, median_folder: Path, speed_change: float, profile: Dict) -> Path:
+    """
+    Turns a single fixed track into its median-len track, unless a median track with the expected length already exists.
+
+    Returns:
+        Path: The median track.
+    """
+    if not fixed_filep.stem.endswith("_fixed"):
+        raise ValueError(F"Unexpected filename: {fixed_filep} does not end with '_fixed'.")
+
+    fixed_file_name = fixed_filep.stem # number plus "_fixed" suffix
+    curr_sura_ID = str(fixed_file_name.split("_")[0])
+
+    median_file_name = curr_sura_ID + "_median" + profile["extension"]
+    sura_median_filep = median_folder / median_file_name
+    if not sura_median_filep.exists():
+        speedup_audio_ffmpeg(
+            input_filep=fixed_filep, 
+            output_filep=sura_median_filep, 
+            speed_change=speed_change,
+            profile=profile,
+            )
+    else: # median already exists but may have a different old median
+        # Check if the existing median file has the correct length
+        existing_median_len = get_codec_backend().probe(sura_median_filep)['duration_s']/60.0
+        input_file_len = get_codec_backend().probe(fixed_filep)['duration_s']/60.0
+        expected_median_len = input_file_len / speed_change
+
+        if not math.isclose(existing_median_len, expected_median_len, abs_tol=1e-5):
+            print(f" - Regenerating {sura_median_filep.name} (existing length: {existing_median_len:.2f}, expected: {expected_median_len:.2f})")
+            speedup_audio_ffmpeg(
+                input_filep=fixed_filep, 
+                output_filep=sura_median_filep, 
+                speed_change=speed_change,
+                profile=profile,
+                )
+        else: 
+            print(f" - Skipping {sura_median_filep.name} (already correct length: {existing_median_len:.2f})")
+    return sura_median_filep
+
+
+def atempo_filter_chain(speed_change: float) -> str:
+    """
+    Returns the ffmpeg audio filter chain changing the tempo by speed_change.
+    Handles extreme speed changes by chaining atempo filters.
+    """
+    if speed_change < 0.5:
+        # For slowing down (speed_change < 0.5), chain multiple atempo filters
+        # Each atempo can handle 0.5-1.0, so we need multiple steps
+        remaining_factor = speed_change
+        atempo_filters = []
+        
+        while remaining_factor < 0.5:
+            # Use the minimum supported value (0.5) for each step
+            atempo_filters.append("atempo=0.5")
+            remaining_factor /= 0.5
+        
+        # Add the final step
+        if remaining_factor != 1.0:
+            atempo_filters.append(f"atempo={remaining_factor}")
+        
+        filter_chain = ",".join(atempo_filters)
+    elif speed_change > 2.0:
+        # For speeding up (speed_change > 2.0), chain multiple atempo filters
+        # Each atempo can handle 1.0-2.0, so we need multiple steps
+        remaining_factor = speed_change
+        atempo_filters = []
+        
+        while remaining_factor > 2.0:
+            # Use the maximum supported value (2.0) for each step
+            atempo_filters.append("atempo=2.0")
+            remaining_factor /= 2.0
+        
+        # Add the final step
+        if remaining_factor != 1.0:
+            atempo_filters.append(f"atempo={remaining_factor}")
+        
+        filter_chain = ",".join(atempo_filters)
+    else:
+        # Normal case: speed_change is within 0.5-2.0 range
+        filter_chain = f"atempo={speed_change}"
+    return filter_chain
+
+
+def speedup_segment(segment: AudioSegment, speed_change: float) -> AudioSegment:
+    """
+    Changes the tempo of an in-memory audio segment with the codec backend, without any temporary files.
+
+    Args:
+        segment (AudioSegment): The audio to speed up.
+        speed_change (float): The factor by which to change the playback speed.
+
+    Returns:
+        AudioSegment: The audio with the new tempo.
+    """
+    if math.isclose(speed_change, 1.0, abs_tol=1e-5) or len(segment) == 0:
+        return segment
+    return get_codec_backend().filter_segment(segment, atempo_filter_chain(speed_change))
 
 
-def speedup_audio_ffmpeg(input_filep: Path, output_filep: Path, speed_change: float) -> None:
+def speedup_audio_ffmpeg(input_filep: Path, output_filep: Path, speed_change: float, profile: Dict = None) -> None:
     """
     Speed up the audio file using ffmpeg.
+    The output is written to a temp_ file first and renamed at the end, so a partial output file is never visible.
+    On an error the temp_ files are removed and the error is raised again.
 
     Args:
         input_path (Path): Path to the input audio file.
         file_output_path (Path): Path to the output audio file.
         speed_change (float): The factor by which to change the playback speed. Range 0.5 (slow down) to 100.0 (speed up).
+        profile (Dict): The encode profile of the output file, None for the default profile.
 
     Returns:
         None
     """
+    if profile is None:
+        profile = get_profile()
+    backend = get_codec_backend()
+    partial_filep = output_filep.with_name("temp_" + output_filep.name)
     try:
-        if not math.isclose(speed_change, 1.0, abs_tol=1e-5):
+        # A plain copy is only possible if the input already is encoded like the profile
+        if not math.isclose(speed_change, 1.0, abs_tol=1e-5) or not matches_profile(input_filep, backend.probe(input_filep), profile):
             print(F"\n - Speeding up {input_filep.parent.parent.stem}/{input_filep.parent.stem}/{input_filep.stem} with factor {speed_change:.2f}.")
             
             # Get original duration for metadata verification
-            original_info = mediainfo(input_filep)
-            original_duration = float(original_info['duration'])
+            original_info = backend.probe(input_filep)
+            original_duration = original_info['duration_s']
             expected_duration = original_duration / speed_change
             
-            # Handle extreme speed changes by chaining atempo filters
-            if speed_change < 0.5:
-                # For slowing down (speed_change < 0.5), chain multiple atempo filters
-                # Each atempo can handle 0.5-1.0, so we need multiple steps
-                remaining_factor = speed_change
-                atempo_filters = []
-                
-                while remaining_factor < 0.5:
-                    # Use the minimum supported value (0.5) for each step
-                    atempo_filters.append("atempo=0.5")
-                    remaining_factor /= 0.5
-                
-                # Add the final step
-                if remaining_factor != 1.0:
-                    atempo_filters.append(f"atempo={remaining_factor}")
-                
-                filter_chain = ",".join(atempo_filters)
-            elif speed_change > 2.0:
-                # For speeding up (speed_change > 2.0), chain multiple atempo filters
-                # Each atempo can handle 1.0-2.0, so we need multiple steps
-                remaining_factor = speed_change
-                atempo_filters = []
-                
-                while remaining_factor > 2.0:
-                    # Use the maximum supported value (2.0) for each step
-                    atempo_filters.append("atempo=2.0")
-                    remaining_factor /= 2.0
-                
-                # Add the final step
-                if remaining_factor != 1.0:
-                    atempo_filters.append(f"atempo={remaining_factor}")
-                
-                filter_chain = ",".join(atempo_filters)
-            else:
-                # Normal case: speed_change is within 0.5-2.0 range
-                filter_chain = f"atempo={speed_change}"
+            filter_chain = atempo_filter_chain(speed_change)
             
             # Process the audio with speed change
-            subprocess.run([
-                'ffmpeg', '-y', '-i', str(input_filep), '-filter:a', filter_chain, '-c:a', 'mp3', '-b:a', '128k', str(output_filep)
-            ], check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            backend.transcode(input_filep, partial_filep, profile, filter_chain)
             
             # Verify and fix metadata if needed
-            actual_info = mediainfo(output_filep)
-            actual_duration = float(actual_info['duration'])
+            actual_info = backend.probe(partial_filep)
+            actual_duration = actual_info['duration_s']
             final_info = None
             
             # Check if duration metadata is correct (within 1 second tolerance)
@@ -143,19 +214,16 @@ def speedup_audio_ffmpeg(input_filep: Path, output_filep: Path, speed_change: fl
                 print(f"   Fixing metadata...")
                 
                 # Re-encode with explicit duration metadata
-                temp_output = output_filep.with_suffix('.temp.mp3')
-                shutil.move(output_filep, temp_output)
+                temp_output = output_filep.with_name("temp_meta_" + output_filep.name)
+                shutil.move(partial_filep, temp_output)
                 
-                subprocess.run([
-                    'ffmpeg', '-y', '-i', str(temp_output), '-c:a', 'mp3', '-b:a', '128k',
-                    '-metadata', f'duration={expected_duration}', str(output_filep)
-                ], check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+                backend.transcode(temp_output, partial_filep, profile, extra_args=['-metadata', f'duration={expected_duration}'])
                 
                 temp_output.unlink()
                 
                 # Verify the fix worked
-                final_info = mediainfo(output_filep)
-                final_duration = float(final_info['duration'])
+                final_info = backend.probe(partial_filep)
+                final_duration = final_info['duration_s']
                 if math.isclose(final_duration, expected_duration, abs_tol=1.0):
                     print(f"   Metadata fixed: duration now correct at {final_duration:.1f}s")
                 else:
@@ -166,7 +234,8 @@ def speedup_audio_ffmpeg(input_filep: Path, output_filep: Path, speed_change: fl
             # Set the track title using sura name from CSV
             sura_id = int(output_filep.stem[:3])
             sura_name = NUM_TO_SURA.get(sura_id, f"Sura {sura_id:03d}")
-            set_mp3_title(output_filep, sura_name)
+            tag_audio_file(partial_filep, {"title": sura_name}, profile["tagging"])
+            os.replace(partial_filep, output_filep)
             
             # Memory optimization - free large variables (only delete if they exist)
             del original_info, actual_info
@@ -176,6 +245,12 @@ def speedup_audio_ffmpeg(input_filep: Path, output_filep: Path, speed_change: fl
             
         else:
             # print(F"\n - Copying {input_filep.parent.stem}/{input_filep.name} to {output_filep.parent.stem}/{output_filep.name}, because speedup factor is 1.0.")
-            shutil.copy(input_filep, output_filep)
-    except subprocess.CalledProcessError as e:
-        logging.error(f"Error speeding up {input_filep.parent.stem}/{input_filep.stem} with ffmpeg:\n{e}")
\ No newline at end of file
+            shutil.copy(input_filep, partial_filep)
+            os.replace(partial_filep, output_filep)
+    except Exception as e:
+        logging.error(f"Error speeding up {input_filep.parent.stem}/{input_filep.stem} with the {get_codec_backend().name} codec backend:\n{e}")
+        # remove the partial outputs, the caller has to know that the median track is missing
+        for leftover_filep in (partial_filep, output_filep.with_name("temp_meta_" + output_filep.name)):
+            if leftover_filep.exists():
+                leftover_filep.unlink()
+        raise
\ No newline at end of file
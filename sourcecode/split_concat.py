@@ -4,6 +4,8 @@ from typing import List, Dict, Tuple
 import logging
 
 from audio import preprocess_audio_files
+from codec import get_codec_backend
+from timeline import VirtualTimeline
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
@@ -34,7 +36,7 @@ def postprocess_combined_audio(combined_audio: AudioSegment, combined_path: Path
     speedup_audio_ffmpeg(temp_combined_audio_path, temp_output_audio_path, speed_change)
     
     # Load the sped-up audio back into an AudioSegment
-    combined_audio = AudioSegment.from_mp3(temp_output_audio_path)
+    combined_audio = get_codec_backend().decode(temp_output_audio_path)
 
     # Adjust sura start times according to the speed change
     adjusted_sura_start_times = {sura: int(start_time / speed_change) for sura, start_time in sura_start_times.items()}
@@ -62,7 +64,7 @@ def concatenate_audio_files(file_list: List[Path], desired_length_minutes: int,
     for file in file_list:
         sura_number = file.stem
         try:
-            sura_audio = AudioSegment.from_mp3(file)
+            sura_audio = get_codec_backend().decode(file)
             sura_audio = preprocess_audio_files(sura_audio)
         except Exception as e:
             logging.error(f"Error loading {file}: {e}")
@@ -76,6 +78,25 @@ def concatenate_audio_files(file_list: List[Path], desired_length_minutes: int,
     combined, sura_start_times, speedup_factor = postprocess_combined_audio(combined, ouput_path, sura_start_times, desired_length_minutes=desired_length_minutes)
     return combined, sura_start_times, speedup_factor
 
+def build_virtual_timeline(file_list: List[Path], desired_length_minutes: int) -> Tuple[VirtualTimeline, Dict[int, int], float]:
+    """
+    Lazy counterpart of concatenate_audio_files: lays the MP3 files on a virtual timeline which is sped up to the desired length.
+    Neither the combined audio nor the sped up combined audio is ever materialized, spans are only decoded when a clip is cut.
+    Unlike concatenate_audio_files the suras are not peak normalized, because that would require decoding every sura completely.
+
+    Args:
+        file_list (List[Path]): List of file paths to the MP3 files in playback order.
+        desired_length_minutes (int): The desired total length of the timeline in minutes.
+
+    Returns:
+        Tuple[VirtualTimeline, Dict[int, int], float]: The timeline, the sura start times in milliseconds and the speed change.
+    """
+    timeline = VirtualTimeline(file_list)
+    desired_length_ms = desired_length_minutes * 60 * 1000
+    timeline.speed_change = timeline.source_length_ms / desired_length_ms
+    logging.info(f"Virtual timeline of {len(file_list)} suras, {timeline.source_length_ms / 3600000:.2f} h sped up by {timeline.speed_change:.2f}")
+    return timeline, timeline.sura_start_times, timeline.speed_change
+
 def get_sura_length_ms(sura_number: str, input_dir: Path, speedup_factor:float) -> int:
     """
     Gets the length of a sura audio file in milliseconds.
@@ -89,7 +110,7 @@ def get_sura_length_ms(sura_number: str, input_dir: Path, speedup_factor:float)
     """
     sura_file = input_dir / f"{sura_number:03d}_median.mp3"
     try:
-        sura_audio = AudioSegment.from_mp3(sura_file)
+        sura_audio = get_codec_backend().decode(sura_file)
         return len(sura_audio) / speedup_factor
     except Exception as e:
         logging.error(f"Error loading {sura_file}: {e}")
@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# the modules of sourcecode import each other by their plain names, like main.py does
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
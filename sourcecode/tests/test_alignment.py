@@ -0,0 +1,77 @@
+import shutil
+import subprocess
+
+import numpy as np
+import pytest
+
+from alignment import N_MELS, align_features, banded_dtw, get_features
+
+
+def _smooth_features(times: np.ndarray, seed: int = 0) -> np.ndarray:
+    """Unit length feature frames which are a smooth random function of the (fractional) source frame time."""
+    rng = np.random.default_rng(seed)
+    frequencies = rng.uniform(0.01, 0.15, size=(3, N_MELS))
+    phases = rng.uniform(0.0, 2 * np.pi, size=(3, N_MELS))
+    features = sum(np.sin(2 * np.pi * frequencies[k] * times[:, None] + phases[k]) for k in range(3))
+    features += 0.05 * rng.standard_normal(features.shape)
+    features -= features.mean(axis=0)
+    return (features / np.linalg.norm(features, axis=1, keepdims=True)).astype(np.float32)
+
+
+def _warped_pair(num_ref: int, seed: int = 0):
+    """
+    Returns reference features, query features of the same content with a tempo drifting between 0.7x and 1.4x,
+    and the true query frame of every reference frame.
+    """
+    rng = np.random.default_rng(seed + 1)
+    # local tempo (reference frames per query frame), changing smoothly every few seconds
+    knots = rng.uniform(0.7, 1.4, size=num_ref // 200 + 2)
+    tempo = np.interp(np.arange(2 * num_ref), np.linspace(0, 2 * num_ref, len(knots)), knots)
+    query_times = np.concatenate(([0.0], np.cumsum(tempo)))
+    query_times = query_times[query_times <= num_ref - 1]
+    ref_times = np.arange(num_ref, dtype=np.float64)
+    true_query_frames = np.interp(ref_times, query_times, np.arange(len(query_times)))
+    return _smooth_features(ref_times, seed), _smooth_features(query_times, seed), true_query_frames
+
+
+def _assert_valid_path(path: np.ndarray, num_ref: int, num_query: int, true_query_frames: np.ndarray, max_error: float):
+    assert tuple(path[0]) == (0, 0)
+    assert tuple(path[-1]) == (num_ref - 1, num_query - 1)
+    steps = np.diff(path, axis=0)
+    assert {tuple(step) for step in steps} <= {(1, 1), (1, 2), (2, 1)}
+    errors = np.abs(path[:, 1] - true_query_frames[path[:, 0]])
+    assert errors.max() <= max_error
+
+
+def test_banded_dtw_follows_a_tempo_change():
+    ref, query, true_query_frames = _warped_pair(800)
+    slope = (len(query) - 1) / (len(ref) - 1)
+    path = banded_dtw(ref, query, band_frames=150, slope=slope)
+    _assert_valid_path(path, len(ref), len(query), true_query_frames, max_error=4)
+
+
+def test_align_features_joins_chunks_without_losing_the_path():
+    ref, query, true_query_frames = _warped_pair(2500, seed=3)
+    # small chunks, so the path crosses several chunk anchors
+    path = align_features(ref, query, chunk_frames=400, band_frames=150)
+    assert path.dtype == np.int32
+    _assert_valid_path(path, len(ref), len(query), true_query_frames, max_error=4)
+
+
+def test_banded_dtw_reports_a_too_narrow_band():
+    ref, query, _ = _warped_pair(400)
+    with pytest.raises(ValueError):
+        banded_dtw(ref, query[:150], band_frames=5, slope=1.0)
+
+
+@pytest.mark.skipif(shutil.which("ffmpeg") is None, reason="needs ffmpeg")
+def test_cached_features_equal_fresh_features(tmp_path):
+    fixed_folder = tmp_path / "Reciter" / "fixed"
+    fixed_folder.mkdir(parents=True)
+    source_file = fixed_folder / "001_fixed.mp3"
+    subprocess.run(["ffmpeg", "-v", "error", "-f", "lavfi", "-i", "sine=f=440:d=3", "-b:a", "64k", str(source_file)], check=True)
+
+    fresh = get_features(source_file)
+    cached = get_features(source_file)
+    assert fresh.dtype == cached.dtype == np.float32
+    assert np.array_equal(fresh, cached)
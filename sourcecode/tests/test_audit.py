@@ -0,0 +1,57 @@
+import importlib.util
+import shutil
+import subprocess
+
+import mutagen
+import pytest
+
+from audit import audit_clip_library
+from utils import clip_folder_name, split_all_median_files_to_clips
+
+pytestmark = pytest.mark.skipif(shutil.which("ffmpeg") is None or (shutil.which("ffprobe") is None and importlib.util.find_spec("av") is None),
+                                reason="needs ffmpeg and ffprobe or PyAV")
+
+CLIP_ARGS = {"clip_length_ms": 2000, "overlap_ms": 0, "speedup_factor": 1.0, "clip_folder_prefix": "test_"}
+
+
+def _sine(path, seconds):
+    subprocess.run(["ffmpeg", "-y", "-v", "error", "-f", "lavfi", "-i", f"sine=f=440:d={seconds}", "-ac", "2", "-ar", "44100",
+                    "-b:a", "128k", str(path)], check=True)
+
+
+def _audit(quran_data_folder):
+    return audit_clip_library(quran_data_folder, [quran_data_folder / "Reciter"], max_workers=2, **CLIP_ARGS)
+
+
+def test_audit_classifies_missing_orphaned_and_mistagged_clips(tmp_path):
+    median_folder = tmp_path / "Reciter" / "median"
+    median_folder.mkdir(parents=True)
+    # 3.98 s end 20 ms before a third clip, the mp3 header length with the encoder delay and padding goes beyond 4 s
+    _sine(median_folder / "001_median.mp3", 3.98)
+    _sine(median_folder / "002_median.mp3", 5)
+    split_all_median_files_to_clips(tmp_path, fade_duration=400, metadata=None, **CLIP_ARGS)
+    clip_folder = tmp_path / "Reciter" / clip_folder_name("Reciter", 1.0, "test_")
+    clips = sorted(clip_folder.iterdir())
+    assert len(clips) == 2 + 3
+
+    assert _audit(tmp_path) == {"missing": [], "truncated": [], "mistagged": [], "orphaned": [], "unreadable": []}
+
+    missing_clip, mistagged_clip, truncated_clip = clips[0], clips[1], clips[2]
+    missing_clip.unlink()
+    tags = mutagen.File(mistagged_clip, easy=True)
+    tags["title"] = "Al-Fatiha"
+    tags.save()
+    _sine(truncated_clip, 0.5)
+    orphaned_files = [clip_folder / f"temp_{clips[3].name}", clip_folder / clips[4].name.replace("CLP003", "CLP004")]
+    for orphaned_file in orphaned_files:
+        shutil.copy(clips[4], orphaned_file)
+
+    report = _audit(tmp_path)
+    assert report["missing"] == [str(missing_clip)]
+    assert [entry["path"] for entry in report["truncated"]] == [str(truncated_clip)]
+    # the clip written over with a short file has lost its tags as well
+    assert [entry["path"] for entry in report["mistagged"]] == [str(mistagged_clip), str(truncated_clip)]
+    assert report["mistagged"][0]["tags"] == {"title": {"found": "Al-Fatiha", "expected": "Al-Fatihah (the Opening) - C002 S1.00"}}
+    assert report["orphaned"] == sorted(str(orphaned_file) for orphaned_file in orphaned_files)
+    assert report["unreadable"] == []
+    assert (tmp_path / "audit_report.json").exists()
@@ -0,0 +1,184 @@
+import importlib.util
+import io
+import json
+import shutil
+import subprocess
+import threading
+import urllib.error
+import urllib.request
+from urllib.parse import quote
+from http.server import ThreadingHTTPServer
+
+import pytest
+from pydub import AudioSegment
+
+from clip_server import ClipCache, ClipRequestHandler, ClipService, MAX_TIMELINES
+
+
+def _put(cache, key, num_bytes):
+    cache.temp_path(key).write_bytes(b"x" * num_bytes)
+    cache.put(key)
+
+
+def test_cache_evicts_the_least_recently_used_files(tmp_path):
+    cache = ClipCache(tmp_path / "cache", max_bytes=3000)
+    for key in ("a", "b", "c"):
+        _put(cache, key, 1000)
+    cache.open("a").close()
+
+    _put(cache, "d", 1000)
+    assert list(cache.entries) == ["c", "a", "d"]
+    assert not (tmp_path / "cache" / "b").exists()
+    assert cache.open("b") is None
+    assert cache.total_bytes == 3000
+
+    # a file opened for a client stays readable when it is evicted before it is sent
+    cache_file = cache.open("c")
+    cache.open("a").close()
+    cache.open("d").close()
+    _put(cache, "e", 2000)
+    assert list(cache.entries) == ["d", "e"]
+    assert cache.open("c") is None
+    with cache_file:
+        assert cache_file.read() == b"x" * 1000
+
+    # the access order survives a restart
+    assert list(ClipCache(tmp_path / "cache", max_bytes=3000).entries) == list(cache.entries)
+
+
+@pytest.fixture
+def clip_server(tmp_path):
+    """Serves a reciter with two short median files and returns the base url and the service."""
+    if shutil.which("ffmpeg") is None:
+        pytest.skip("needs ffmpeg with libmp3lame")
+    median_folder = tmp_path / "Reciter" / "median"
+    median_folder.mkdir(parents=True)
+    for sura_num, seconds in ((1, 8), (2, 5)):
+        subprocess.run(["ffmpeg", "-v", "error", "-f", "lavfi", "-i", f"sine=f=440:d={seconds}", "-ac", "2", "-ar", "44100",
+                        "-b:a", "128k", str(median_folder / f"{sura_num:03d}_median.mp3")], check=True)
+
+    service = ClipService(tmp_path, cache_max_bytes=10 * 1024**2)
+    handler = type("TestHandler", (ClipRequestHandler,), {"service": service, "log_message": lambda *args: None})
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_address[1]}", service
+    server.shutdown()
+    server.server_close()
+
+
+def _get(url):
+    try:
+        with urllib.request.urlopen(url, timeout=60) as response:
+            return response.status, response.read()
+    except urllib.error.HTTPError as e:
+        return e.code, e.read()
+
+
+def _stub_render(service, release_render=None):
+    """Replaces the render of the service by one which writes a fixed body, and returns the list of rendered keys."""
+    renders = []
+
+    def render(key, timeline, start_ms, end_ms, fade_ms, duck, profile, write_chunk):
+        renders.append(key)
+        if release_render is not None:
+            release_render.wait(timeout=30)
+        body = f"{start_ms:.0f}-{end_ms:.0f} ".encode() * 1000
+        service.cache.temp_path(key).write_bytes(body)
+        write_chunk(body)
+        service.cache.put(key)
+        service.render_seconds.append(0.01)
+
+    service.render = render
+    return renders
+
+
+def _decode(mp3_bytes) -> AudioSegment:
+    wav = subprocess.run(["ffmpeg", "-v", "error", "-f", "mp3", "-i", "pipe:0", "-f", "wav", "pipe:1"], input=mp3_bytes,
+                         check=True, stdout=subprocess.PIPE).stdout
+    return AudioSegment.from_wav(io.BytesIO(wav))
+
+
+def test_hits_misses_and_render_times_are_counted(clip_server):
+    base_url, service = clip_server
+    renders = _stub_render(service)
+    status, body = _get(f"{base_url}/clip?reciter=Reciter&sura=1&clip=1")
+    assert status == 200
+    assert _get(f"{base_url}/clip?reciter=Reciter&sura=1&clip=1") == (200, body)
+    assert _get(f"{base_url}/clip?reciter=Reciter&sura=2")[0] == 200
+    assert len(renders) == 2
+
+    status, body = _get(f"{base_url}/metrics")
+    metrics = json.loads(body)
+    assert (metrics["requests"], metrics["hits"], metrics["misses"], metrics["coalesced"], metrics["errors"]) == (3, 1, 2, 0, 0)
+    assert metrics["hit_rate"] == pytest.approx(1 / 3)
+    assert metrics["renders"] == 2
+    assert metrics["render_seconds_mean"] == metrics["render_seconds_p50"] == metrics["render_seconds_p95"] == 0.01
+    assert metrics["cache_files"] == 2 and metrics["cache_bytes"] == service.cache.total_bytes > 0
+
+
+@pytest.mark.skipif(shutil.which("ffprobe") is None and importlib.util.find_spec("av") is None,
+                    reason="decoding the median files needs ffprobe or PyAV")
+def test_streamed_clip_has_the_length_of_the_range(clip_server):
+    base_url, service = clip_server
+    status, body = _get(f"{base_url}/clip?reciter=Reciter&sura=1&speed=2&preset=plain")
+    assert status == 200
+    # 8 s at double speed, the decoder adds its delay
+    assert abs(len(_decode(body)) - 4000) < 100
+    assert _get(f"{base_url}/clip?reciter=Reciter&sura=1&speed=2&preset=plain") == (200, body)
+    assert service.metrics_report()["renders"] == 1
+
+
+def test_concurrent_requests_share_one_render(clip_server):
+    base_url, service = clip_server
+    release_render = threading.Event()
+    renders = _stub_render(service, release_render)
+    results = []
+    url = f"{base_url}/clip?reciter=Reciter&sura=2&clip=1"
+    clients = [threading.Thread(target=lambda: results.append(_get(url))) for _ in range(4)]
+    for client in clients:
+        client.start()
+    # the render is held until every later client waits for it
+    while service.metrics["misses"] + service.metrics["coalesced"] < 4:
+        threading.Event().wait(0.01)
+    release_render.set()
+    for client in clients:
+        client.join(timeout=60)
+
+    assert len(renders) == 1
+    assert len(results) == 4 and all(result == results[0] for result in results)
+    assert results[0][0] == 200
+    assert (service.metrics["misses"], service.metrics["coalesced"]) == (1, 3)
+
+
+def test_bad_requests_and_failed_renders(clip_server):
+    base_url, service = clip_server
+    for query in ("sura=1&speed=0", "sura=1&speed=-1", "sura=1&speed=nan", "sura=1&speed=inf", "sura=1&clip=x",
+                  "start_page=5&end_page=3", "start_page=0&end_page=1", "start_page=1&end_page=9999"):
+        assert _get(f"{base_url}/clip?reciter=Reciter&{query}")[0] == 400
+    # the reciter only has the first two suras
+    assert _get(f"{base_url}/clip?reciter=Reciter&start_page=100&end_page=101")[0] == 404
+    assert _get(f"{base_url}/clip?reciter=Reciter&sura=3")[0] == 404
+    assert _get(f"{base_url}/clip?reciter=Nobody&sura=1")[0] == 404
+    # names which leave the data folder are unknown reciters
+    outside_median = service.quran_data_folder.parent / "outside" / "median"
+    outside_median.mkdir(parents=True)
+    shutil.copy(service.quran_data_folder / "Reciter" / "median" / "001_median.mp3", outside_median)
+    for reciter in ("..", ".", "../outside", "Reciter/../../outside", quote(str(outside_median.parent))):
+        assert _get(f"{base_url}/clip?reciter={reciter}&sura=1")[0] == 404
+
+    def failing_render(*args):
+        raise RuntimeError("no encoder")
+
+    service.render = failing_render
+    status, body = _get(f"{base_url}/clip?reciter=Reciter&sura=1")
+    assert status == 500 and b"no encoder" in body
+    assert not service.in_flight
+
+
+def test_timelines_are_bounded(clip_server):
+    _, service = clip_server
+    for step in range(MAX_TIMELINES + 5):
+        service.get_timeline("Reciter", 1.0 + step / 100)
+    assert len(service.timelines) == MAX_TIMELINES
+    assert ("Reciter", 1.0) not in service.timelines
@@ -0,0 +1,88 @@
+import importlib.util
+import shutil
+
+import numpy as np
+import pytest
+from pydub import AudioSegment
+from pydub.generators import Sine, WhiteNoise
+
+from codec import PyAVBackend, SubprocessBackend
+from encode_profiles import get_profile
+
+# the subprocess backend encodes and filters with ffmpeg alone, probing and decoding through pydub also needs ffprobe
+pytestmark = [pytest.mark.skipif(shutil.which("ffmpeg") is None, reason="needs ffmpeg"),
+              pytest.mark.skipif(importlib.util.find_spec("av") is None, reason="needs PyAV")]
+needs_ffprobe = pytest.mark.skipif(shutil.which("ffprobe") is None, reason="the subprocess backend probes and decodes with ffprobe")
+
+PROFILES = ["mp3_128k", "mp3_64k_mono", "opus_32k"]
+
+
+def _segment(seconds=3) -> AudioSegment:
+    tone = Sine(440).to_audio_segment(duration=seconds * 1000)
+    return tone.overlay(WhiteNoise().to_audio_segment(duration=seconds * 1000, volume=-30)).set_channels(2)
+
+
+def _samples(segment) -> np.ndarray:
+    return np.array(segment.get_array_of_samples(), dtype=np.int32).reshape(-1, segment.channels)
+
+
+def _assert_same_stream(info, other_info, profile):
+    assert (info["sample_rate"], info["channels"]) == (other_info["sample_rate"], other_info["channels"]) == \
+        (profile["sample_rate"], profile["channels"])
+    assert info["duration_s"] == pytest.approx(other_info["duration_s"], abs=0.05)
+    assert info["bit_rate"] == pytest.approx(other_info["bit_rate"], rel=0.1)
+
+
+@pytest.mark.parametrize("profile_name", PROFILES)
+def test_backends_encode_the_same_stream(tmp_path, profile_name):
+    profile = get_profile(profile_name)
+    pyav_backend = PyAVBackend()
+    encoded = {}
+    for backend in (SubprocessBackend(), pyav_backend):
+        encoded[backend.name] = tmp_path / f"{backend.name}{profile['extension']}"
+        backend.encode(_segment(), encoded[backend.name], profile)
+
+    infos = {name: pyav_backend.probe(file_path) for name, file_path in encoded.items()}
+    _assert_same_stream(infos["subprocess"], infos["pyav"], profile)
+    assert infos["pyav"]["duration_s"] == pytest.approx(3.0, abs=0.1)
+    lengths = [len(pyav_backend.decode(file_path)) for file_path in encoded.values()]
+    assert lengths[0] == pytest.approx(lengths[1], abs=30)
+
+
+def test_backends_filter_and_transcode_alike(tmp_path):
+    pyav_backend = PyAVBackend()
+    segment = _segment()
+    faster = [backend.filter_segment(segment, "atempo=1.5") for backend in (SubprocessBackend(), pyav_backend)]
+    assert (faster[0].frame_rate, faster[0].channels) == (faster[1].frame_rate, faster[1].channels) == (segment.frame_rate, 2)
+    assert len(faster[0]) == pytest.approx(len(faster[1]), abs=30)
+    assert len(faster[1]) == pytest.approx(2000, abs=30)
+
+    # the in-memory encode gives the stream of the file encode
+    source = tmp_path / "source.mp3"
+    source.write_bytes(SubprocessBackend().encode_bytes(segment, get_profile("mp3_128k")))
+    assert pyav_backend.probe(source)["duration_s"] == pytest.approx(3.0, abs=0.1)
+    profile = get_profile("mp3_64k_mono")
+    transcoded = {}
+    for backend in (SubprocessBackend(), pyav_backend):
+        transcoded[backend.name] = tmp_path / f"{backend.name}_transcoded.mp3"
+        backend.transcode(source, transcoded[backend.name], profile, filter_chain="atempo=1.5")
+    _assert_same_stream(pyav_backend.probe(transcoded["subprocess"]), pyav_backend.probe(transcoded["pyav"]), profile)
+
+
+@needs_ffprobe
+@pytest.mark.parametrize("profile_name", PROFILES)
+def test_backends_probe_and_decode_alike(tmp_path, profile_name):
+    profile = get_profile(profile_name)
+    file_path = tmp_path / f"sura{profile['extension']}"
+    SubprocessBackend().encode(_segment(), file_path, profile)
+    _assert_same_stream(SubprocessBackend().probe(file_path), PyAVBackend().probe(file_path), profile)
+
+    subprocess_audio, pyav_audio = SubprocessBackend().decode(file_path), PyAVBackend().decode(file_path)
+    assert (subprocess_audio.frame_rate, subprocess_audio.channels) == (pyav_audio.frame_rate, pyav_audio.channels)
+    if profile["format"] == "mp3":
+        # both decode gapless with the same libav decoder
+        assert np.array_equal(_samples(subprocess_audio), _samples(pyav_audio))
+    else:
+        assert len(subprocess_audio) == pytest.approx(len(pyav_audio), abs=30)
+    window = [backend.decode(file_path, 1000, 2000) for backend in (SubprocessBackend(), PyAVBackend())]
+    assert len(window[0]) == pytest.approx(len(window[1]), abs=30)
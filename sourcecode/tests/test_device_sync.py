@@ -0,0 +1,36 @@
+from device_sync import load_device_manifest, sync_clip_folders
+
+
+def _make_clip_folder(root, name, num_clips):
+    folder = root / name
+    folder.mkdir(parents=True)
+    for clip_num in range(1, num_clips + 1):
+        (folder / f"001_{clip_num:02d}.mp3").write_bytes(bytes([clip_num]) * 1000)
+    return folder
+
+
+def test_sync_of_a_subset_keeps_the_other_folders(tmp_path):
+    source_dir, device_dir = tmp_path / "source", tmp_path / "device"
+    folder_a = _make_clip_folder(source_dir, "clips A", 3)
+    folder_b = _make_clip_folder(source_dir, "clips B", 2)
+    assert sync_clip_folders([folder_a, folder_b], device_dir)["copied"] == 5
+
+    # only folder A is synced, one of its clips is no longer generated and folder B is left alone
+    (folder_a / "001_03.mp3").unlink()
+    stats = sync_clip_folders([folder_a], device_dir)
+    assert stats == {"copied": 0, "deleted": 1, "copied_bytes": 0}
+    assert sorted(path.name for path in (device_dir / "clips B").iterdir()) == ["001_01.mp3", "001_02.mp3"]
+    assert "clips B/001_01.mp3" in load_device_manifest(device_dir)["files"]
+    assert not (device_dir / "clips A" / "001_03.mp3").exists()
+
+
+def test_missing_source_folder_is_not_emptied_on_the_device(tmp_path):
+    source_dir, device_dir = tmp_path / "source", tmp_path / "device"
+    folder_a = _make_clip_folder(source_dir, "clips A", 2)
+    sync_clip_folders([folder_a], device_dir)
+
+    moved_folder = folder_a.rename(source_dir / "elsewhere")
+    assert sync_clip_folders([folder_a], device_dir)["deleted"] == 0
+    assert len(list((device_dir / "clips A").iterdir())) == 2
+    moved_folder.rename(folder_a)
+    assert sync_clip_folders([folder_a], device_dir) == {"copied": 0, "deleted": 0, "copied_bytes": 0}
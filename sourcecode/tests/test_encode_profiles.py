@@ -0,0 +1,50 @@
+import importlib.util
+import shutil
+import subprocess
+
+import mutagen
+import pytest
+from pydub.generators import Sine
+
+from codec import get_codec_backend
+from encode_profiles import ENCODE_PROFILES, get_profile, list_audio_files, with_profile_extension
+from utils import tag_audio_file
+
+
+def _has_encoder(codec):
+    if shutil.which("ffmpeg") is None or (shutil.which("ffprobe") is None and importlib.util.find_spec("av") is None):
+        return False
+    encoders = subprocess.run(["ffmpeg", "-hide_banner", "-encoders"], check=True, stdout=subprocess.PIPE, text=True).stdout
+    return any(line.split()[1:2] == [codec] for line in encoders.splitlines())
+
+
+@pytest.mark.parametrize("profile_name", sorted(ENCODE_PROFILES))
+def test_profiles_write_files_with_their_extension_and_tags(tmp_path, profile_name):
+    profile = get_profile(profile_name)
+    if not _has_encoder(profile["codec"]):
+        pytest.skip(f"the ffmpeg build has no {profile['codec']} encoder")
+    output_path = with_profile_extension(tmp_path / "001_fixed.wav", profile)
+    assert output_path.name == "001_fixed" + profile["extension"]
+
+    backend = get_codec_backend()
+    backend.encode(Sine(440).to_audio_segment(duration=2000).set_channels(2), output_path, profile)
+    metadata = {"title": "Al-Fatihah - C001 S1.00", "album": "Speed 1.00x", "artist": "Reciter", "genre": "Quran test"}
+    tag_audio_file(output_path, metadata, profile["tagging"])
+
+    tags = mutagen.File(output_path, easy=True).tags
+    assert {key: tags[key][0] for key in metadata} == metadata
+    info = backend.probe(output_path)
+    assert (info["sample_rate"], info["channels"]) == (profile["sample_rate"], profile["channels"])
+    assert info["duration_s"] == pytest.approx(2.0, abs=0.1)
+
+    (tmp_path / f"temp_{output_path.name}").write_bytes(b"")
+    (tmp_path / "notes.txt").write_text("not audio")
+    assert list_audio_files(tmp_path) == [output_path]
+
+
+def test_default_and_unknown_profiles():
+    assert get_profile() is ENCODE_PROFILES["mp3_128k"]
+    with pytest.raises(ValueError, match="mp3_64k_mono"):
+        get_profile("mp3_320k")
+    with pytest.raises(ValueError, match="Unknown tagging"):
+        tag_audio_file("clip.wav", {"title": "x"}, "riff")
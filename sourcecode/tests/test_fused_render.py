@@ -0,0 +1,52 @@
+import importlib.util
+import shutil
+import subprocess
+
+import pytest
+
+from codec import get_codec_backend
+from encode_profiles import list_audio_files
+from fused_render import render_all_fixed_files_to_clips
+from speedster import create_median_length_tracks
+from utils import clip_folder_name, split_all_median_files_to_clips
+
+pytestmark = pytest.mark.skipif(shutil.which("ffmpeg") is None or (shutil.which("ffprobe") is None and importlib.util.find_spec("av") is None),
+                                reason="needs ffmpeg and ffprobe or PyAV")
+
+CLIP_ARGS = {"clip_length_ms": 10000, "overlap_ms": 5000, "fade_duration": 1000, "metadata": None, "clip_folder_prefix": "test_"}
+
+
+def _reciter_with_fixed_files(quran_data_folder):
+    fixed_folder = quran_data_folder / "Reciter" / "fixed"
+    fixed_folder.mkdir(parents=True)
+    for sura_num, seconds in ((1, 31), (2, 17)):
+        subprocess.run(["ffmpeg", "-y", "-v", "error", "-f", "lavfi", "-i", f"sine=f=440:d={seconds}", "-ac", "2", "-ar", "44100",
+                        "-b:a", "128k", str(fixed_folder / f"{sura_num:03d}_fixed.mp3")], check=True)
+    return quran_data_folder / "Reciter"
+
+
+def _clip_lengths(clip_folder):
+    backend = get_codec_backend()
+    return {clip_file.name: backend.probe(clip_file)["duration_s"] for clip_file in list_audio_files(clip_folder)}
+
+
+@pytest.mark.parametrize("speedup_factor", [1.0, 1.2])
+def test_fused_clips_match_the_median_flow(tmp_path, speedup_factor):
+    median_speedup = {"Reciter": 1.1}
+
+    # two steps: median tracks at speedup_factor times the median speed, then split into clips
+    two_step_folder = _reciter_with_fixed_files(tmp_path / "two_step")
+    create_median_length_tracks([two_step_folder], {"Reciter": median_speedup["Reciter"] * speedup_factor})
+    split_all_median_files_to_clips(tmp_path / "two_step", speedup_factor=speedup_factor, **CLIP_ARGS)
+
+    fused_folder = _reciter_with_fixed_files(tmp_path / "fused")
+    render_all_fixed_files_to_clips([fused_folder], median_speedup, speedup_factor=speedup_factor, **CLIP_ARGS)
+
+    clip_folder = clip_folder_name("Reciter", speedup_factor, "test_")
+    two_step_lengths = _clip_lengths(two_step_folder / clip_folder)
+    fused_lengths = _clip_lengths(fused_folder / clip_folder)
+    # a clip starts every 5 s: 31 s and 17 s at 1.1 are 28.2 s and 15.5 s long, at 1.1 times 1.2 23.5 s and 12.9 s
+    assert len(fused_lengths) == (6 + 4 if speedup_factor == 1.0 else 5 + 3)
+    assert sorted(fused_lengths) == sorted(two_step_lengths)
+    for name, length_s in fused_lengths.items():
+        assert length_s == pytest.approx(two_step_lengths[name], abs=0.1)
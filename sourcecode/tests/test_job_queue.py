@@ -0,0 +1,146 @@
+import json
+import multiprocessing
+import os
+import time
+from pathlib import Path
+
+from job_queue import (DONE_SUFFIX, FAILED_SUFFIX, LEASE_SUFFIX, job_id, job_is_closed, read_lease, reset_queue, run_worker,
+                       try_claim)
+
+
+def _counting_job(job):
+    """Appends one line per run to the run log of the job, so double runs show up as extra lines."""
+    time.sleep(0.01)
+    with open(Path(job["log_dir"]) / job["id"], "a") as f:
+        f.write(f"{os.getpid()}\n")
+
+
+def _flaky_job(job):
+    """Fails on the first run and succeeds on the second."""
+    _counting_job(job)
+    if len((Path(job["log_dir"]) / job["id"]).read_text().splitlines()) == 1:
+        raise RuntimeError("transient error")
+
+
+def _failing_job(job):
+    raise RuntimeError("permanent error")
+
+
+def _make_jobs(log_dir: Path, num_reciters: int = 3, num_suras: int = 15):
+    return [{"id": job_id("test", f"Reciter {r}", sura), "log_dir": str(log_dir)}
+            for r in range(num_reciters) for sura in range(1, num_suras + 1)]
+
+
+def test_workers_run_every_job_exactly_once(tmp_path):
+    queue_dir = tmp_path / ".jobs"
+    log_dir = tmp_path / "logs"
+    log_dir.mkdir()
+    jobs = _make_jobs(log_dir)
+
+    workers = [multiprocessing.Process(target=run_worker, args=(queue_dir, jobs, _counting_job),
+                                       kwargs={"worker_id": f"worker{i}", "lease_seconds": 10.0, "poll_seconds": 0.05})
+               for i in range(4)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join(timeout=60)
+        assert worker.exitcode == 0
+
+    for job in jobs:
+        assert len((log_dir / job["id"]).read_text().splitlines()) == 1
+        assert (queue_dir / (job["id"] + DONE_SUFFIX)).exists()
+    assert not list(queue_dir.glob("*" + LEASE_SUFFIX))
+
+    # a second run finds every job done
+    assert run_worker(queue_dir, jobs, _counting_job, worker_id="late", poll_seconds=0.05) == 0
+
+
+def test_stale_lease_is_taken_over(tmp_path):
+    queue_dir = tmp_path / ".jobs"
+    queue_dir.mkdir()
+    log_dir = tmp_path / "logs"
+    log_dir.mkdir()
+    jobs = _make_jobs(log_dir, num_reciters=1, num_suras=3)
+
+    # a worker died while holding the lease of the first job, a fresh lease of a live worker holds the second job
+    stale_lease = queue_dir / (jobs[0]["id"] + LEASE_SUFFIX)
+    stale_lease.write_text(json.dumps({"worker": "dead"}))
+    os.utime(stale_lease, (time.time() - 60, time.time() - 60))
+    live_lease = queue_dir / (jobs[1]["id"] + LEASE_SUFFIX)
+    live_lease.write_text(json.dumps({"worker": "alive"}))
+
+    worker = multiprocessing.Process(target=run_worker, args=(queue_dir, jobs, _counting_job),
+                                     kwargs={"worker_id": "taker", "lease_seconds": 2.0, "poll_seconds": 0.05})
+    worker.start()
+    time.sleep(0.5)
+    # the live job is left alone while its lease is fresh
+    assert (queue_dir / (jobs[0]["id"] + DONE_SUFFIX)).exists()
+    assert not (queue_dir / (jobs[1]["id"] + DONE_SUFFIX)).exists()
+    # once the live worker stops its heartbeat, its lease expires and gets taken over as well
+    worker.join(timeout=30)
+    assert worker.exitcode == 0
+    for job in jobs:
+        assert len((log_dir / job["id"]).read_text().splitlines()) == 1
+        assert (queue_dir / (job["id"] + DONE_SUFFIX)).exists()
+
+
+def _race_for_lease(queue_dir, job, worker_id, barrier, results):
+    barrier.wait()
+    results.put((worker_id, try_claim(queue_dir, job, worker_id, lease_seconds=5.0)))
+
+
+def test_workers_racing_on_a_stale_lease_take_it_over_once(tmp_path):
+    queue_dir = tmp_path / ".jobs"
+    queue_dir.mkdir()
+    for round_num in range(10):
+        job = job_id("race", "Reciter", round_num + 1)
+        stale_lease = queue_dir / (job + LEASE_SUFFIX)
+        stale_lease.write_text(json.dumps({"worker": "dead", "token": f"stale{round_num}"}))
+        os.utime(stale_lease, (time.time() - 60, time.time() - 60))
+
+        barrier = multiprocessing.Barrier(6)
+        results = multiprocessing.Queue()
+        workers = [multiprocessing.Process(target=_race_for_lease, args=(queue_dir, job, f"worker{i}", barrier, results))
+                   for i in range(6)]
+        for worker in workers:
+            worker.start()
+        claims = dict(results.get(timeout=30) for _ in workers)
+        for worker in workers:
+            worker.join(timeout=30)
+
+        winners = [worker_id for worker_id, token in claims.items() if token is not None]
+        assert len(winners) == 1
+        lease = read_lease(stale_lease)
+        assert (lease["worker"], lease["token"]) == (winners[0], claims[winners[0]])
+        # the fresh lease of the winner is not taken over again
+        assert try_claim(queue_dir, job, "late", lease_seconds=5.0) is None
+    assert not list(queue_dir.glob("*.takeover*"))
+
+
+def test_failed_jobs_are_retried_and_expire(tmp_path):
+    queue_dir = tmp_path / ".jobs"
+    log_dir = tmp_path / "logs"
+    log_dir.mkdir()
+    jobs = _make_jobs(log_dir, num_reciters=1, num_suras=2)
+
+    assert run_worker(queue_dir, jobs, _flaky_job, worker_id="w", poll_seconds=0.05, max_attempts=3) == 4
+    for job in jobs:
+        assert (queue_dir / (job["id"] + DONE_SUFFIX)).exists()
+        assert not (queue_dir / (job["id"] + FAILED_SUFFIX)).exists()
+
+    # a job failing on every attempt is given up after max_attempts, until its failures expire
+    failing_jobs = _make_jobs(log_dir, num_reciters=1, num_suras=1)
+    failing_jobs[0]["id"] = job_id("failing", "Reciter 0", 1)
+    run_worker(queue_dir, failing_jobs, _failing_job, worker_id="w", poll_seconds=0.05, max_attempts=2)
+    assert job_is_closed(queue_dir, failing_jobs[0]["id"], max_attempts=2)
+    assert not job_is_closed(queue_dir, failing_jobs[0]["id"], max_attempts=2, failed_expiry_seconds=-1.0)
+
+    assert reset_queue(queue_dir, stage="failing") == 1
+    assert not job_is_closed(queue_dir, failing_jobs[0]["id"], max_attempts=2)
+
+
+def test_job_id_changes_with_the_parameters():
+    base = job_id("median", "Reciter A", 2, {"speed_change": 1.1, "profile": {"bitrate": "128k"}})
+    assert base == job_id("median", "Reciter A", 2, {"profile": {"bitrate": "128k"}, "speed_change": 1.1})
+    assert base != job_id("median", "Reciter A", 2, {"speed_change": 1.2, "profile": {"bitrate": "128k"}})
+    assert base != job_id("median", "Reciter A", 2, {"speed_change": 1.1, "profile": {"bitrate": "64k"}})
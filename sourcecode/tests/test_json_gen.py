@@ -0,0 +1,32 @@
+import importlib.util
+import shutil
+import subprocess
+
+import pytest
+
+from codec import get_codec_backend
+from encode_profiles import bitrate_to_int, get_profile
+from json_gen import correct_mp3_file
+
+pytestmark = pytest.mark.skipif(shutil.which("ffmpeg") is None or (shutil.which("ffprobe") is None and importlib.util.find_spec("av") is None),
+                                reason="needs ffmpeg and ffprobe or PyAV")
+
+
+def _write_original(reciter_folder, sura_num=1):
+    (reciter_folder / "fixed").mkdir(parents=True, exist_ok=True)
+    original = reciter_folder / f"{sura_num:03d}.mp3"
+    subprocess.run(["ffmpeg", "-y", "-v", "error", "-f", "lavfi", "-i", "sine=f=440:d=3", "-ac", "2", "-ar", "44100",
+                    "-b:a", "128k", str(original)], check=True)
+    return original
+
+
+@pytest.mark.parametrize("profile_name, expected_method", [("mp3_128k", "remux"), ("mp3_64k_mono", "transcode")])
+def test_fixed_file_has_the_format_of_the_profile(tmp_path, profile_name, expected_method):
+    profile = get_profile(profile_name)
+    fixed_filep, fix_method = correct_mp3_file(_write_original(tmp_path / "Reciter"), profile)
+
+    assert fix_method == expected_method
+    info = get_codec_backend().probe(fixed_filep)
+    assert (info["sample_rate"], info["channels"]) == (profile["sample_rate"], profile["channels"])
+    assert info["bit_rate"] == pytest.approx(bitrate_to_int(profile["bitrate"]), rel=0.02)
+    assert correct_mp3_file(tmp_path / "Reciter" / "001.mp3", profile) == (fixed_filep, "existing")
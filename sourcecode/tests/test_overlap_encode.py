@@ -0,0 +1,55 @@
+import io
+import shutil
+import subprocess
+
+import pytest
+from pydub import AudioSegment
+from pydub.generators import Sine
+
+from encode_profiles import get_profile, list_audio_files
+from file_io import clip_windows
+from overlap_encode import save_clips_overlap_encoded
+
+pytestmark = pytest.mark.skipif(shutil.which("ffmpeg") is None, reason="needs ffmpeg with libmp3lame")
+
+
+def _sura_audio(duration_ms: int) -> AudioSegment:
+    return Sine(440).to_audio_segment(duration=duration_ms, volume=-12.0).set_frame_rate(44100).set_channels(2)
+
+
+def _decode(clip_file) -> AudioSegment:
+    """Decodes a clip with ffmpeg alone, pydub would need ffprobe for an mp3."""
+    wav = subprocess.run(["ffmpeg", "-v", "error", "-i", str(clip_file), "-f", "wav", "pipe:1"], check=True, stdout=subprocess.PIPE).stdout
+    return AudioSegment.from_wav(io.BytesIO(wav))
+
+
+def _save_clips(audio, output_dir, clip_length_ms, overlap_ms, fade_ms, duck):
+    output_dir.mkdir()
+    return save_clips_overlap_encoded(audio, "Reciter", 1, clip_length_ms, overlap_ms, output_dir, fade_ms, None, 1.0,
+                                      "test_", get_profile("mp3_128k"), duck)
+
+
+def test_clips_without_ducking_share_their_unity_frames(tmp_path):
+    audio = _sura_audio(60000)
+    stats = _save_clips(audio, tmp_path / "clips", 20000, 15000, 1000, duck=False)
+
+    # every second is part of four clips but its full level frames are encoded only once
+    assert stats["encoded_frames"] < 0.5 * stats["clip_frames"]
+    windows = list(clip_windows(len(audio), 20000, 15000))
+    clips = list_audio_files(tmp_path / "clips")
+    assert len(clips) == len(windows)
+    for clip_file, (_, start_ms, end_ms) in zip(clips, windows):
+        decoded = _decode(clip_file)
+        # clip borders are moved onto the frame grid by at most half a frame, the decoder adds its delay
+        assert abs(len(decoded) - (end_ms - start_ms)) < 100
+        # the shared middle of the clip plays at full level
+        assert decoded[len(decoded) // 2 - 500:len(decoded) // 2 + 500].dBFS > -16.0
+
+
+def test_clips_without_shared_frames_are_encoded_one_by_one(tmp_path):
+    audio = _sura_audio(30000)
+    # fades covering the whole clip: no frame is at full level or silent, so nothing can be shared
+    stats = _save_clips(audio, tmp_path / "clips", 10000, 5000, 5000, duck=False)
+
+    assert stats["encoded_frames"] == stats["clip_frames"]
+    assert len(list_audio_files(tmp_path / "clips")) == len(list(clip_windows(len(audio), 10000, 5000)))
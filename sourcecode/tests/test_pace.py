@@ -0,0 +1,51 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from pace import MUSHAF_PAGES, NUM_SURAS, TEMPO_FACTOR_RANGE, load_sura_pages, per_sura_speedups, tempo_factor_matrix
+
+
+def test_sura_pages_of_the_mushaf():
+    sura_pages = load_sura_pages()
+    assert len(sura_pages) == NUM_SURAS
+    assert sura_pages.sum() == pytest.approx(MUSHAF_PAGES)
+    assert (sura_pages > 0).all()
+    # Al-Fatiha has the first page, Al-Baqara runs from page 2 to the start of Al-Imran on page 50
+    assert sura_pages[0] == pytest.approx(1.0)
+    assert sura_pages[1] == pytest.approx(48.0)
+    # the last three suras share page 604
+    assert sura_pages[111:] == pytest.approx([1 / 3] * 3)
+
+
+def test_tempo_factors_are_clamped():
+    sura_pages = load_sura_pages()
+    # a reciter at exactly 20 pages per hour, except for a slow Al-Fatiha and short suras at the end
+    durations = (sura_pages / 20.0 * 3600.0)[np.newaxis, :].astype(np.float32).copy()
+    durations[0, 0] = 50.0
+    durations[0, 111:] = 10.0
+    durations[0, 50] = np.nan
+
+    raw = tempo_factor_matrix(durations, sura_pages, 20.0, factor_range=None)
+    assert raw[0, 1] == pytest.approx(1.0)
+    assert raw[0, 0] == pytest.approx(50.0 / 180.0)
+    assert raw[0, 113] == pytest.approx(10.0 / 60.0)
+
+    factors = tempo_factor_matrix(durations, sura_pages, 20.0)
+    assert np.isnan(factors[0, 50])
+    assert factors[0, 0] == factors[0, 113] == TEMPO_FACTOR_RANGE[0]
+    assert factors[0, 1] == pytest.approx(1.0)
+    # twice the pace needs twice the tempo, within the range
+    assert tempo_factor_matrix(durations, sura_pages, 10.0)[0, 1] == pytest.approx(0.5)
+    assert tempo_factor_matrix(durations, sura_pages, 80.0)[0, 1] == TEMPO_FACTOR_RANGE[1]
+
+
+def test_per_sura_speedups_warn_about_clamped_suras(tmp_path, capsys):
+    sura_pages = load_sura_pages()
+    rows = [{"artist": "Reciter", "trk_num": f"{sura_num:03d}", "len": minutes}
+            for sura_num, minutes in ((1, 50.0 / 60.0), (2, sura_pages[1] / 20.0 * 60.0), (114, 10.0 / 60.0))]
+    pd.DataFrame(rows).to_json(tmp_path / "rec_sura_df.json", orient="records", lines=True)
+
+    speedups = per_sura_speedups(tmp_path, 20.0)
+    assert speedups["Reciter"] == pytest.approx({1: 0.5, 2: 1.0, 114: 0.5}, rel=1e-4)
+    output = capsys.readouterr().out
+    assert "2 suras" in output and "1 (0.28)" in output and "114 (0.17)" in output
@@ -0,0 +1,52 @@
+import multiprocessing
+import shutil
+import subprocess
+
+import pytest
+
+from proxies import PROXY_SAMPLE_RATE, get_proxy, load_source_sidecar, source_sidecar_path
+
+pytestmark = pytest.mark.skipif(shutil.which("ffmpeg") is None, reason="needs ffmpeg")
+
+
+def _write_tone(file_path, seconds):
+    subprocess.run(["ffmpeg", "-y", "-v", "error", "-f", "lavfi", "-i", f"sine=f=440:d={seconds}", "-ac", "2", "-ar", "44100",
+                    "-b:a", "128k", str(file_path)], check=True)
+
+
+def _get_proxies(store_dir, source_files):
+    for source_file in source_files:
+        get_proxy(source_file, store_dir)
+
+
+def test_concurrent_workers_keep_every_sidecar(tmp_path):
+    store_dir = tmp_path / ".proxies"
+    source_files = []
+    for sura_num in range(1, 9):
+        source_file = tmp_path / f"{sura_num:03d}_fixed.mp3"
+        _write_tone(source_file, 1 + sura_num % 3)
+        source_files.append(source_file)
+
+    # every worker handles every second file, so the workers write proxies and sidecars at the same time
+    workers = [multiprocessing.Process(target=_get_proxies, args=(store_dir, source_files[offset::2] + source_files[::-1]))
+               for offset in range(2) for _ in range(2)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join(timeout=120)
+        assert worker.exitcode == 0
+
+    for source_file in source_files:
+        entry = load_source_sidecar(source_sidecar_path(store_dir, source_file))
+        assert entry["size"] == source_file.stat().st_size
+        assert (store_dir / f"{entry['hash']}.s16").exists()
+    assert not list(store_dir.glob("temp_*"))
+
+    # the same content shares a proxy, a changed file gets a new one
+    copy_file = tmp_path / "copy" / "001_fixed.mp3"
+    copy_file.parent.mkdir()
+    shutil.copy(source_files[0], copy_file)
+    assert get_proxy(copy_file, store_dir) == get_proxy(source_files[0], store_dir)
+    _write_tone(source_files[0], 5)
+    assert get_proxy(source_files[0], store_dir) != get_proxy(copy_file, store_dir)
+    assert (get_proxy(source_files[0], store_dir).stat().st_size / 2 / PROXY_SAMPLE_RATE) == pytest.approx(5.0, abs=0.1)
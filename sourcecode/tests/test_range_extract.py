@@ -0,0 +1,109 @@
+import importlib.util
+import shutil
+import subprocess
+
+import numpy as np
+import pytest
+
+import codec
+from mp3_frames import DECODER_DELAY_SAMPLES, frame_byte_range, index_num_samples, parse_frame_header, scan_mp3_frames
+from range_extract import build_sura_timeline, decode_window, extract_range, get_duration_ms, get_frame_index
+from utils import tag_audio_file
+
+pytestmark = pytest.mark.skipif(shutil.which("ffmpeg") is None, reason="needs ffmpeg")
+
+BACKENDS = [
+    pytest.param("pyav", marks=pytest.mark.skipif(importlib.util.find_spec("av") is None, reason="needs PyAV")),
+    pytest.param("subprocess", marks=pytest.mark.skipif(shutil.which("ffprobe") is None, reason="pydub needs ffprobe")),
+]
+
+
+@pytest.fixture
+def backend(request):
+    codec.set_codec_backend(request.param)
+    yield codec.get_codec_backend()
+    codec.set_codec_backend("auto")
+
+
+def _write_mp3(file_path, seconds, extra_args=()):
+    # a tone plus noise, so every sample offset shows up in the comparison
+    subprocess.run(["ffmpeg", "-y", "-v", "error", "-f", "lavfi", "-i", f"sine=f=440:d={seconds}", "-f", "lavfi", "-i", f"anoisesrc=d={seconds}:a=0.1",
+                    "-filter_complex", "amix=inputs=2", "-ac", "2", "-ar", "44100", "-b:a", "128k", *extra_args, str(file_path)], check=True)
+    return file_path
+
+
+def _samples(segment) -> np.ndarray:
+    return np.array(segment.get_array_of_samples(), dtype=np.int32).reshape(-1, segment.channels)
+
+
+@pytest.mark.parametrize("backend", BACKENDS, indirect=True)
+@pytest.mark.parametrize("xing_header", [True, False])
+def test_joined_windows_equal_one_contiguous_decode(tmp_path, backend, xing_header):
+    mp3_file = _write_mp3(tmp_path / "001_median.mp3", 6, () if xing_header else ("-write_xing", "0"))
+    full = _samples(backend.decode(mp3_file))
+    assert len(full) == round(get_duration_ms(mp3_file) * 44.1)
+
+    # window borders off the frame grid, the last window runs past the end of the file
+    borders = [0.0, 1000.0, 1987.3, 2500.0, 4012.9, 6500.0]
+    joined = np.concatenate([_samples(decode_window(mp3_file, start_ms, end_ms)) for start_ms, end_ms in zip(borders, borders[1:])])
+    assert np.array_equal(joined, full)
+
+    middle = _samples(decode_window(mp3_file, 1234.5, 3456.7))
+    start_sample = round(1234.5 * 44.1)
+    assert np.array_equal(middle, full[start_sample:start_sample + len(middle)])
+    assert len(middle) == round(3456.7 * 44.1) - start_sample
+
+
+def _frame_headers(data, index):
+    return [parse_frame_header(data[offset:offset + 4]) for offset in index.offsets]
+
+
+def test_frame_index_survives_tags_and_garbage(tmp_path):
+    mp3_file = _write_mp3(tmp_path / "001_median.mp3", 3)
+    index = get_frame_index(mp3_file)
+    data = mp3_file.read_bytes()
+    headers = _frame_headers(data, index)
+    # the Info frame is left out, its LAME tag gives the gapless length
+    assert index.offsets[0] > 0 and None not in headers
+    assert all(offset + header.frame_size == next_offset for offset, header, next_offset in zip(index.offsets, headers, index.offsets[1:]))
+    assert (index.sample_rate, index.samples_per_frame, index.channels) == (44100, 1152, 2)
+    assert index.start_skip > DECODER_DELAY_SAMPLES
+    assert index_num_samples(index) == 3 * 44100
+    assert frame_byte_range(index, 0, len(index.offsets)) == (index.offsets[0], index.audio_end)
+    assert frame_byte_range(index, 2, 5) == (index.offsets[2], index.offsets[5])
+
+    # an ID3 tag in front and junk with a header lookalike between two frames only move the offsets,
+    # the cached index follows the file change
+    tag_audio_file(mp3_file, {"title": "Al-Fatihah"})
+    tag_size = len(mp3_file.read_bytes()) - len(data)
+    junk_at = index.offsets[10] + tag_size
+    tagged = mp3_file.read_bytes()
+    mp3_file.write_bytes(tagged[:junk_at] + b"\x00\xff\xfb junk" + tagged[junk_at:])
+    changed_index = get_frame_index(mp3_file)
+    assert len(changed_index.offsets) == len(index.offsets)
+    assert list(changed_index.offsets[:10]) == [offset + tag_size for offset in index.offsets[:10]]
+    assert list(changed_index.offsets[10:]) == [offset + tag_size + 8 for offset in index.offsets[10:]]
+    assert index_num_samples(changed_index) == index_num_samples(index)
+
+
+def test_non_mp3_data_has_no_frame_index():
+    with pytest.raises(ValueError):
+        scan_mp3_frames(b"RIFF" + bytes(1000))
+
+
+@pytest.mark.skipif(shutil.which("ffprobe") is None and importlib.util.find_spec("av") is None, reason="needs ffprobe or PyAV")
+def test_extract_range_crosses_the_sura_borders(tmp_path):
+    median_folder = tmp_path / "Reciter" / "median"
+    median_folder.mkdir(parents=True)
+    median_files = [_write_mp3(median_folder / f"{sura_num:03d}_median.mp3", seconds) for sura_num, seconds in ((1, 2), (2, 3), (3, 2))]
+    timeline = build_sura_timeline(median_folder)
+    assert [(entry["sura"], entry["start_ms"], entry["duration_ms"]) for entry in timeline] == \
+        [(1, 0.0, pytest.approx(2000.0)), (2, pytest.approx(2000.0), pytest.approx(3000.0)), (3, pytest.approx(5000.0), pytest.approx(2000.0))]
+
+    backend = codec.get_codec_backend()
+    full = np.concatenate([_samples(backend.decode(median_file)) for median_file in median_files])
+    # from the middle of the first sura over the whole second one into the third
+    audio = _samples(extract_range(tmp_path / "Reciter", 1500.0, 5500.0))
+    assert np.array_equal(audio, full[round(1500 * 44.1):round(5500 * 44.1)])
+    assert len(extract_range(tmp_path / "Reciter", 6500.0, 9000.0, timeline)) == 500
+    assert len(extract_range(tmp_path / "Reciter", 8000.0, 9000.0, timeline)) == 0
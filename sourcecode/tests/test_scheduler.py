@@ -0,0 +1,99 @@
+import logging
+import shutil
+import subprocess
+import time
+from types import SimpleNamespace
+
+import pytest
+
+import scheduler
+from scheduler import DEFAULT_PCM_BYTES_PER_SECOND, MB, annotate_audio_jobs, estimate_job_memory, run_scheduled
+
+
+def record_job(job):
+    """Runs in the worker processes: sleeps and writes when the job ran into its log file."""
+    start = time.time()
+    if job.get("fail"):
+        raise RuntimeError("broken input")
+    time.sleep(job["sleep_s"])
+    (job["log_dir"] / job["id"]).write_text(f"{start} {time.time()}")
+
+
+def _job(log_dir, job_id, duration_s, **extra):
+    return {"id": job_id, "mode": "pydub", "duration_s": duration_s, "sleep_s": 0.3, "log_dir": log_dir, **extra}
+
+
+def _intervals(log_dir):
+    return {log_file.name: tuple(map(float, log_file.read_text().split())) for log_file in log_dir.iterdir()}
+
+
+def _overlapping(intervals, job_id):
+    start, end = intervals[job_id]
+    return {other for other, (other_start, other_end) in intervals.items() if other != job_id and other_start < end and start < other_end}
+
+
+def test_estimate_scales_with_the_decoded_pcm_size():
+    job = {"mode": "pydub", "duration_s": 100}
+    assert estimate_job_memory(job) == 150 * MB + 3 * 100 * DEFAULT_PCM_BYTES_PER_SECOND
+    assert estimate_job_memory({**job, "pcm_bytes_per_second": DEFAULT_PCM_BYTES_PER_SECOND // 4}) == \
+        150 * MB + 3 * 100 * DEFAULT_PCM_BYTES_PER_SECOND // 4
+    # ffmpeg streams, the duration does not matter
+    assert estimate_job_memory({"mode": "ffmpeg", "duration_s": 100}) == estimate_job_memory({"mode": "ffmpeg", "duration_s": 5000})
+
+
+def test_largest_jobs_start_first(tmp_path):
+    jobs = [_job(tmp_path, job_id, duration_s, sleep_s=0.05) for job_id, duration_s in (("short", 10), ("long", 1000), ("middle", 300))]
+    run_scheduled(jobs, record_job, ram_budget_bytes=4096 * MB, max_workers=1, poll_seconds=0.05)
+    intervals = _intervals(tmp_path)
+    assert sorted(intervals, key=lambda job_id: intervals[job_id][0]) == ["long", "middle", "short"]
+
+
+def test_running_jobs_stay_within_the_budget(tmp_path):
+    # about 654 MB and 604 MB for the long jobs, 155 MB for the short ones
+    jobs = [_job(tmp_path, "long_a", 1000), _job(tmp_path, "long_b", 900)] + [_job(tmp_path, f"short_{num}", 10) for num in range(3)]
+    estimates = {job["id"]: estimate_job_memory(job) for job in jobs}
+    run_scheduled(jobs, record_job, ram_budget_bytes=900 * MB, max_workers=3, poll_seconds=0.05)
+
+    intervals = _intervals(tmp_path)
+    assert sorted(intervals) == sorted(estimates)
+    assert "long_b" not in _overlapping(intervals, "long_a")
+    for job_id, (start, _) in intervals.items():
+        running = [other for other, (other_start, other_end) in intervals.items() if other_start <= start < other_end]
+        assert sum(estimates[other] for other in running) <= 900 * MB
+    # a short job fills the budget next to a long one
+    assert _overlapping(intervals, "long_a") or _overlapping(intervals, "long_b")
+
+
+def test_a_job_above_the_budget_runs_alone(tmp_path, caplog):
+    jobs = [_job(tmp_path, "huge", 1000)] + [_job(tmp_path, f"short_{num}", 10) for num in range(2)]
+    with caplog.at_level(logging.WARNING):
+        run_scheduled(jobs, record_job, ram_budget_bytes=500 * MB, max_workers=3, poll_seconds=0.05)
+    intervals = _intervals(tmp_path)
+    assert len(intervals) == 3
+    assert not _overlapping(intervals, "huge")
+    assert "Job huge needs about" in caplog.text
+
+
+def test_memory_pressure_and_failed_jobs(tmp_path, monkeypatch, caplog):
+    # above the pressure threshold only one job at a time is admitted
+    monkeypatch.setattr(scheduler.psutil, "virtual_memory", lambda: SimpleNamespace(percent=95.0, available=8192 * MB))
+    jobs = [_job(tmp_path, f"short_{num}", 10, sleep_s=0.1) for num in range(3)] + [_job(tmp_path, "broken", 20, fail=True)]
+    with caplog.at_level(logging.ERROR):
+        run_scheduled(jobs, record_job, max_workers=3, poll_seconds=0.05)
+    intervals = _intervals(tmp_path)
+    assert sorted(intervals) == ["short_0", "short_1", "short_2"]
+    assert not any(_overlapping(intervals, job_id) for job_id in intervals)
+    assert "Job broken failed: broken input" in caplog.text
+
+
+@pytest.mark.skipif(shutil.which("ffmpeg") is None, reason="needs ffmpeg")
+def test_jobs_are_annotated_from_the_probed_files(tmp_path):
+    mp3_file = tmp_path / "001_median.mp3"
+    subprocess.run(["ffmpeg", "-v", "error", "-f", "lavfi", "-i", "sine=f=440:d=3", "-ac", "1", "-ar", "22050", "-b:a", "64k", str(mp3_file)],
+                   check=True)
+    jobs = annotate_audio_jobs([{"id": "clips", "stage": "clips", "median_file": str(mp3_file)},
+                                {"id": "median", "stage": "median", "fixed_filep": str(mp3_file)}])
+    assert [(job["mode"], job["pcm_bytes_per_second"]) for job in jobs] == [("pydub", 22050 * 2), ("ffmpeg", 22050 * 2)]
+    assert jobs[0]["duration_s"] == pytest.approx(3.0)
+    with pytest.raises(ValueError):
+        annotate_audio_jobs([{"id": "x", "stage": "unknown"}])
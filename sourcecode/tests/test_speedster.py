@@ -0,0 +1,35 @@
+import importlib.util
+import shutil
+import subprocess
+
+import pytest
+
+from codec import get_codec_backend
+from speedster import create_median_length_tracks
+
+pytestmark = pytest.mark.skipif(shutil.which("ffmpeg") is None or (shutil.which("ffprobe") is None and importlib.util.find_spec("av") is None),
+                                reason="needs ffmpeg and ffprobe or PyAV")
+
+
+def _write_fixed(fixed_folder, sura_num, seconds):
+    subprocess.run(["ffmpeg", "-y", "-v", "error", "-f", "lavfi", "-i", f"sine=f=440:d={seconds}", "-ac", "2", "-ar", "44100",
+                    "-b:a", "128k", str(fixed_folder / f"{sura_num:03d}_fixed.mp3")], check=True)
+
+
+def test_undecodable_sura_does_not_stop_the_batch(tmp_path):
+    rec_folders = []
+    for reciter_name in ("Reciter A", "Reciter B"):
+        fixed_folder = tmp_path / reciter_name / "fixed"
+        fixed_folder.mkdir(parents=True)
+        _write_fixed(fixed_folder, 1, 2)
+        _write_fixed(fixed_folder, 3, 2)
+        rec_folders.append(tmp_path / reciter_name)
+    bad_filep = tmp_path / "Reciter A" / "fixed" / "002_fixed.mp3"
+    bad_filep.write_bytes(b"not an mp3 file" * 100)
+
+    failed = create_median_length_tracks(rec_folders, {"Reciter A": 1.25, "Reciter B": 1.25})
+
+    assert failed == [bad_filep]
+    assert sorted(path.name for path in (tmp_path / "Reciter A" / "median").iterdir()) == ["001_median.mp3", "003_median.mp3"]
+    assert sorted(path.name for path in (tmp_path / "Reciter B" / "median").iterdir()) == ["001_median.mp3", "003_median.mp3"]
+    assert get_codec_backend().probe(tmp_path / "Reciter B" / "median" / "003_median.mp3")["duration_s"] == pytest.approx(1.6, abs=0.1)
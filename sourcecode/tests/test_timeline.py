@@ -0,0 +1,83 @@
+import importlib.util
+import shutil
+import subprocess
+
+import numpy as np
+import pytest
+
+from codec import get_codec_backend
+from timeline import VirtualTimeline
+
+pytestmark = pytest.mark.skipif(shutil.which("ffmpeg") is None or (shutil.which("ffprobe") is None and importlib.util.find_spec("av") is None),
+                                reason="needs ffmpeg and ffprobe or PyAV")
+
+
+def _write_mp3(file_path, seconds, frequency, extra_args=("-ac", "2", "-ar", "44100")):
+    subprocess.run(["ffmpeg", "-y", "-v", "error", "-f", "lavfi", "-i", f"sine=f={frequency}:d={seconds}", "-f", "lavfi", "-i", f"anoisesrc=d={seconds}:a=0.1",
+                    "-filter_complex", "amix=inputs=2", *extra_args, "-b:a", "128k", str(file_path)], check=True)
+    return file_path
+
+
+def _samples(segment) -> np.ndarray:
+    return np.array(segment.get_array_of_samples(), dtype=np.int32).reshape(-1, segment.channels)
+
+
+@pytest.fixture
+def sura_files(tmp_path):
+    # 2 s, 3 s and 1.5 s: the borders lie at 2 s and 5 s of the source timeline
+    return [_write_mp3(tmp_path / f"{sura_num:03d}_median.mp3", seconds, frequency)
+            for sura_num, seconds, frequency in ((1, 2, 300), (2, 3, 500), (3, 1.5, 700))]
+
+
+def test_timeline_maps_the_suras_at_every_speed(sura_files):
+    timeline = VirtualTimeline(sura_files)
+    assert [(entry["sura"], round(entry["source_start_ms"]), round(entry["source_duration_ms"])) for entry in timeline.entries] == \
+        [(1, 0, 2000), (2, 2000, 3000), (3, 5000, 1500)]
+    assert len(timeline) == 6500
+    assert timeline.sura_start_times == {1: 0, 2: 2000, 3: 5000}
+    assert timeline.sura_range(1500, 2000) == ["001"]
+    assert timeline.sura_range(1999, 5001) == ["001", "002", "003"]
+
+    double_speed = VirtualTimeline(sura_files, speed_change=2.0)
+    assert len(double_speed) == 3250
+    assert double_speed.sura_start_times == {1: 0, 2: 1000, 3: 2500}
+    assert double_speed.sura_range(999, 1001) == ["001", "002"]
+    assert double_speed.sura_range(1000, 2500) == ["002"]
+
+
+def test_spans_across_the_sura_borders_match_a_full_decode(sura_files):
+    timeline = VirtualTimeline(sura_files)
+    backend = get_codec_backend()
+    full = np.concatenate([_samples(backend.decode(sura_file)) for sura_file in sura_files])
+    assert len(full) == round(6500 * 44.1)
+
+    # over the first border, over the whole second sura, and to the end
+    for start_ms, end_ms in ((1500, 2500), (1999.5, 5000.5), (4000, 6500)):
+        span = _samples(timeline.decode_source(start_ms, end_ms))
+        assert np.array_equal(span, full[round(start_ms * 44.1):round(end_ms * 44.1)])
+
+    # blocks joined without a gap or an overlap, the first one starts on a whole millisecond
+    blocks = [_samples(block) for block in timeline.iter_source_blocks(1000, 6500, block_ms=700)]
+    assert [len(block) for block in blocks[:-1]] == [round(700 * 44.1)] * (len(blocks) - 1)
+    assert np.array_equal(np.concatenate(blocks), full[round(1000 * 44.1):])
+
+
+def test_suras_of_other_formats_are_converted_to_the_first_one(tmp_path, sura_files):
+    sura_files[1] = _write_mp3(tmp_path / "002_mono.mp3", 3, 500, ("-ac", "1", "-ar", "22050"))
+    timeline = VirtualTimeline(sura_files)
+    span = timeline.decode_source(1000, 6000)
+    assert (span.frame_rate, span.channels) == (44100, 2)
+    assert len(span) == 5000
+    blocks = list(timeline.iter_source_blocks(0, 6500, block_ms=2500))
+    assert all((block.frame_rate, block.channels) == (44100, 2) for block in blocks)
+    assert sum(len(block) for block in blocks) == 6500
+
+
+def test_rendered_slices_have_the_length_of_the_timeline_span(sura_files):
+    timeline = VirtualTimeline(sura_files, speed_change=1.5)
+    assert len(timeline) == 4333
+    assert len(timeline[1000:2500]) == 1500
+    # the last slice is cut at the end of the timeline
+    assert len(timeline[4000:5000]) == 333
+    with pytest.raises(TypeError):
+        timeline[0:1000:2]
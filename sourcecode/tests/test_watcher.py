@@ -0,0 +1,90 @@
+import os
+import time
+
+from watcher import load_watch_state, poll_changes, save_watch_state
+
+SETTLE_SECONDS = 60
+
+
+def _write(file_path, num_bytes, age_seconds=0):
+    """Writes a stand-in original and dates its mtime age_seconds back."""
+    file_path.write_bytes(b"\xff" * num_bytes)
+    mtime_ns = time.time_ns() - int(age_seconds * 1e9)
+    os.utime(file_path, ns=(mtime_ns, mtime_ns))
+    return _signature(file_path)
+
+
+def _signature(file_path):
+    stat = file_path.stat()
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def _empty_state():
+    return {"dirs": {}, "files": {}, "pending": {}, "speedups": {}}
+
+
+def test_new_files_are_returned_once_they_settled(tmp_path):
+    rec_folder = tmp_path / "Reciter"
+    rec_folder.mkdir()
+    (tmp_path / ".clip_cache").mkdir()
+    first = _write(rec_folder / "001.mp3", 1000, age_seconds=120)
+    second = _write(rec_folder / "002.mp3", 2000, age_seconds=120)
+    _write(rec_folder / "003.fixedtmp.mp3", 100, age_seconds=120)
+    (rec_folder / "notes.txt").write_text("not audio")
+    state = _empty_state()
+
+    # seen for the first time: pending, even though the files are old
+    assert poll_changes(tmp_path, state, SETTLE_SECONDS) == {}
+    assert state["pending"] == {"Reciter": {"001.mp3": first, "002.mp3": second}}
+    # unchanged since the last poll: settled
+    assert poll_changes(tmp_path, state, SETTLE_SECONDS) == {"Reciter": {"changed": {"001.mp3": first, "002.mp3": second}, "removed": []}}
+    assert state["pending"] == {}
+    # nothing changed in the folder, it is not listed again
+    assert poll_changes(tmp_path, state, SETTLE_SECONDS) == {}
+
+
+def test_a_reciter_is_held_back_until_all_its_files_settled(tmp_path):
+    rec_folder = tmp_path / "Reciter"
+    rec_folder.mkdir()
+    done = _write(rec_folder / "001.mp3", 1000, age_seconds=120)
+    _write(rec_folder / "002.mp3", 500)
+    state = _empty_state()
+    assert poll_changes(tmp_path, state, SETTLE_SECONDS) == {}
+
+    # 002 is still growing, 001 settled but waits for it
+    _write(rec_folder / "002.mp3", 1500)
+    assert poll_changes(tmp_path, state, SETTLE_SECONDS) == {}
+    assert set(state["pending"]["Reciter"]) == {"001.mp3", "002.mp3"}
+    # the size stopped changing, but the last write is younger than settle_seconds
+    assert poll_changes(tmp_path, state, SETTLE_SECONDS) == {}
+    changes = poll_changes(tmp_path, state, settle_seconds=0)
+    assert changes == {"Reciter": {"changed": {"001.mp3": done, "002.mp3": _signature(rec_folder / "002.mp3")}, "removed": []}}
+
+
+def test_removed_and_replaced_files_of_ingested_reciters(tmp_path):
+    rec_folder = tmp_path / "Reciter"
+    rec_folder.mkdir()
+    ingested = {"001.mp3": _write(rec_folder / "001.mp3", 1000, age_seconds=600),
+                "002.mp3": _write(rec_folder / "002.mp3", 1000, age_seconds=600),
+                "003.mp3": _write(rec_folder / "003.mp3", 1000, age_seconds=600)}
+    state = _empty_state()
+    state["files"]["Reciter"] = dict(ingested)
+    assert poll_changes(tmp_path, state, SETTLE_SECONDS) == {}
+
+    (rec_folder / "002.mp3").unlink()
+    # a re-download of 003 under a temp name, renamed over the old file
+    replaced = _write(rec_folder / "003.part", 1200, age_seconds=120)
+    os.replace(rec_folder / "003.part", rec_folder / "003.mp3")
+    # the removal is held back with the replaced file until that one settled
+    assert poll_changes(tmp_path, state, SETTLE_SECONDS) == {}
+    assert state["pending"] == {"Reciter": {"003.mp3": replaced}}
+    assert poll_changes(tmp_path, state, SETTLE_SECONDS) == {"Reciter": {"changed": {"003.mp3": replaced}, "removed": ["002.mp3"]}}
+
+
+def test_watch_state_round_trip(tmp_path):
+    state = load_watch_state(tmp_path)
+    assert state == _empty_state()
+    state["files"]["Reciter"] = {"001.mp3": [1000, 123]}
+    state["speedups"]["Reciter"] = 1.05
+    save_watch_state(tmp_path, state)
+    assert load_watch_state(tmp_path) == state
@@ -0,0 +1,133 @@
+import math
+from pathlib import Path
+from typing import Dict, Iterator, List
+
+from pydub import AudioSegment
+
+from range_extract import decode_window, get_duration_ms
+
+
+class VirtualTimeline:
+    """
+    The ordered sura files of a reciter as one virtual audio track, without ever holding the combined audio in memory.
+
+    The timeline behaves like an AudioSegment for len() and [start:end] slicing, so it can be handed to file_io.save_clips.
+    Slicing only decodes the frames of the requested span, also across file borders, and applies the tempo change
+    to that span while rendering. All times of the timeline (len, slices, sura_start_times) are after the tempo change.
+    """
+
+    def __init__(self, file_list: List[Path], speed_change: float = 1.0):
+        """
+        Args:
+            file_list (List[Path]): The sura files in playback order, their names start with the sura number.
+            speed_change (float): Tempo factor applied when rendering, 2.0 plays twice as fast.
+        """
+        self.speed_change = speed_change
+        self.entries = []
+        source_ms = 0.0
+        for file_path in file_list:
+            duration_ms = get_duration_ms(file_path)
+            self.entries.append({
+                "sura": int(file_path.stem.split("_")[0]),
+                "path": file_path,
+                "source_start_ms": source_ms,
+                "source_duration_ms": duration_ms,
+            })
+            source_ms += duration_ms
+        self.source_length_ms = source_ms
+
+    def __len__(self) -> int:
+        return int(self.source_length_ms / self.speed_change)
+
+    def __getitem__(self, span: slice) -> AudioSegment:
+        if not isinstance(span, slice) or span.step is not None:
+            raise TypeError("VirtualTimeline only supports [start:end] slices in milliseconds.")
+        start = 0 if span.start is None else span.start
+        end = len(self) if span.stop is None else min(span.stop, len(self))
+        return self.render(start, end)
+
+    @property
+    def sura_start_times(self) -> Dict[int, int]:
+        """Start time of every sura on the timeline in milliseconds."""
+        return {entry["sura"]: int(entry["source_start_ms"] / self.speed_change) for entry in self.entries}
+
+    def sura_range(self, start_ms: float, end_ms: float) -> List[str]:
+        """Returns the zero padded numbers of the suras which overlap with [start_ms, end_ms) of the timeline."""
+        source_start_ms = start_ms * self.speed_change
+        source_end_ms = end_ms * self.speed_change
+        return [f"{entry['sura']:03d}" for entry in self.entries
+                if entry["source_start_ms"] < source_end_ms
+                and entry["source_start_ms"] + entry["source_duration_ms"] > source_start_ms]
+
+    def decode_source(self, source_start_ms: float, source_end_ms: float) -> AudioSegment:
+        """
+        Decodes [source_start_ms, source_end_ms) of the sura files before the tempo change, also across file borders.
+
+        Args:
+            source_start_ms (float): Start of the span on the source files in milliseconds.
+            source_end_ms (float): End of the span on the source files in milliseconds.
+
+        Returns:
+            AudioSegment: The decoded span, in the sample rate and channels of its first file.
+        """
+        span = AudioSegment.empty()
+        for entry in self.entries:
+            entry_end_ms = entry["source_start_ms"] + entry["source_duration_ms"]
+            if entry_end_ms <= source_start_ms or entry["source_start_ms"] >= source_end_ms:
+                continue
+            window_start_ms = max(source_start_ms, entry["source_start_ms"]) - entry["source_start_ms"]
+            window_end_ms = min(source_end_ms, entry_end_ms) - entry["source_start_ms"]
+            window = decode_window(entry["path"], window_start_ms, window_end_ms)
+            if len(span) > 0:
+                # suras may differ in sample rate or channels after a header-only repair
+                window = window.set_frame_rate(span.frame_rate).set_channels(span.channels)
+            span += window
+        return span
+
+    def iter_source_blocks(self, start_ms: float, end_ms: float, block_ms: float) -> Iterator[AudioSegment]:
+        """
+        Decodes the span [start_ms, end_ms) of the timeline block by block, before the tempo change,
+        so a long span can be streamed into an encoder without holding all of it in memory.
+
+        Args:
+            start_ms (float): Start of the span on the timeline in milliseconds.
+            end_ms (float): End of the span on the timeline in milliseconds.
+            block_ms (float): Length of the blocks on the source files in milliseconds.
+
+        Returns:
+            Iterator[AudioSegment]: The consecutive blocks of the span, all in the sample rate and channels of the first block.
+        """
+        source_end_ms = min(end_ms * self.speed_change, self.source_length_ms)
+        # whole milliseconds, so the blocks join without the rounding of the window borders adding up
+        block_start_ms = round(start_ms * self.speed_change)
+        first_block = None
+        while block_start_ms < source_end_ms:
+            block_end_ms = min(block_start_ms + block_ms, source_end_ms)
+            block = self.decode_source(block_start_ms, block_end_ms)
+            if first_block is None:
+                first_block = block
+            elif len(block) > 0:
+                block = block.set_frame_rate(first_block.frame_rate).set_channels(first_block.channels)
+            yield block
+            block_start_ms = block_end_ms
+
+    def render(self, start_ms: float, end_ms: float) -> AudioSegment:
+        """
+        Renders the span [start_ms, end_ms) of the timeline.
+
+        Args:
+            start_ms (float): Start of the span on the timeline in milliseconds.
+            end_ms (float): End of the span on the timeline in milliseconds.
+
+        Returns:
+            AudioSegment: The span with the tempo change applied, exactly end_ms - start_ms long.
+        """
+        from speedster import speedup_segment  # imported here, speedster pulls in pandas which plain reads do not need
+
+        span = self.decode_source(start_ms * self.speed_change, end_ms * self.speed_change)
+        span = speedup_segment(span, self.speed_change)
+        span_ms = int(math.floor(end_ms - start_ms))
+        if len(span) < span_ms:
+            frame_rate = span.frame_rate if len(span) > 0 else 44100
+            span += AudioSegment.silent(duration=span_ms - len(span), frame_rate=frame_rate)
+        return span[:span_ms]
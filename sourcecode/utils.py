@@ -1,9 +1,37 @@
 import csv
+import hashlib
+import os
+import uuid
 from pathlib import Path
 from mutagen.mp3 import MP3
 from mutagen.easyid3 import EasyID3
+from mutagen.easymp4 import EasyMP4
+from mutagen.oggopus import OggOpus
 from pydub import AudioSegment
 
+from codec import get_codec_backend
+from encode_profiles import get_profile, list_audio_files
+
+# Large reads keep slow media (FAT drives, network shares) reading sequentially
+HASH_BUFFER_BYTES = 8 * 1024 * 1024
+
+def file_hash(file_path: Path) -> str:
+    """Returns the blake2b hash of the content of a file."""
+    digest = hashlib.blake2b(digest_size=16)
+    with open(file_path, "rb") as f:
+        while chunk := f.read(HASH_BUFFER_BYTES):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def write_file_atomically(file_path: Path, text: str) -> None:
+    """Writes the text to a temp_ file next to the target and renames it, so readers never see a partial file."""
+    temp_path = file_path.with_name(f"temp_{uuid.uuid4().hex[:8]}_{file_path.name}")
+    with open(temp_path, "w") as f:
+        f.write(text)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_path, file_path)
+
 def load_quran_numbers(csv_path):
     """Reads quran_numbers.csv and returns a dictionary mapping numbers to Surah names."""
     quran_dict = {}
@@ -33,6 +61,53 @@ def set_mp3_title(file_path: Path, sura_name: str):
     except Exception as e:
         print(f"Warning: Could not set title for {file_path}: {e}") 
 
+def tag_audio_file(file_path: Path, metadata: dict, tagging: str = "id3"):
+    """
+    Writes the metadata (title, album, artist, genre, ...) into the tags of an audio file.
+
+    Args:
+        file_path (Path): The audio file to tag.
+        metadata (dict): Tag names mapped to their values.
+        tagging (str): The tag system of the container, as given by the "tagging" key of an encode profile.
+    """
+    if tagging == "id3":
+        # Ensure file has an ID3 tag
+        mp3 = MP3(str(file_path))
+        if mp3.tags is None:
+            mp3.add_tags()
+            mp3.save()
+        audio = EasyID3(str(file_path))
+    elif tagging == "vorbis":
+        audio = OggOpus(str(file_path))
+    elif tagging == "mp4":
+        audio = EasyMP4(str(file_path))
+    else:
+        raise ValueError(F"Unknown tagging '{tagging}' for {file_path}.")
+
+    for key, value in metadata.items():
+        audio[key] = value
+    audio.save()
+
+def pace_folder_name(pages_per_hour: float) -> str:
+    """Returns the name of the folder holding the tracks of a reciter tempo-normalized to a pace, e.g. "pace_20pph"."""
+    return f"pace_{pages_per_hour:g}pph"
+
+def pace_clip_prefix(clip_folder_prefix: str, pages_per_hour: float) -> str:
+    """Returns the clip folder prefix of clips cut from pace tracks, so their folders and file names differ from the median clips."""
+    return f"pace{pages_per_hour:g}_{clip_folder_prefix}"
+
+def find_median_folder(reciter_folder: Path, pages_per_hour: float = None) -> Path:
+    """
+    Returns the median folder of a reciter. Renamed "median <reciter>" folders are preferred over the plain "median" folder
+    written by create_median_length_tracks. With pages_per_hour the folder of the pace tracks of that pace is returned instead.
+    """
+    if pages_per_hour is not None:
+        return reciter_folder / pace_folder_name(pages_per_hour)
+    named_median_folder = reciter_folder / ("median " + reciter_folder.name)
+    if named_median_folder.exists():
+        return named_median_folder
+    return reciter_folder / "median"
+
 def split_all_median_files_to_clips(
     quran_data_folder: Path,
     clip_length_ms: int,
@@ -41,6 +116,10 @@ def split_all_median_files_to_clips(
     speedup_factor: float,
     metadata: dict,
     clip_folder_prefix: str,
+    clip_profile: str = None,
+    overlap_encode: bool = False,
+    duck: bool = True,
+    pages_per_hour: float = None,
 ):
     """
     Iterates through all reciter/median folders and splits each median file into overlapping clips.
@@ -52,30 +131,75 @@ def split_all_median_files_to_clips(
         overlap_ms (int): Overlap between consecutive clips in milliseconds.
         fade_duration (int): Fade in/out duration in milliseconds.
         metadata (dict): Metadata to apply to each clip.
+        clip_profile (str): Name of the encode profile for the clips, None for the default profile.
+        overlap_encode (bool): Assemble the clips from shared mp3 frame runs, see overlap_encode.save_clips_overlap_encoded.
+        duck (bool): Whether the middle of the clips is faded out and in again like postprocess_clip does.
+        pages_per_hour (float): Split the pace tracks of this pace instead of the median tracks, see pace_folder_name.
     """
-    from file_io import save_clips_no_concat
+    if pages_per_hour is not None:
+        clip_folder_prefix = pace_clip_prefix(clip_folder_prefix, pages_per_hour)
     for reciter_folder in sorted(quran_data_folder.iterdir()):
 
         reciter_name = reciter_folder.name
-        if not reciter_folder.is_dir():
+        if not reciter_folder.is_dir() or reciter_name.startswith("."):
             continue
-        median_folder = reciter_folder / ("median " + reciter_name)
+        median_folder = find_median_folder(reciter_folder, pages_per_hour)
         if not median_folder.exists():
             continue
-        output_dir = reciter_folder / (clip_folder_prefix + "clips " + f"_SPD{speedup_factor:.2f}x".replace(".", "-") + "_" + reciter_name)
+        output_dir = reciter_folder / clip_folder_name(reciter_name, speedup_factor, clip_folder_prefix)
         output_dir.mkdir(exist_ok=True)
-        for median_file in sorted(median_folder.glob("*.mp3")):
-            audio = AudioSegment.from_mp3(median_file)
-            sura_num=int(median_file.stem.split("_")[0])
-            save_clips_no_concat(
-                audio=audio,
+        for median_file in list_audio_files(median_folder):
+            split_median_file_to_clips(
+                median_file=median_file,
+                output_dir=output_dir,
                 reciter_name=reciter_name,
-                sura_num=sura_num,
                 clip_length_ms=clip_length_ms,
                 overlap_ms=overlap_ms,
-                output_dir=output_dir,
-                fade_ms=fade_duration,
+                fade_duration=fade_duration,
                 metadata=metadata,
-                speedup_factor=1.0,
                 clip_folder_prefix=clip_folder_prefix,
-            ) 
\ No newline at end of file
+                clip_profile=clip_profile,
+                overlap_encode=overlap_encode,
+                duck=duck,
+            )
+
+def clip_folder_name(reciter_name: str, speedup_factor: float, clip_folder_prefix: str) -> str:
+    """Returns the name of the clip folder of a reciter for the given speed and clip preset."""
+    return clip_folder_prefix + "clips " + f"_SPD{speedup_factor:.2f}x".replace(".", "-") + "_" + reciter_name
+
+def split_median_file_to_clips(
+    median_file: Path,
+    output_dir: Path,
+    reciter_name: str,
+    clip_length_ms: int,
+    overlap_ms: int,
+    fade_duration: int,
+    metadata: dict,
+    clip_folder_prefix: str,
+    clip_profile: str = None,
+    overlap_encode: bool = False,
+    duck: bool = True,
+):
+    """
+    Splits a single median file into overlapping clips inside output_dir.
+    See split_all_median_files_to_clips for the arguments.
+    """
+    from file_io import save_clips_no_concat
+    from overlap_encode import save_clips_overlap_encoded
+    audio = get_codec_backend().decode(median_file)
+    sura_num=int(median_file.stem.split("_")[0])
+    save_clips = save_clips_overlap_encoded if overlap_encode else save_clips_no_concat
+    save_clips(
+        audio=audio,
+        reciter_name=reciter_name,
+        sura_num=sura_num,
+        clip_length_ms=clip_length_ms,
+        overlap_ms=overlap_ms,
+        output_dir=output_dir,
+        fade_ms=fade_duration,
+        metadata=metadata,
+        speedup_factor=1.0,
+        clip_folder_prefix=clip_folder_prefix,
+        profile=get_profile(clip_profile),
+        duck=duck,
+    )
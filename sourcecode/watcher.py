@@ -0,0 +1,254 @@
+import json
+import logging
+import math
+import time
+from pathlib import Path
+from typing import Dict, List
+
+import pandas as pd
+
+from encode_profiles import get_profile, list_audio_files
+from json_gen import ORIG_JSON_NAME, compute_median_speedups, load_folder_dfs, update_folder_df
+from speedster import create_median_track
+from utils import clip_folder_name, split_median_file_to_clips, write_file_atomically
+
+
+# The watch state lives in the quran data folder next to reciter_sura_sums.json:
+#   dirs     -> mtime of every reciter folder at the last poll, unchanged folders are not listed again
+#   files    -> size and mtime of every ingested original file
+#   pending  -> size and mtime of files seen but not yet settled (still downloading)
+#   speedups -> the median speedup factors the current medians and clips were made with
+WATCH_STATE_NAME = "watch_state.json"
+
+
+def snapshot_folder(rec_folder: Path) -> Dict[str, List[int]]:
+    """Returns size and mtime of the original mp3 files of a reciter folder, without the .fixedtmp files of correct_mp3_file."""
+    snapshot = {}
+    for sura_filep in rec_folder.iterdir():
+        if sura_filep.suffix != ".mp3" or ".fixedtmp" in sura_filep.name or not sura_filep.is_file():
+            continue
+        stat = sura_filep.stat()
+        snapshot[sura_filep.name] = [stat.st_size, stat.st_mtime_ns]
+    return snapshot
+
+
+def load_watch_state(quran_data_folder: Path) -> Dict:
+    """
+    Loads the WATCH_STATE_NAME of the quran data folder. Without one, the state is seeded from a previous batch run:
+    files listed in the ORIG_JSON_NAME of a reciter count as ingested and the speedups come from reciter_sura_sums.json.
+    """
+    state_path = quran_data_folder / WATCH_STATE_NAME
+    if state_path.exists():
+        with open(state_path) as f:
+            return json.load(f)
+
+    state = {"dirs": {}, "files": {}, "pending": {}, "speedups": {}}
+    for rec_folder in sorted(quran_data_folder.iterdir()):
+        json_path = rec_folder / ORIG_JSON_NAME
+        if rec_folder.name.startswith(".") or not json_path.exists():
+            continue
+        ingested_files = set(pd.read_json(json_path, lines=True, dtype={'trk_num': str}).get('file', []))
+        state["files"][rec_folder.name] = {name: signature for name, signature in snapshot_folder(rec_folder).items()
+                                           if name in ingested_files}
+    sums_path = quran_data_folder / "reciter_sura_sums.json"
+    if sums_path.exists():
+        with open(sums_path) as f:
+            state["speedups"] = compute_median_speedups(json.load(f))
+    return state
+
+
+def save_watch_state(quran_data_folder: Path, state: Dict) -> None:
+    write_file_atomically(quran_data_folder / WATCH_STATE_NAME, json.dumps(state, indent=2))
+
+
+def poll_changes(quran_data_folder: Path, state: Dict, settle_seconds: float) -> Dict[str, Dict]:
+    """
+    Compares the reciter folders with the snapshot in the state and returns the settled changes.
+    Only folders whose mtime changed (files added, removed or renamed) or which still have pending files are listed again.
+    A file is settled once its size and mtime did not change between two polls and it was last written settle_seconds ago.
+    The changes of a reciter are only returned once all of its files settled, so a reciter being downloaded is ingested in one go.
+
+    Returns:
+        Dict[str, Dict]: Reciter name mapped to "changed" (file name -> [size, mtime]) and "removed" (file names).
+    """
+    changes = {}
+    now_ns = time.time_ns()
+    for rec_folder in sorted(quran_data_folder.iterdir()):
+        reciter_name = rec_folder.name
+        if not rec_folder.is_dir() or reciter_name.startswith("."):
+            continue
+        dir_mtime = rec_folder.stat().st_mtime_ns
+        pending = state["pending"].get(reciter_name, {})
+        if state["dirs"].get(reciter_name) == dir_mtime and not pending:
+            continue
+
+        known = state["files"].get(reciter_name, {})
+        snapshot = snapshot_folder(rec_folder)
+        changed, still_pending = {}, {}
+        for name, signature in snapshot.items():
+            if known.get(name) == signature:
+                continue
+            if pending.get(name) == signature and now_ns - signature[1] >= settle_seconds * 1e9:
+                changed[name] = signature
+            else:
+                still_pending[name] = signature
+        removed = [name for name in known if name not in snapshot]
+
+        state["dirs"][reciter_name] = dir_mtime
+        if still_pending:
+            still_pending.update(changed)
+            state["pending"][reciter_name] = still_pending
+            continue
+        state["pending"].pop(reciter_name, None)
+        if changed or removed:
+            changes[reciter_name] = {"changed": changed, "removed": removed}
+    return changes
+
+
+def remove_sura_outputs(rec_folder: Path, sura_num: int, clip_dir: Path) -> None:
+    """Deletes the fixed file, the median file and the clips of a sura whose original changed or disappeared."""
+    sura_ID = f"{sura_num:03d}"
+    for folder, pattern in [(rec_folder / "fixed", f"{sura_ID}*_fixed.*"), (rec_folder / "median", f"{sura_ID}_median.*"),
+                            (clip_dir, f"*_SUR{sura_ID}_*")]:
+        if folder.exists():
+            for stale_filep in folder.glob(pattern):
+                stale_filep.unlink()
+
+
+def regenerate_sura_outputs(
+        rec_folder: Path,
+        sura_nums: List[int],
+        speed_change: float,
+        clip_length_ms: int,
+        overlap_ms: int,
+        fade_duration: int,
+        speedup_factor: float,
+        metadata: dict,
+        clip_folder_prefix: str,
+        intermediate_profile: str = None,
+        clip_profile: str = None) -> None:
+    """Writes the median file and the clips of the given suras of a reciter, old clips of those suras are deleted first."""
+    profile = get_profile(intermediate_profile)
+    reciter_name = rec_folder.name
+    median_folder = rec_folder / "median"
+    median_folder.mkdir(exist_ok=True)
+    output_dir = rec_folder / clip_folder_name(reciter_name, speedup_factor, clip_folder_prefix)
+    output_dir.mkdir(exist_ok=True)
+    for fixed_filep in list_audio_files(rec_folder / "fixed"):
+        sura_num = int(fixed_filep.stem.split("_")[0])
+        if sura_num not in sura_nums:
+            continue
+        median_filep = create_median_track(fixed_filep, median_folder, speed_change, profile)
+        # a clip run with fewer clips than before would leave the tail clips behind
+        for stale_clip in output_dir.glob(f"*_SUR{sura_num:03d}_*"):
+            stale_clip.unlink()
+        split_median_file_to_clips(
+            median_file=median_filep,
+            output_dir=output_dir,
+            reciter_name=reciter_name,
+            clip_length_ms=clip_length_ms,
+            overlap_ms=overlap_ms,
+            fade_duration=fade_duration,
+            metadata=metadata,
+            clip_folder_prefix=clip_folder_prefix,
+            clip_profile=clip_profile,
+        )
+
+
+def process_changes(
+        quran_data_folder: Path,
+        state: Dict,
+        changes: Dict[str, Dict],
+        clip_length_ms: int,
+        overlap_ms: int,
+        fade_duration: int,
+        speedup_factor: float,
+        metadata: dict,
+        clip_folder_prefix: str,
+        intermediate_profile: str = None,
+        clip_profile: str = None,
+        repair_mode: str = "remux",
+        speedup_tolerance: float = 1e-9) -> None:
+    """
+    Ingests the changes from poll_changes and regenerates only what they affect:
+        - only the new or changed originals are fixed and probed, the other rows of ORIG_JSON_NAME are kept
+        - the reciter sums and median speedups are recomputed from the stored dataframes
+        - reciters whose speedup changed get all medians and clips regenerated, the others only those of the changed suras
+    """
+    changed_suras = {}
+    for reciter_name, change in changes.items():
+        rec_folder = quran_data_folder / reciter_name
+        clip_dir = rec_folder / clip_folder_name(reciter_name, speedup_factor, clip_folder_prefix)
+        print(F"\n{reciter_name}: {len(change['changed'])} new or changed files, {len(change['removed'])} removed files")
+        for name in list(change["changed"]) + change["removed"]:
+            remove_sura_outputs(rec_folder, int(name[:3]), clip_dir)
+        update_folder_df(rec_folder, [rec_folder / name for name in sorted(change["changed"])], change["removed"],
+                         intermediate_profile, repair_mode)
+
+        known = state["files"].setdefault(reciter_name, {})
+        known.update(change["changed"])
+        for name in change["removed"]:
+            known.pop(name, None)
+        changed_suras[reciter_name] = [int(name[:3]) for name in change["changed"]]
+
+    rec_folders = [quran_data_folder / reciter_name for reciter_name, known in sorted(state["files"].items()) if known]
+    reciter_sums_dict = load_folder_dfs(quran_data_folder, rec_folders, intermediate_profile, repair_mode)
+    if not reciter_sums_dict:
+        logging.warning("No sura is present for all reciters, the median speedups are not updated.")
+        return
+    rec_med_speedup = compute_median_speedups(reciter_sums_dict)
+
+    for rec_folder in rec_folders:
+        reciter_name = rec_folder.name
+        if reciter_name not in rec_med_speedup:
+            continue
+        old_speedup = state["speedups"].get(reciter_name)
+        if old_speedup is None or not math.isclose(old_speedup, rec_med_speedup[reciter_name], rel_tol=speedup_tolerance):
+            print(F"\n{reciter_name}: speedup changed from {old_speedup} to {rec_med_speedup[reciter_name]}, regenerating all suras")
+            sura_nums = [int(fixed_filep.stem.split("_")[0]) for fixed_filep in list_audio_files(rec_folder / "fixed")]
+        else:
+            sura_nums = changed_suras.get(reciter_name, [])
+        if not sura_nums:
+            continue
+        regenerate_sura_outputs(rec_folder, sura_nums, rec_med_speedup[reciter_name], clip_length_ms, overlap_ms, fade_duration,
+                                speedup_factor, metadata, clip_folder_prefix, intermediate_profile, clip_profile)
+        state["speedups"][reciter_name] = rec_med_speedup[reciter_name]
+
+
+def watch_quran_data_folder(
+        quran_data_folder: Path,
+        clip_length_ms: int,
+        overlap_ms: int,
+        fade_duration: int,
+        speedup_factor: float,
+        metadata: dict,
+        clip_folder_prefix: str,
+        intermediate_profile: str = None,
+        clip_profile: str = None,
+        repair_mode: str = "remux",
+        poll_seconds: float = 30.0,
+        settle_seconds: float = 60.0,
+        max_polls: int = None) -> None:
+    """
+    Long running counterpart of analyze_n_generate_medians + split_all_median_files_to_clips for a growing library:
+    polls the quran data folder and processes newly downloaded reciters and suras as they land, see process_changes.
+    The state is stored after every poll, so the watcher can be stopped and restarted at any time.
+
+    Args:
+        quran_data_folder (Path): Path to the main data folder containing reciter subfolders.
+        poll_seconds (float): Interval between two polls.
+        settle_seconds (float): Time a file must stay unchanged before it is ingested.
+        max_polls (int): Number of polls before returning, endless if None.
+        See split_all_median_files_to_clips and analyze_n_generate_medians for the other arguments.
+    """
+    state = load_watch_state(quran_data_folder)
+    print(F"Watching {quran_data_folder} every {poll_seconds:.0f}s ({sum(len(files) for files in state['files'].values())} files ingested)")
+    num_polls = 0
+    while max_polls is None or num_polls < max_polls:
+        changes = poll_changes(quran_data_folder, state, settle_seconds)
+        if changes:
+            process_changes(quran_data_folder, state, changes, clip_length_ms, overlap_ms, fade_duration, speedup_factor,
+                            metadata, clip_folder_prefix, intermediate_profile, clip_profile, repair_mode)
+        save_watch_state(quran_data_folder, state)
+        num_polls += 1
+        time.sleep(poll_seconds)